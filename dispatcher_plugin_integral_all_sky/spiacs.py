@@ -39,9 +39,14 @@ from . import conf_file, conf_dir
 
 from cdci_data_analysis.analysis.queries import  *
 from cdci_data_analysis.analysis.instrument import Instrument
+from cdci_data_analysis.analysis.parameters import Name
 from .spiacs_dataserver_dispatcher import   SpiacsDispatcher
 
 from .spiacs_lightcurve_query import   SpiacsLightCurveQuery
+from .spiacs_excess_query import   SpiacsExcessQuery
+from .spiacs_alignment import   SpiacsAlignmentQuery
+from .spiacs_pds_query import   SpiacsPowerSpectrumQuery
+from .spiacs_prefetch import start_prefetcher
 
 
 
@@ -51,7 +56,14 @@ def common_instr_query():
     #TODO make a special class
     #max_pointings=Integer(value=50,name='max_pointings')
 
-    instr_query_pars=[]
+    data_level = Name(name_format='str', name='data_level', value="ordinary")
+    data_level._allowed_values = ["ordinary", "realtime"]
+
+    # with yes, the query is profiled, see spiacs_profiling
+    spiacs_profile = Name(name_format='str', name='spiacs_profile', value="no")
+    spiacs_profile._allowed_values = ["no", "yes"]
+
+    instr_query_pars=[data_level, spiacs_profile]
 
     return instr_query_pars
 
@@ -76,10 +88,19 @@ def spiacs_factory():
 
     light_curve = SpiacsLightCurveQuery('spi_acs_lc_query')
 
+    excess = SpiacsExcessQuery('spi_acs_excess_query')
+
+    alignment = SpiacsAlignmentQuery('spi_acs_alignment_query')
+
+    pds = SpiacsPowerSpectrumQuery('spi_acs_pds_query')
+
 
 
     query_dictionary={}
     query_dictionary['spi_acs_lc'] = 'spi_acs_lc_query'
+    query_dictionary['spi_acs_excess'] = 'spi_acs_excess_query'
+    query_dictionary['spi_acs_alignment'] = 'spi_acs_alignment_query'
+    query_dictionary['spi_acs_pds'] = 'spi_acs_pds_query'
     #query_dictionary['update_image'] = 'update_image'
 
     print('--> conf_file',conf_file)
@@ -87,12 +108,16 @@ def spiacs_factory():
 
 
 
-    return  Instrument('spi_acs',
+    instrument = Instrument('spi_acs',
                        asynch=False,
                        data_serve_conf_file=conf_file,                    
                        src_query=src_query,
                        instrumet_query=instr_query,
-                       product_queries_list=[light_curve],
+                       product_queries_list=[light_curve, excess, alignment, pds],
                        data_server_query_class=SpiacsDispatcher,
                        query_dictionary=query_dictionary)
 
+    start_prefetcher(instrument.data_server_conf_dict)
+
+    return instrument
+
@@ -0,0 +1,158 @@
+"""
+Overview
+--------
+
+node-wide admission control for backend requests
+
+All dispatcher workers of a node share a state file, locked with fcntl, which holds
+a token bucket (request rate) and the leases of requests in flight (concurrency).
+Part of the capacity is reserved for realtime queries, which are the most urgent.
+Low priority requests (prefetching, see spiacs_prefetch) leave further headroom for user queries.
+
+A request over the limits waits up to max_wait_s for capacity; after that it is turned
+away before reaching the backend, so that the backend does not have to refuse it.
+
+Leases of workers which died while holding them are reclaimed.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import random
+import time
+import uuid
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+
+class AdmissionRefused(Exception):
+    pass
+
+
+class AdmissionControl(object):
+
+    defaults = dict(
+        state_file='/tmp/spiacs_backend_admission.json',
+        max_concurrent=8,
+        rate_per_s=5.,
+        burst=10.,
+        realtime_reserved=1,
+        low_priority_headroom=2,
+        max_wait_s=10.,
+        max_lease_s=600.,
+    )
+
+    def __init__(self, **kwargs):
+        unknown = set(kwargs) - set(self.defaults)
+        if len(unknown) > 0:
+            raise RuntimeError(f"unknown admission_control settings: {unknown}")
+
+        for k, v in {**self.defaults, **kwargs}.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def from_conf_dict(cls, conf_dict):
+        settings = conf_dict.get('admission_control')
+
+        if not settings or not settings.get('enabled', True):
+            return None
+
+        return cls(**{k: v for k, v in settings.items() if k != 'enabled' and v is not None})
+
+    @contextlib.contextmanager
+    def _locked_state(self):
+        with open(self.state_file, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    state = dict(tokens=self.burst, updated=time.time(), leases={})
+
+                yield state
+
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _reclaim_leases(self, state, now):
+        for lease_id, (pid, started) in list(state['leases'].items()):
+            stale = now - started > self.max_lease_s
+
+            if not stale:
+                try:
+                    os.kill(pid, 0)
+                except ProcessLookupError:
+                    stale = True
+                except PermissionError:
+                    pass
+
+            if stale:
+                logger.warning('reclaiming backend lease %s of pid %s', lease_id, pid)
+                del state['leases'][lease_id]
+
+    def try_acquire(self, realtime=False, low_priority=False):
+        """
+        returns a lease id, or None if there is no capacity now
+        """
+
+        now = time.time()
+
+        with self._locked_state() as state:
+            state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * self.rate_per_s)
+            state['updated'] = now
+
+            self._reclaim_leases(state, now)
+
+            reserved = 0 if realtime else self.realtime_reserved
+            if low_priority:
+                reserved += self.low_priority_headroom
+
+            if len(state['leases']) + reserved >= self.max_concurrent or state['tokens'] < 1 + reserved:
+                return None
+
+            lease_id = uuid.uuid4().hex
+            state['tokens'] -= 1
+            state['leases'][lease_id] = (os.getpid(), now)
+
+            return lease_id
+
+    def release(self, lease_id):
+        with self._locked_state() as state:
+            state['leases'].pop(lease_id, None)
+
+    @contextlib.contextmanager
+    def slot(self, realtime=False, low_priority=False):
+        t0 = time.time()
+
+        while True:
+            lease_id = self.try_acquire(realtime=realtime, low_priority=low_priority)
+
+            if lease_id is not None:
+                break
+
+            waited_s = time.time() - t0
+            if waited_s >= self.max_wait_s:
+                raise AdmissionRefused(
+                    f'SPI-ACS backend is busy serving other requests, please retry in a minute (waited {waited_s:.3g} s)')
+
+            time.sleep(min(random.uniform(0.05, 0.5), self.max_wait_s - waited_s))
+
+        if time.time() - t0 > 0.01:
+            logger.info('admitted to backend after waiting %.3g s', time.time() - t0)
+
+        try:
+            yield
+        finally:
+            self.release(lease_id)
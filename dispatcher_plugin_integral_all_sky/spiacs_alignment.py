@@ -0,0 +1,436 @@
+"""
+Overview
+--------
+
+alignment of realtime against ordinary SPI-ACS data
+
+Realtime time stamps drift with respect to the ordinary (consolidated) ones. Both data levels
+are fetched for the same window, put on a common grid, and cross-correlated with one FFT,
+in O(N log N) instead of a loop over trial offsets. The product reports the lag of the
+realtime data (sub-bin, from a parabola through the correlation peak), the peak correlation,
+the rate scaling between the two levels and the statistics of the residuals after alignment.
+
+Measured lags can be kept in realtime_time_correction_file, and applied to realtime light curves
+of all users, see RealtimeTimeCorrection. A lag is only kept when the alignment query asks for it
+with alignment_record_correction=yes, which needs the spiacs-time-correction role, and when its
+correlation peak is at least realtime_time_correction_min_correlation.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import fcntl
+import json
+import logging
+import time
+import traceback
+from concurrent import futures
+from typing import List
+
+import numpy as np
+
+from cdci_data_analysis.analysis.queries import ProductQuery
+from cdci_data_analysis.analysis.parameters import Float, Name
+from cdci_data_analysis.analysis.products import LightCurveProduct, QueryOutput
+from oda_api.data_products import NumpyDataProduct, NumpyDataUnit
+
+from .spiacs_dataserver_dispatcher import SpiacsDispatcher, SpiacsAnalysisException
+from .spiacs_lightcurve_query import SpicasLightCurve, SpiacsDataQueryMixin
+from .spiacs_profiling import profiled
+from .spiacs_time import integral_mjdref
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+time_correction_role = 'spiacs-time-correction'
+
+
+alignment_dtype = [('LAG', '<f8'),
+                   ('CORRELATION', '<f8')]
+
+
+def grid_counts(time_s, counts, instr_t_bin, t0, bin_s, n):
+    """
+    counts summed on a regular grid of n bins of bin_s from t0, and the mask of bins with data
+    """
+    # by the sample centre: robust to rounding of the time stamps at the bin edges
+    i = np.floor((time_s + instr_t_bin / 2. - t0) / bin_s).astype(np.int64)
+
+    return (np.bincount(i, weights=counts, minlength=n)[:n],
+            np.bincount(i, minlength=n)[:n] > 0)
+
+
+def align_counts(time_a_s, counts_a, instr_t_bin_a, time_b_s, counts_b, instr_t_bin_b, max_lag_s=10.):
+    """
+    finds the lag of series b with respect to series a: the same signal is seen at t in a and t + lag_s in b.
+
+    returns a dict of results, and the cross-correlation for lags up to max_lag_s as a structured array
+    """
+
+    bin_s = max(instr_t_bin_a, instr_t_bin_b)
+
+    t0 = min(time_a_s[0], time_b_s[0])
+    n = int(np.floor((max(time_a_s[-1], time_b_s[-1]) + bin_s - t0) / bin_s)) + 1
+
+    a, mask_a = grid_counts(time_a_s, np.asarray(counts_a, dtype=float), instr_t_bin_a, t0, bin_s, n)
+    b, mask_b = grid_counts(time_b_s, np.asarray(counts_b, dtype=float), instr_t_bin_b, t0, bin_s, n)
+
+    if mask_a.sum() < 2 or mask_b.sum() < 2:
+        raise SpiacsAnalysisException(message='not enough data to align realtime and ordinary data')
+
+    a_dev = np.where(mask_a, a - a[mask_a].mean(), 0.)
+    b_dev = np.where(mask_b, b - b[mask_b].mean(), 0.)
+
+    # zero padding to avoid circular wrap-around
+    n_fft = 1 << int(np.ceil(np.log2(2 * n)))
+
+    # correlation[k] = sum_t a[t] b[t + k]
+    correlation = np.fft.irfft(np.conj(np.fft.rfft(a_dev, n_fft)) * np.fft.rfft(b_dev, n_fft), n_fft)
+    correlation /= np.sqrt(np.sum(a_dev ** 2) * np.sum(b_dev ** 2))
+
+    max_lag = min(int(np.ceil(max_lag_s / bin_s)), n - 1)
+    lags = np.arange(-max_lag, max_lag + 1)
+    correlation = correlation[lags % n_fft]
+
+    i_peak = int(np.argmax(correlation))
+    k = int(lags[i_peak])
+
+    # sub-bin peak position
+    offset = 0.
+    if 0 < i_peak < lags.size - 1:
+        y_m, y_0, y_p = correlation[i_peak - 1:i_peak + 2]
+        curvature = y_m - 2 * y_0 + y_p
+        if curvature < 0:
+            offset = 0.5 * (y_m - y_p) / curvature
+
+    # residuals after shifting by the whole bins of the peak
+    a_overlap = a[max(-k, 0):n - max(k, 0)]
+    b_overlap = b[max(k, 0):n - max(-k, 0)]
+    overlap = mask_a[max(-k, 0):n - max(k, 0)] & mask_b[max(k, 0):n - max(-k, 0)]
+
+    a_overlap = a_overlap[overlap]
+    b_overlap = b_overlap[overlap]
+
+    scale = np.sum(a_overlap * b_overlap) / np.sum(a_overlap ** 2)
+    residual = b_overlap - scale * a_overlap
+
+    # Poisson variance of both
+    variance = b_overlap + scale ** 2 * a_overlap
+    usable = variance > 0
+
+    ccf = np.zeros(lags.size, dtype=alignment_dtype)
+    ccf['LAG'] = lags * bin_s
+    ccf['CORRELATION'] = correlation
+
+    results = dict(
+        lag_s=float((k + offset) * bin_s),
+        correlation_peak=float(correlation[i_peak]),
+        rate_scale=float(scale),
+        residual_mean=float(residual.mean()),
+        residual_std=float(residual.std()),
+        residual_chi2_dof=float(np.mean(residual[usable] ** 2 / variance[usable])),
+        n_overlap=int(overlap.sum()),
+        time_bin=float(bin_s),
+    )
+
+    logger.info('alignment of %s and %s samples: %s', len(time_a_s), len(time_b_s), results)
+
+    return results, ccf
+
+
+class RealtimeTimeCorrection(object):
+    """
+    lags of realtime data measured by alignment queries, kept in a file shared by all workers.
+    The correction of a realtime light curve is the opposite of the lag measured closest in time,
+    if it is not further than max_distance_s.
+    """
+
+    def __init__(self, state_file, max_distance_s=86400., min_correlation=0.3, max_records=1000):
+        self.state_file = state_file
+        self.max_distance_s = max_distance_s
+        self.min_correlation = min_correlation
+        self.max_records = max_records
+
+    @classmethod
+    def from_conf_dict(cls, conf_dict):
+        if not conf_dict.get('realtime_time_correction_file'):
+            return None
+
+        return cls(conf_dict['realtime_time_correction_file'],
+                   max_distance_s=conf_dict.get('realtime_time_correction_max_distance_s', 86400.),
+                   min_correlation=conf_dict.get('realtime_time_correction_min_correlation', 0.3))
+
+    def _read(self, f):
+        f.seek(0)
+        try:
+            return json.loads(f.read())
+        except ValueError:
+            return []
+
+    def record(self, t_ijd, lag_s, correlation_peak):
+        if correlation_peak < self.min_correlation:
+            logger.info('not recording realtime lag %s s, correlation %s too low', lag_s, correlation_peak)
+            return
+
+        with open(self.state_file, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                records = [r for r in self._read(f) if r[0] != t_ijd]
+                records.append([t_ijd, lag_s, correlation_peak, time.time()])
+
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(sorted(records)[-self.max_records:]))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def correction_s(self, t_ijd):
+        try:
+            with open(self.state_file) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                records = self._read(f)
+        except FileNotFoundError:
+            return 0.
+
+        if len(records) == 0:
+            return 0.
+
+        t_record, lag_s, _, _ = min(records, key=lambda r: abs(r[0] - t_ijd))
+
+        if abs(t_record - t_ijd) * 86400 > self.max_distance_s:
+            return 0.
+
+        return -lag_s
+
+
+class SpiacsBothLevelsDispatcher(object):
+    """
+    fetches the same window at both data levels, in parallel
+    """
+
+    def __init__(self, instrument, config, param_dict):
+        self.dispatchers = [SpiacsDispatcher(instrument=instrument,
+                                             config=config,
+                                             param_dict={**param_dict, 'data_level': data_level})
+                            for data_level in ('ordinary', 'realtime')]
+
+    def run_query(self, call_back_url=None, run_asynch=False, logger=None, param_dict=None):
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(
+                lambda dispatcher: dispatcher.run_query(call_back_url=call_back_url, run_asynch=run_asynch,
+                                                        logger=logger),
+                self.dispatchers))
+
+        (res, _), (res_rt, query_out) = results
+
+        return (res, res_rt), query_out
+
+
+class SpiacsAlignmentTable(LightCurveProduct):
+
+    def __init__(self, name, file_name, data, prod_prefix=None, out_dir=None, src_name=None, meta_data=None):
+
+        if meta_data is None:
+            meta_data = {}
+
+        self.meta_data = {'product': 'spiacs_alignment',
+                          'instrument': 'spiacs', 'src_name': src_name,
+                          **meta_data}
+
+        super().__init__(name=name,
+                         data=data,
+                         name_prefix=prod_prefix,
+                         file_dir=out_dir,
+                         file_name=file_name,
+                         meta_data=self.meta_data)
+
+    @classmethod
+    def build_from_res(cls,
+                       res,
+                       src_name='',
+                       prod_prefix='spiacs_alignment',
+                       out_dir=None,
+                       max_lag_s=10.):
+
+        ((res, res_ephs), (res_rt, res_rt_ephs)) = res
+
+        if out_dir is None:
+            out_dir = './'
+
+        if prod_prefix is None:
+            prod_prefix = ''
+
+        file_name = src_name + '.fits'
+
+        SpicasLightCurve.check_res_has_data(res)
+        SpicasLightCurve.check_res_has_data(res_rt)
+
+        try:
+            data, _ = SpicasLightCurve.parse_res(res, 'ordinary')
+            data_rt, comment = SpicasLightCurve.parse_res(res_rt, 'realtime')
+
+            t_ref = SpicasLightCurve.deduce_t_ref(data)
+
+            results, ccf = align_counts((data['TIME_IJD'] - t_ref) * 24 * 3600,
+                                        data['COUNTS'],
+                                        SpicasLightCurve.deduce_instr_t_bin(data),
+                                        (data_rt['TIME_IJD'] - t_ref) * 24 * 3600,
+                                        data_rt['COUNTS'],
+                                        SpicasLightCurve.deduce_instr_t_bin(data_rt),
+                                        max_lag_s=max_lag_s)
+
+            header = {}
+            header['EXTNAME'] = 'ALIGNMENT'
+            header['TIMESYS'] = 'TT'
+            header['TIMEREF'] = 'LOCAL'
+            header['TASSIGN'] = 'SATELLITE'
+            header['MJDREF'] = integral_mjdref
+            header['TIMEZERO'] = t_ref * 24 * 3600
+            header['TIMEUNIT'] = 's '
+            header['TELESCOP'] = 'INTEGRAL'
+            header['INSTRUME'] = 'SPI-ACS'
+            header['TIMEDEL'] = results['time_bin']
+            header['LAG'] = results['lag_s']
+            header['CCPEAK'] = results['correlation_peak']
+            header['RATESCAL'] = results['rate_scale']
+            header['RESMEAN'] = results['residual_mean']
+            header['RESSTD'] = results['residual_std']
+            header['RESCHI2'] = results['residual_chi2_dof']
+            header['NOVERLAP'] = results['n_overlap']
+            header['PROPHECY'] = comment
+            header['EPHS'] = SpicasLightCurve.strip_ephs_text(res_ephs)
+
+            units_dict = {}
+            units_dict['LAG'] = 's'
+
+            meta_data = {'src_name': src_name,
+                         't_ref_ijd': float(t_ref),
+                         **results}
+
+            npd = NumpyDataProduct(data_unit=NumpyDataUnit(data=ccf,
+                                                           name='ALIGNMENT',
+                                                           data_header=header,
+                                                           hdu_type='bintable',
+                                                           units_dict=units_dict),
+                                   meta_data=meta_data)
+
+            table = cls(name=src_name, data=npd, file_name=file_name, out_dir=out_dir,
+                        prod_prefix=prod_prefix, src_name=src_name, meta_data=meta_data)
+
+        except SpiacsAnalysisException:
+            raise
+
+        except Exception as e:
+            logger.info(traceback.format_exc())
+
+            raise SpiacsAnalysisException(
+                message='spiacs realtime alignment failed: %s' % e.__repr__(), debug_message=str(e))
+
+        return [table]
+
+
+class SpiacsAlignmentQuery(SpiacsDataQueryMixin, ProductQuery):
+
+    def __init__(self, name):
+
+        alignment_max_lag_s = Float(value=10., name='alignment_max_lag_s')
+
+        # with yes, the lag is kept and corrects the realtime light curves of all users
+        alignment_record_correction = Name(name_format='str', name='alignment_record_correction', value='no')
+        alignment_record_correction._allowed_values = ['no', 'yes']
+
+        super(SpiacsAlignmentQuery, self).__init__(name, parameters_list=[alignment_max_lag_s,
+                                                                          alignment_record_correction])
+
+    def get_data_server_query(self, instrument,
+                              config=None):
+        q = super(SpiacsAlignmentQuery, self).get_data_server_query(instrument, config=config)
+
+        return SpiacsBothLevelsDispatcher(instrument=instrument, config=config, param_dict=q.param_dict)
+
+    def check_query_roles(self, provided_roles: List[str], par_dic: dict):
+        # realtime data is always fetched
+        roles = super(SpiacsAlignmentQuery, self).check_query_roles(provided_roles,
+                                                                    {**par_dic, 'data_level': 'realtime'})
+
+        if par_dic.get('alignment_record_correction') != 'yes' or time_correction_role in provided_roles:
+            return roles
+
+        return dict(authorization=False,
+                    needed_roles=roles['needed_roles'] + [time_correction_role],
+                    needed_roles_with_comments={
+                        **roles.get('needed_roles_with_comments', {}),
+                        time_correction_role: "recording realtime time corrections for all users requires special role"})
+
+    @profiled('build_product_list')
+    def build_product_list(self, instrument, res, out_dir, prod_prefix='spiacs_alignment', api=False):
+        return SpiacsAlignmentTable.build_from_res(
+            res,
+            src_name='query',
+            prod_prefix=prod_prefix,
+            out_dir=out_dir,
+            max_lag_s=instrument.get_par_by_name('alignment_max_lag_s').value)
+
+    @profiled('process_product_method')
+    def process_product_method(self, instrument, prod_list, api=False):
+
+        _names = []
+        _table_path = []
+        _html_fig = []
+
+        _data_list = []
+
+        message = ''
+
+        time_correction = None
+
+        if instrument.get_par_by_name('alignment_record_correction').value == 'yes':
+            time_correction = RealtimeTimeCorrection.from_conf_dict(instrument.data_server_conf_dict)
+
+        for query_alignment in prod_list.prod_list:
+            query_alignment.add_url_to_fits_file(
+                instrument._current_par_dic, url=instrument.disp_conf.products_url)
+            query_alignment.write()
+
+            results = query_alignment.meta_data
+
+            message = ('realtime data lags ordinary data by %.4g s, correlation peak %.3g, '
+                       'realtime/ordinary rate scale %.4g, residual chi2/dof %.3g' % (
+                           results['lag_s'], results['correlation_peak'],
+                           results['rate_scale'], results['residual_chi2_dof']))
+
+            if time_correction is not None:
+                time_correction.record(results['t_ref_ijd'], results['lag_s'], results['correlation_peak'])
+
+            if api == False:
+                _names.append(query_alignment.name)
+                _table_path.append(str(query_alignment.file_path.name))
+
+                du = query_alignment.data.get_data_unit_by_name('ALIGNMENT')
+                _html_fig.append(query_alignment.get_html_draw(x=du.data['LAG'],
+                                                               dx=np.zeros(du.data.size) + du.header['TIMEDEL'] / 2.,
+                                                               y=du.data['CORRELATION'],
+                                                               title='Start Time: %s' % instrument.get_par_by_name(
+                                                                   'T1')._astropy_time.utc.value,
+                                                               x_label='Realtime lag  (s)',
+                                                               y_label='Correlation'))
+            else:
+                _data_list.append(query_alignment.data)
+
+        query_out = QueryOutput()
+
+        if api == True:
+            query_out.prod_dictionary['numpy_data_product_list'] = _data_list
+            query_out.prod_dictionary['binary_data_product_list'] = []
+        else:
+            query_out.prod_dictionary['name'] = _names
+            query_out.prod_dictionary['file_name'] = _table_path
+            query_out.prod_dictionary['image'] = _html_fig
+            query_out.prod_dictionary['download_file_name'] = 'alignment.tar.gz'
+
+        query_out.prod_dictionary['prod_process_message'] = message
+
+        self.set_backend_fetch_stats(instrument, query_out)
+
+        return query_out
@@ -0,0 +1,331 @@
+"""
+Overview
+--------
+
+local archive of ordinary-level SPI-ACS counts
+
+Ordinary-level data does not change after processing, so it can be kept locally instead of
+being fetched again from the backend. The archive has one directory per IJD day::
+
+    <archive_dir>/<ijd day>/TIME_S.<generation>.f8   seconds since the start of the IJD day, float64
+    <archive_dir>/<ijd day>/COUNTS.<generation>.u4   counts in the instrument bin, uint32
+    <archive_dir>/<ijd day>/meta.json               generation, number of samples and covered intervals
+
+Columns are raw little-endian arrays, read with np.memmap: a query only maps the slice it needs.
+A write adds a new generation of the columns of a day, and replacing meta.json switches readers to it,
+so that they never pair the times of one generation with the counts of another. Writers of a day take
+a lock on <archive_dir>/<ijd day>/.lock for their read-merge-write.
+Windows without data are not archived: the backend may still process them, and a query of
+a window without archived samples goes to the backend, which tells the user why there is no data.
+Nor are windows which are not settled yet (see is_settled in spiacs_negative_cache): their data may
+still be completed.
+Ingesting from the backend goes through the fetch policy and admission control of the dispatcher,
+with low priority.
+
+The archive is filled with::
+
+    python -m dispatcher_plugin_integral_all_sky.spiacs_archive ingest --archive-dir DIR --start ISOT --stop ISOT
+    python -m dispatcher_plugin_integral_all_sky.spiacs_archive ingest-files --archive-dir DIR FILE [FILE ...]
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+from .spiacs_negative_cache import is_settled
+from .spiacs_raw import CompactCounts
+from .spiacs_time import isot_to_ijd, ijd_to_isot
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+
+def merge_intervals(intervals):
+    merged = []
+    for start, stop in sorted(intervals):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+class ArchivedRes(object):
+    """
+    stands in for the backend response: carries the already parsed data
+    """
+
+    status_code = 200
+    text = ''
+    content = b''
+
+    def __init__(self, data):
+        self.data = data
+
+
+class SpiacsArchive(object):
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+
+    def day_dir(self, day):
+        return os.path.join(self.archive_dir, '%05d' % day)
+
+    @staticmethod
+    def days(t1_ijd, t2_ijd):
+        return range(int(np.floor(t1_ijd)), max(int(np.ceil(t2_ijd)), int(np.floor(t1_ijd)) + 1))
+
+    def read_meta(self, day):
+        try:
+            with open(os.path.join(self.day_dir(day), 'meta.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict(n=0, covered=[])
+
+    def column_paths(self, day, meta):
+        """
+        time and counts files of the generation of meta; archives written before generations have none
+        """
+
+        suffix = '' if meta.get('generation') is None else '.%d' % meta['generation']
+
+        return (os.path.join(self.day_dir(day), 'TIME_S%s.f8' % suffix),
+                os.path.join(self.day_dir(day), 'COUNTS%s.u4' % suffix))
+
+    def covers(self, t1_ijd, t2_ijd):
+        for day in self.days(t1_ijd, t2_ijd):
+            start_s = max(t1_ijd - day, 0) * 86400
+            stop_s = min(t2_ijd - day, 1) * 86400
+
+            if not any(c_start <= start_s and stop_s <= c_stop
+                       for c_start, c_stop in self.read_meta(day)['covered']):
+                return False
+
+        return True
+
+    def map_day(self, day):
+        while True:
+            meta = self.read_meta(day)
+
+            if meta['n'] == 0:
+                return np.zeros(0, dtype='<f8'), np.zeros(0, dtype='<u4')
+
+            time_path, counts_path = self.column_paths(day, meta)
+
+            try:
+                # mapped files stay readable when a writer removes them
+                return (np.memmap(time_path, dtype='<f8', mode='r', shape=(meta['n'],)),
+                        np.memmap(counts_path, dtype='<u4', mode='r', shape=(meta['n'],)))
+            except FileNotFoundError:
+                # replaced by a new generation since meta was read
+                if self.read_meta(day).get('generation') == meta.get('generation'):
+                    raise
+
+    def read(self, t1_ijd, t2_ijd):
+        """
+        returns the archived samples in [t1_ijd, t2_ijd), or None if the interval is not fully archived
+        or has no samples
+        """
+
+        if not self.covers(t1_ijd, t2_ijd):
+            return None
+
+        time_ijd_chunks = []
+        counts_chunks = []
+
+        for day in self.days(t1_ijd, t2_ijd):
+            time_s, counts = self.map_day(day)
+
+            i1, i2 = np.searchsorted(time_s, [(t1_ijd - day) * 86400, (t2_ijd - day) * 86400])
+
+            time_ijd_chunks.append(day + time_s[i1:i2] / 86400.)
+            counts_chunks.append(counts[i1:i2])
+
+        data = CompactCounts.from_arrays(np.concatenate(time_ijd_chunks), np.concatenate(counts_chunks))
+
+        if data.size == 0:
+            logger.info('no archived samples for %s - %s', t1_ijd, t2_ijd)
+            return None
+
+        logger.info('read %s samples from archive for %s - %s', data.size, t1_ijd, t2_ijd)
+
+        return data
+
+    def write(self, data, covered):
+        """
+        adds samples (structured array with TIME_IJD and COUNTS, or CompactCounts) and the IJD intervals they cover
+        """
+
+        if isinstance(data, CompactCounts):
+            data = data.to_raw()
+
+        days = set()
+        for t1, t2 in covered:
+            days.update(range(int(np.floor(t1)), int(np.ceil(t2))))
+
+        for day in sorted(days):
+            self._write_day(day, data, covered)
+
+    def _write_day(self, day, data, covered):
+        day_dir = self.day_dir(day)
+        os.makedirs(day_dir, exist_ok=True)
+
+        with open(os.path.join(day_dir, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._merge_day(day, data, covered)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _merge_day(self, day, data, covered):
+        day_data = data[np.floor(data['TIME_IJD']) == day]
+
+        meta = self.read_meta(day)
+        previous_paths = self.column_paths(day, meta)
+
+        time_s, counts = self.map_day(day)
+
+        new_time_s = (day_data['TIME_IJD'] - day) * 86400
+
+        time_s, i = np.unique(np.concatenate([time_s, new_time_s]), return_index=True)
+        counts = np.concatenate([counts, day_data['COUNTS'].astype('<u4')])[i]
+
+        meta['generation'] = meta.get('generation', 0) + 1
+        meta['n'] = int(time_s.size)
+        meta['covered'] = merge_intervals(
+            meta['covered'] +
+            [[max(t1 - day, 0) * 86400, min(t2 - day, 1) * 86400]
+             for t1, t2 in covered if t1 < day + 1 and t2 > day])
+
+        day_dir = self.day_dir(day)
+
+        # columns of the new generation first, meta last: readers trust the meta only
+        for path, column in zip(self.column_paths(day, meta), (time_s.astype('<f8'), counts.astype('<u4'))):
+            with tempfile.NamedTemporaryFile(dir=day_dir, delete=False) as f:
+                column.tofile(f)
+            os.replace(f.name, path)
+
+        with tempfile.NamedTemporaryFile('w', dir=day_dir, delete=False) as f:
+            json.dump(meta, f)
+        os.replace(f.name, os.path.join(day_dir, 'meta.json'))
+
+        for path in previous_paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        logger.info('archived %s samples for IJD day %s, covered %s', meta['n'], day, meta['covered'])
+
+
+def ingest_from_backend(archive, dispatcher, start_isot, stop_isot, chunk_s=1800., settled_after_s=None):
+    """
+    archives the ordinary data of [start_isot, stop_isot), fetched by a SpiacsDispatcher in chunks of chunk_s;
+    chunks which fail, have no data or are not settled (by default after negative_cache_settled_after_s)
+    are left for the next run
+    """
+    import requests
+    from .spiacs_admission import AdmissionRefused
+    from .spiacs_fetch import BackendUnavailable
+    from .spiacs_lightcurve_query import SpicasLightCurve
+
+    dispatcher.low_priority = True
+
+    if settled_after_s is None:
+        settled_after_s = dispatcher.data_server_conf_dict.get('negative_cache_settled_after_s', 3 * 86400.)
+
+    t1_ijd = isot_to_ijd(start_isot)
+    t2_ijd = isot_to_ijd(stop_isot)
+
+    for chunk_start in np.arange(t1_ijd, t2_ijd, chunk_s / 86400.):
+        chunk_stop = min(chunk_start + chunk_s / 86400., t2_ijd)
+
+        if archive.covers(chunk_start, chunk_stop):
+            continue
+
+        if not is_settled('ordinary', chunk_stop, settled_after_s):
+            logger.info('chunk %s - %s is not settled, not archived', chunk_start, chunk_stop)
+            continue
+
+        param_dict = dict(t0_isot=ijd_to_isot((chunk_start + chunk_stop) / 2.),
+                          dt_s=(chunk_stop - chunk_start) * 86400 / 2.,
+                          data_level='ordinary')
+
+        try:
+            res = dispatcher.fetch_data(param_dict)
+        except (requests.exceptions.RequestException, BackendUnavailable, AdmissionRefused) as e:
+            logger.warning('can not fetch chunk %s - %s: %s', chunk_start, chunk_stop, e)
+            continue
+
+        if 'this service are limited' in res.text or 'Over revolution' in res.text:
+            logger.warning('backend refused chunk %s - %s: %s', chunk_start, chunk_stop, res.text[:200])
+            continue
+
+        text = SpicasLightCurve.strip_res_text(res)
+
+        if 'ZeroData' in text or 'NoData' in text:
+            logger.info('no data in chunk %s - %s, not archived', chunk_start, chunk_stop)
+            continue
+
+        archive.write(SpicasLightCurve.parse_ordinary_data(text), [[chunk_start, chunk_stop]])
+
+
+def ingest_from_files(archive, filenames):
+    from .spiacs_lightcurve_query import SpicasLightCurve
+
+    for fn in filenames:
+        with open(fn) as f:
+            data = SpicasLightCurve.parse_ordinary_data(f.read().replace(r"\n", "\n").strip('" \n\\n'))
+
+        instr_t_bin = SpicasLightCurve.deduce_instr_t_bin(data)
+
+        archive.write(data, [[data['TIME_IJD'][0], data['TIME_IJD'][-1] + instr_t_bin / 86400.]])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='fill the local SPI-ACS ordinary data archive')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest = subparsers.add_parser('ingest', help='fetch from the backend')
+    ingest.add_argument('--archive-dir', required=True)
+    ingest.add_argument('--start', required=True, help='UTC, isot')
+    ingest.add_argument('--stop', required=True, help='UTC, isot')
+    ingest.add_argument('--chunk-s', type=float, default=1800.)
+    ingest.add_argument('--data-server-url', default=None,
+                        help='defaults to data_server_url from the plugin configuration')
+
+    ingest_files = subparsers.add_parser('ingest-files', help='read recorded ordinary backend responses')
+    ingest_files.add_argument('--archive-dir', required=True)
+    ingest_files.add_argument('filenames', nargs='+')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    archive = SpiacsArchive(args.archive_dir)
+
+    if args.command == 'ingest':
+        from .spiacs import spiacs_factory
+        from .spiacs_dataserver_dispatcher import SpiacsDispatcher
+
+        dispatcher = SpiacsDispatcher(instrument=spiacs_factory())
+
+        if args.data_server_url is not None:
+            dispatcher.config(args.data_server_url)
+
+        ingest_from_backend(archive, dispatcher, args.start, args.stop, chunk_s=args.chunk_s)
+    else:
+        ingest_from_files(archive, args.filenames)
+
+
+if __name__ == '__main__':
+    main()
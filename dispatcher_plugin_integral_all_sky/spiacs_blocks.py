@@ -0,0 +1,173 @@
+"""
+Overview
+--------
+
+adaptive binning of light curves into Bayesian blocks
+
+The counts are first put in cells of time_bin (at least the instrument bin). Blocks of cells are
+chosen to maximize the sum of their Poisson log-likelihood N log(N / T), for N counts in exposure T,
+minus ncp_prior per block (Scargle et al. 2013, ApJ 764, 167), where ncp_prior follows from the
+false positive probability p0 of a change point.
+
+The optimal partition is found by dynamic programming over prefix sums of counts and exposures:
+each step evaluates all candidate starts of the last block at once, and candidates which
+can not start an optimal last block any more are pruned (PELT, Killick et al. 2012).
+On a slowly varying background, candidates only get pruned at change points, so that the cost grows
+with the number of cells times the block length. Light curves of more than max_cells cells are therefore
+partitioned on cells merged to at most max_cells, and each change point is then moved to the best
+position at full resolution, within a merged cell on either side.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+blocks_dtype = [('TIME', '<f8'),
+                ('TIMEDEL', '<f8'),
+                ('RATE', '<f8'),
+                ('ERROR', '<f8')]
+
+
+def ncp_prior(n_cells, p0=0.05):
+    """
+    block penalty for a false positive probability p0 (Scargle et al. 2013, eq. 21)
+    """
+    return 4 - np.log(73.53 * p0 * n_cells ** -0.478)
+
+
+def block_fitness(n_counts, exposure):
+    """
+    maximized Poisson log-likelihood of blocks, N log(N / T)
+    """
+    return n_counts * np.log(np.where(n_counts > 0, n_counts, 1.) / exposure)
+
+
+def optimal_partition(counts, exposure, penalty):
+    """
+    starts of the optimal blocks of cells, with the number of cells appended
+    """
+
+    n = counts.size
+
+    cumulative_counts = np.concatenate([[0.], np.cumsum(counts)])
+    cumulative_exposure = np.concatenate([[0.], np.cumsum(exposure)])
+
+    best = np.zeros(n + 1)
+    last_start = np.zeros(n + 1, dtype=np.int64)
+
+    candidates = np.zeros(1, dtype=np.int64)
+
+    for stop in range(1, n + 1):
+        values = best[candidates] + block_fitness(cumulative_counts[stop] - cumulative_counts[candidates],
+                                                  cumulative_exposure[stop] - cumulative_exposure[candidates])
+
+        i = values.argmax()
+        best[stop] = values[i] - penalty
+        last_start[stop] = candidates[i]
+
+        # splitting a block never lowers the likelihood: a start this far behind will never be the best
+        candidates = np.append(candidates[values >= best[stop]], stop)
+
+    starts = [n]
+    while starts[-1] > 0:
+        starts.append(last_start[starts[-1]])
+
+    return np.array(starts[::-1])
+
+
+def refine_edges(edges, cumulative_counts, cumulative_exposure, reach):
+    """
+    moves each inner edge within reach cells to the best split of its two neighbouring blocks
+    """
+
+    edges = edges.copy()
+
+    for k in range(1, edges.size - 1):
+        positions = np.arange(max(edges[k - 1] + 1, edges[k] - reach), min(edges[k + 1] - 1, edges[k] + reach) + 1)
+
+        values = block_fitness(cumulative_counts[positions] - cumulative_counts[edges[k - 1]],
+                               cumulative_exposure[positions] - cumulative_exposure[edges[k - 1]]) + \
+                 block_fitness(cumulative_counts[edges[k + 1]] - cumulative_counts[positions],
+                               cumulative_exposure[edges[k + 1]] - cumulative_exposure[positions])
+
+        edges[k] = positions[values.argmax()]
+
+    return edges
+
+
+def bayesian_blocks(counts, exposure, p0=0.05, max_cells=16384):
+    """
+    indices of the first cell of each block, with the number of cells appended
+    """
+
+    counts = np.asarray(counts, dtype=np.float64)
+    exposure = np.asarray(exposure, dtype=np.float64)
+
+    n = counts.size
+    penalty = ncp_prior(n, p0)
+
+    factor = int(np.ceil(n / max_cells))
+
+    if factor <= 1:
+        return optimal_partition(counts, exposure, penalty)
+
+    merged = np.arange(0, n, factor)
+
+    edges = optimal_partition(np.add.reduceat(counts, merged), np.add.reduceat(exposure, merged), penalty)
+    edges = np.append(merged, n)[edges]
+
+    logger.info('%s blocks on %s cells merged by %s, refining edges', edges.size - 1, merged.size, factor)
+
+    return refine_edges(edges,
+                        np.concatenate([[0.], np.cumsum(counts)]),
+                        np.concatenate([[0.], np.cumsum(exposure)]),
+                        factor)
+
+
+def block_light_curve(time_s, counts, instr_t_bin, cell_s=None, p0=0.05, max_cells=16384):
+    """
+    light curve of Bayesian blocks (see blocks_dtype): TIME is the middle of the block, TIMEDEL its width,
+    RATE and ERROR are over the exposure of the block, which excludes gaps
+
+    cells of cell_s (rounded to instrument bins) start at the first sample; returns the light curve and the cell width
+    """
+
+    time_s = np.asarray(time_s, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.float64)
+
+    factor = max(int(round((cell_s or instr_t_bin) / instr_t_bin)), 1)
+    cell_s = factor * instr_t_bin
+
+    cell_ids = np.rint((time_s - time_s[0]) / instr_t_bin).astype(np.int64) // factor
+
+    cell_counts = np.bincount(cell_ids, weights=counts)
+    cell_exposure = np.bincount(cell_ids) * instr_t_bin
+
+    # empty cells are gaps
+    used = np.flatnonzero(cell_exposure > 0)
+    cell_counts, cell_exposure = cell_counts[used], cell_exposure[used]
+
+    edges = bayesian_blocks(cell_counts, cell_exposure, p0=p0, max_cells=max_cells)
+
+    n_counts = np.add.reduceat(cell_counts, edges[:-1])
+    exposure = np.add.reduceat(cell_exposure, edges[:-1])
+
+    t_start = time_s[0] + used[edges[:-1]] * cell_s
+    t_stop = time_s[0] + (used[edges[1:] - 1] + 1) * cell_s
+
+    blocks = np.zeros(n_counts.size, dtype=blocks_dtype)
+    blocks['TIME'] = (t_start + t_stop) / 2
+    blocks['TIMEDEL'] = t_stop - t_start
+    blocks['RATE'] = n_counts / exposure
+    blocks['ERROR'] = np.sqrt(n_counts) / exposure
+
+    logger.info('%s Bayesian blocks from %s cells of %s s', blocks.size, used.size, cell_s)
+
+    return blocks, cell_s
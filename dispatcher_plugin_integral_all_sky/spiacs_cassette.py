@@ -0,0 +1,170 @@
+"""
+Overview
+--------
+
+record and replay of backend traffic
+
+To compare builds on the same data and the same backend behaviour, backend requests can be
+recorded once, e.g. in production, and replayed offline. With cassette_mode in data_server_conf.yml:
+
+* record: every request made by the dispatcher goes to the backend as usual, and its URL,
+  parameters, response body, status and latency, or its failure, are added to the cassette
+* replay: requests are answered from the cassette, after the recorded latency multiplied
+  by cassette_latency_scale (0 answers at once); requests not in the cassette fail
+
+The cassette in cassette_dir holds::
+
+    requests.jsonl      one line per request: key, status, latency, body digest or error
+    bodies/<sha256>.gz  response bodies, compressed, each stored once
+
+Requests recorded several times are replayed in turn, so that a replayed query mix sees
+the same sequence of answers as the recorded one.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+from .spiacs_fetch import BackendUnavailable
+from .spiacs_shared_cache import CachedRes
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def request_key(url, params=None):
+    return json.dumps([url, sorted((str(k), str(v)) for k, v in (params or {}).items())])
+
+
+class Cassette(object):
+
+    def __init__(self, cassette_dir, mode, latency_scale=1.):
+        self.cassette_dir = cassette_dir
+        self.mode = mode
+        self.latency_scale = latency_scale
+
+        self._lock = threading.Lock()
+        self._records = None
+        self._replayed = collections.Counter()
+
+    @classmethod
+    def from_conf_dict(cls, conf_dict):
+        """
+        one cassette per directory and process, so that replay order is kept across queries
+        """
+
+        mode = conf_dict.get('cassette_mode')
+
+        if not mode:
+            return None
+
+        if mode not in ('record', 'replay'):
+            raise ValueError('cassette_mode should be record or replay, not %r' % mode)
+
+        key = (conf_dict['cassette_dir'], mode, conf_dict.get('cassette_latency_scale', 1.))
+
+        with _cassettes_lock:
+            if key not in _cassettes:
+                _cassettes[key] = cls(*key)
+
+            return _cassettes[key]
+
+    def body_path(self, digest):
+        return os.path.join(self.cassette_dir, 'bodies', digest + '.gz')
+
+    def _append(self, record):
+        line = json.dumps(record) + '\n'
+
+        with self._lock:
+            os.makedirs(self.cassette_dir, exist_ok=True)
+
+            # a single write of a line in append mode is not interleaved with other writers
+            with open(os.path.join(self.cassette_dir, 'requests.jsonl'), 'a') as f:
+                f.write(line)
+
+    def record(self, fetch, url, params=None, **kwargs):
+        key = request_key(url, params)
+
+        t0 = time.time()
+
+        try:
+            res = fetch(url, params=params, **kwargs)
+        except (requests.exceptions.RequestException, BackendUnavailable) as e:
+            self._append(dict(key=key, latency_s=time.time() - t0, error=str(e)))
+            raise
+
+        latency_s = time.time() - t0
+
+        digest = hashlib.sha256(res.content).hexdigest()
+
+        if not os.path.exists(self.body_path(digest)):
+            os.makedirs(os.path.dirname(self.body_path(digest)), exist_ok=True)
+
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.body_path(digest)), delete=False) as f:
+                f.write(gzip.compress(res.content))
+
+            os.replace(f.name, self.body_path(digest))
+
+        self._append(dict(key=key, latency_s=latency_s, status_code=res.status_code, body=digest))
+
+        return res
+
+    def _load(self):
+        records = collections.defaultdict(list)
+
+        with open(os.path.join(self.cassette_dir, 'requests.jsonl')) as f:
+            for line in f:
+                record = json.loads(line)
+                records[record['key']].append(record)
+
+        logger.info('loaded cassette %s: %s requests', self.cassette_dir, sum(map(len, records.values())))
+
+        return records
+
+    def replay(self, url, params=None):
+        key = request_key(url, params)
+
+        with self._lock:
+            if self._records is None:
+                self._records = self._load()
+
+            recorded = self._records.get(key)
+
+            if not recorded:
+                raise BackendUnavailable('request not in cassette %s: %s' % (self.cassette_dir, key))
+
+            record = recorded[self._replayed[key] % len(recorded)]
+            self._replayed[key] += 1
+
+        time.sleep(record['latency_s'] * self.latency_scale)
+
+        if 'error' in record:
+            raise BackendUnavailable('recorded failure: %s' % record['error'])
+
+        with open(self.body_path(record['body']), 'rb') as f:
+            return CachedRes(gzip.decompress(f.read()), status_code=record['status_code'])
+
+    def fetch(self, fetch, url, params=None, **kwargs):
+        """
+        fetch(url, params=params, **kwargs) is the real request
+        """
+
+        if self.mode == 'record':
+            return self.record(fetch, url, params=params, **kwargs)
+
+        return self.replay(url, params=params)
@@ -0,0 +1,262 @@
+"""
+Overview
+--------
+
+single-flight coalescing of identical backend requests
+
+When many users ask for the same window at the same time (e.g. after an alert), only one
+backend fetch runs per key: within a process the other threads wait for the leader,
+across workers the leader holds a file lock in the shared cache directory and leaves its
+result there for the others to pick up.
+
+Results are left as JSON with the status, headers and body of each response, and rebuilt
+as requests.Response objects, never unpickled: the shared mount is writable by all workers.
+Workers wait for the lock of another worker for at most request_coalescing_ttl_s, and then fetch
+on their own.
+
+Results are only used for request_coalescing_ttl_s. The sweeper of the shared cache (spiacs_shared_cache)
+removes older ones, the locks of keys not requested for a while, and temporary files abandoned by crashed
+workers, with sweep_shared_results.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import base64
+import collections
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+
+def normalize_request_key(param_dict):
+    return (str(param_dict['t0_isot']),
+            round(float(param_dict['dt_s']), 3),
+            str(param_dict['data_level']))
+
+
+def request_key_digest(key):
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+
+def encode_responses(responses):
+    """
+    JSON of the status, headers and body of a sequence of responses
+    """
+    return json.dumps([dict(status_code=res.status_code,
+                            headers=dict(getattr(res, 'headers', None) or {}),
+                            # text of the stand-ins is utf-8
+                            encoding=getattr(res, 'encoding', None) or 'utf-8',
+                            content=base64.b64encode(res.content).decode())
+                       for res in responses]).encode()
+
+
+def decode_responses(blob):
+    """
+    the responses of encode_responses, as requests.Response
+    """
+    responses = []
+
+    for entry in json.loads(blob.decode()):
+        res = requests.models.Response()
+        res.status_code = entry['status_code']
+        res.headers = CaseInsensitiveDict(entry['headers'])
+        res.encoding = entry['encoding']
+        res._content = base64.b64decode(entry['content'])
+        responses.append(res)
+
+    return tuple(responses)
+
+
+def sweep_shared_results(shared_dir, result_ttl_s=30., max_age_s=3600.):
+    """
+    removes results older than result_ttl_s, and locks and temporary files older than max_age_s;
+    locks held by a worker are kept
+    """
+
+    coalescing_dir = os.path.join(shared_dir, 'coalescing')
+
+    try:
+        filenames = os.listdir(coalescing_dir)
+    except FileNotFoundError:
+        return 0
+
+    t0 = time.time()
+    n_removed = 0
+
+    for fn in filenames:
+        path = os.path.join(coalescing_dir, fn)
+
+        try:
+            age_s = t0 - os.path.getmtime(path)
+
+            if fn.endswith('.json'):
+                if age_s >= result_ttl_s:
+                    os.remove(path)
+                    n_removed += 1
+
+            elif fn.endswith('.lock'):
+                if age_s > max_age_s:
+                    with open(path, 'a') as lock_file:
+                        try:
+                            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            continue
+
+                        # a worker which opened it just before may lead beside one locking a new file:
+                        # at worst, the window is fetched twice
+                        os.remove(path)
+                        n_removed += 1
+
+            elif age_s > max_age_s:
+                os.remove(path)
+                n_removed += 1
+
+        except FileNotFoundError:
+            # removed by another sweeper
+            pass
+
+    return n_removed
+
+
+class _InFlightCall(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.counters = collections.Counter()
+
+    def do(self, key, fetch, shared_dir=None, shared_ttl_s=30., encode=encode_responses, decode=decode_responses):
+        """
+        calls fetch() once per key for all concurrent callers, and returns its result to all of them.
+        If shared_dir is given, the leader in this process also coordinates with other processes,
+        passing them the result as encode(result) bytes; results encoded to None are not passed
+        """
+
+        with self._lock:
+            call = self._calls.get(key)
+
+            if call is None:
+                call = _InFlightCall()
+                self._calls[key] = call
+                is_leader = True
+                self.counters['requests'] += 1
+            else:
+                is_leader = False
+                self.counters['requests'] += 1
+                self.counters['coalesced'] += 1
+
+        if not is_leader:
+            logger.info('waiting for in-flight backend request for %s', key)
+            call.event.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            if shared_dir is None:
+                call.result = fetch()
+            else:
+                call.result = self._do_shared(key, fetch, shared_dir, shared_ttl_s, encode, decode)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.result
+
+    def _read_shared_result(self, fn, shared_ttl_s, decode):
+        try:
+            if time.time() - os.path.getmtime(fn) >= shared_ttl_s:
+                return None
+
+            with open(fn, 'rb') as f:
+                return decode(f.read())
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _do_shared(self, key, fetch, shared_dir, shared_ttl_s, encode, decode):
+        coalescing_dir = os.path.join(shared_dir, 'coalescing')
+        os.makedirs(coalescing_dir, exist_ok=True)
+
+        fn = os.path.join(coalescing_dir, request_key_digest(key))
+
+        with open(fn + '.lock', 'a') as lock_file:
+            deadline = time.time() + shared_ttl_s
+
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                    # in use: kept by the sweeper
+                    os.utime(fn + '.lock')
+                    break
+                except BlockingIOError:
+                    pass
+
+                # a hung leader in another worker does not block this one for longer than the result would live
+                if time.time() > deadline:
+                    logger.warning('backend request for %s still locked by another worker, fetching', key)
+                    locked = False
+                    break
+
+                time.sleep(0.05)
+
+            try:
+                result = self._read_shared_result(fn + '.json', shared_ttl_s, decode)
+
+                if result is not None:
+                    with self._lock:
+                        self.counters['coalesced_shared'] += 1
+
+                    logger.info('using result of backend request for %s made by another worker', key)
+
+                    return result
+
+                result = fetch()
+
+                blob = encode(result)
+
+                if blob is not None:
+                    with tempfile.NamedTemporaryFile(dir=coalescing_dir, delete=False) as f:
+                        f.write(blob)
+
+                    os.replace(f.name, fn + '.json')
+
+                return result
+
+            finally:
+                if locked:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, in_flight=len(self._calls))
+
+
+single_flight = SingleFlight()
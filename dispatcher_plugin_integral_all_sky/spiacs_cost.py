@@ -0,0 +1,144 @@
+"""
+Overview
+--------
+
+pre-flight cost model of backend queries
+
+The backend returns every raw sample in the window, at the instrument bin, whatever time_bin is asked:
+a day at 50 ms is 1.7 million samples, a text response of about 50 MB and, while parsing, close to
+1 GB of worker memory. Before anything is fetched, the cost of a query is estimated from
+T2 - T1, the data level and the instrument bin:
+
+* raw samples and downloaded bytes
+* peak memory while parsing and rebinning, the response being held as bytes and text
+* output rows and bytes of the light curve
+
+The per-sample figures were measured with tracemalloc on parse_and_rebin (see spiacs_profiling),
+with some margin.
+
+With cost_limits in data_server_conf.yml, queries estimated to need more than
+offload_peak_memory_bytes are parsed in the process pool, away from the dispatcher worker, and
+queries above max_raw_samples, max_peak_memory_bytes or max_output_bytes are rejected, with a message
+telling how to make them smaller. Light curves served in pages (lc_page_rows, api only) are not limited
+by output size; since api is not known before fetching, the output size of queries asking for pages is
+checked again when the products are built.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+
+from cdci_data_analysis.analysis.exceptions import RequestNotUnderstood
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+# both data levels have the 50 ms SPI-ACS bin
+instr_t_bin_s = 0.05
+
+# ordinary: "8484.1000000000 0.050 150 0" lines; realtime: JSON rows, with a margin for extra columns
+text_bytes_per_sample = {'ordinary': 31, 'realtime': 40}
+
+# genfromtxt or json.loads, compact counts, float64 columns and rebinning, on top of the response
+parse_bytes_per_sample = {'ordinary': 450, 'realtime': 250}
+
+# TIME, RATE, ERROR
+output_bytes_per_row = 24
+
+
+class QueryCostExceeded(RequestNotUnderstood):
+    pass
+
+
+class QueryCost(object):
+
+    def __init__(self, n_raw_samples, download_bytes, peak_memory_bytes, n_output_rows, output_bytes):
+        self.n_raw_samples = n_raw_samples
+        self.download_bytes = download_bytes
+        self.peak_memory_bytes = peak_memory_bytes
+        self.n_output_rows = n_output_rows
+        self.output_bytes = output_bytes
+
+    @classmethod
+    def estimate(cls, duration_s, data_level, time_bin_s=None):
+        """
+        time_bin_s is the light curve bin, None if no light curve is produced
+        """
+
+        # a negative estimate would pass every limit
+        if not duration_s > 0:
+            raise RequestNotUnderstood('the requested time interval is empty: T2 should be after T1')
+
+        n_raw_samples = int(duration_s / instr_t_bin_s) + 1
+        download_bytes = n_raw_samples * text_bytes_per_sample[data_level]
+
+        # the response is held as bytes and as text while parsing
+        peak_memory_bytes = 2 * download_bytes + n_raw_samples * parse_bytes_per_sample[data_level]
+
+        if time_bin_s is None:
+            n_output_rows = 0
+        else:
+            n_output_rows = min(n_raw_samples, int(duration_s / max(time_bin_s, instr_t_bin_s)) + 1)
+
+        return cls(n_raw_samples, download_bytes, peak_memory_bytes, n_output_rows,
+                   n_output_rows * output_bytes_per_row)
+
+    def as_dict(self):
+        return dict(n_raw_samples=self.n_raw_samples,
+                    download_bytes=self.download_bytes,
+                    peak_memory_bytes=self.peak_memory_bytes,
+                    n_output_rows=self.n_output_rows,
+                    output_bytes=self.output_bytes)
+
+
+class CostLimits(object):
+
+    def __init__(self, max_raw_samples=None, max_peak_memory_bytes=None, offload_peak_memory_bytes=None,
+                 max_output_bytes=None):
+        self.max_raw_samples = max_raw_samples
+        self.max_peak_memory_bytes = max_peak_memory_bytes
+        self.offload_peak_memory_bytes = offload_peak_memory_bytes
+        self.max_output_bytes = max_output_bytes
+
+    @classmethod
+    def from_conf_dict(cls, conf_dict):
+        conf = conf_dict.get('cost_limits')
+
+        if not conf:
+            return None
+
+        return cls(max_raw_samples=conf.get('max_raw_samples'),
+                   max_peak_memory_bytes=conf.get('max_peak_memory_bytes'),
+                   offload_peak_memory_bytes=conf.get('offload_peak_memory_bytes'),
+                   max_output_bytes=conf.get('max_output_bytes'))
+
+    def route(self, cost, paged=False):
+        """
+        'inline' or 'process_pool', raises QueryCostExceeded for queries too large to run
+        """
+
+        problems = []
+
+        if self.max_raw_samples is not None and cost.n_raw_samples > self.max_raw_samples:
+            problems.append('about %s raw samples, more than %s' % (cost.n_raw_samples, self.max_raw_samples))
+
+        if self.max_peak_memory_bytes is not None and cost.peak_memory_bytes > self.max_peak_memory_bytes:
+            problems.append('about %.3g GB of memory, more than %.3g GB' % (cost.peak_memory_bytes / 1e9,
+                                                                             self.max_peak_memory_bytes / 1e9))
+
+        if problems:
+            raise QueryCostExceeded('the requested time interval is too long, it would need %s: '
+                                    'please request a shorter interval, or several of them' % ', '.join(problems))
+
+        if not paged and self.max_output_bytes is not None and cost.output_bytes > self.max_output_bytes:
+            raise QueryCostExceeded('the requested light curve would have about %s rows, %.3g MB, more than %.3g MB: '
+                                    'please request a larger time_bin, or, through the API, pages of rows '
+                                    'with lc_page_rows' % (cost.n_output_rows, cost.output_bytes / 1e6,
+                                                           self.max_output_bytes / 1e6))
+
+        if self.offload_peak_memory_bytes is not None and cost.peak_memory_bytes > self.offload_peak_memory_bytes:
+            return 'process_pool'
+
+        return 'inline'
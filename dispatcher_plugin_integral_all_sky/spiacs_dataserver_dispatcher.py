@@ -30,6 +30,7 @@ __author__ = "Volodymyr Savchenko, Andrea Tramacere"
 # eg copy
 # absolute import rg:from copy import deepcopy
 import ast
+import collections
 import requests
 # Dependencies
 # eg numpy
@@ -45,11 +46,23 @@ from cdci_data_analysis.analysis.queries import *
 from cdci_data_analysis.analysis.job_manager import Job
 from cdci_data_analysis.analysis.io_helper import FilePath
 from cdci_data_analysis.analysis.products import QueryOutput
+from .spiacs_coalescing import single_flight, normalize_request_key, encode_responses
+from .spiacs_archive import SpiacsArchive, ArchivedRes
+from .spiacs_time import isot_to_ijd
+from .spiacs_fetch import fetch, FetchPolicy, BackendUnavailable, circuit_breaker
+from .spiacs_admission import AdmissionControl, AdmissionRefused
+from .spiacs_cassette import Cassette
+from .spiacs_ephemeris import EphemerisStore
+from .spiacs_negative_cache import NegativeCache, no_data_keywords
+from .spiacs_revalidation import RealtimeRevalidation
+from .spiacs_shared_cache import ContentStore, CachedRes, shared_cache_root
+from .spiacs_profiling import profiled_stage
 import json
 import traceback
 import time
 from ast import literal_eval
 import os
+import contextlib
 from contextlib import contextmanager
 
 
@@ -64,6 +77,12 @@ class SpiacsAnalysisException(Exception):
         self.debug_message = debug_message
 
 
+class SpiacsBackendBusyException(SpiacsAnalysisException):
+
+    def __init__(self, message='SPI-ACS backend is busy, please retry later', debug_message=''):
+        super(SpiacsBackendBusyException, self).__init__(message, debug_message)
+
+
 class SpiacsException(Exception):
 
     def __init__(self, message='Spiacs analysis exception', debug_message=''):
@@ -85,7 +104,27 @@ class SpiacsDispatcher:
 
         self.param_dict = param_dict
 
-        
+        self.instrument = instrument
+
+        self.data_server_conf_dict = instrument.data_server_conf_dict
+
+        self.fetch_policy = FetchPolicy.from_conf_dict(self.data_server_conf_dict)
+        self.fetch_stats = collections.Counter()
+        self.admission_control = AdmissionControl.from_conf_dict(self.data_server_conf_dict)
+        self.negative_cache = NegativeCache.from_conf_dict(self.data_server_conf_dict)
+        self.shared_cache = ContentStore.from_conf_dict(self.data_server_conf_dict)
+        self.ephemeris_store = EphemerisStore.from_conf_dict(self.data_server_conf_dict)
+        self.cassette = Cassette.from_conf_dict(self.data_server_conf_dict)
+        self.realtime_revalidation = RealtimeRevalidation.from_conf_dict(self.data_server_conf_dict)
+
+        # set by the prefetcher, yields backend capacity to user queries
+        self.low_priority = False
+
+        if self.data_server_conf_dict.get('prefer_archive', False) and self.data_server_conf_dict.get('archive_dir'):
+            self.archive = SpiacsArchive(self.data_server_conf_dict['archive_dir'])
+        else:
+            self.archive = None
+
         config = DataServerConf(data_server_url=instrument.data_server_conf_dict['data_server_url'],
                                 dummy_cache=instrument.data_server_conf_dict['dummy_cache'])
 
@@ -171,39 +210,186 @@ class SpiacsDispatcher:
     def _run_test(self, t1=1482049941, t2=1482049941+100, dt=0.1, e1=10, e2=500):
         raise NotImplementedError
 
+    def _read_archive(self, param_dict):
+        if self.archive is None or param_dict['data_level'] != 'ordinary':
+            return None
+
+        t0_ijd = isot_to_ijd(param_dict['t0_isot'])
+        dt_ijd = float(param_dict['dt_s']) / 86400.
+
+        data = self.archive.read(t0_ijd - dt_ijd, t0_ijd + dt_ijd)
+
+        if data is None:
+            logger.info('window not in the archive, falling back to the data server')
+            return None
+
+        return ArchivedRes(data)
+
+    def _read_shared_cache(self, param_dict):
+        if self.shared_cache is None:
+            return None
+
+        ref = self.shared_cache.get_ref('response', normalize_request_key(param_dict), verify=False)
+
+        if ref is None:
+            return None
+
+        content, content_ephs = (self.shared_cache.get_bytes(ref['objects'][name]) for name in ('res', 'res_ephs'))
+
+        if content is None or content_ephs is None:
+            return None
+
+        logger.info('using backend response from the shared cache')
+
+        return CachedRes(content), CachedRes(content_ephs)
+
+    def _write_shared_cache(self, param_dict, res, res_ephs):
+        try:
+            self.shared_cache.put_ref('response', normalize_request_key(param_dict), param_dict['data_level'],
+                                      dict(res=self.shared_cache.put_bytes(res.content),
+                                           res_ephs=self.shared_cache.put_bytes(res_ephs.content)),
+                                      t2_ijd=isot_to_ijd(param_dict['t0_isot']) + float(param_dict['dt_s']) / 86400.)
+        except OSError as e:
+            # the shared mount is only a cache
+            logger.warning('can not write to the shared cache: %s', e)
+
+    @staticmethod
+    def _encode_coalesced(result):
+        # archived data is read as fast by the other workers
+        if isinstance(result[0], ArchivedRes):
+            return None
+
+        return encode_responses(result)
+
+    def _fetch(self, url, **kwargs):
+        if self.cassette is None:
+            return fetch(url, **kwargs)
+
+        return self.cassette.fetch(fetch, url, **kwargs)
+
+    def _fetch_data(self, data_server_url, url, param_dict):
+        if param_dict['data_level'] != 'realtime' or self.realtime_revalidation is None:
+            return self._fetch(url, params=param_dict, policy=self.fetch_policy,
+                               kind=param_dict['data_level'], stats=self.fetch_stats)
+
+        def window_url(t0_isot, dt_s):
+            return data_server_url.format(t0_isot=t0_isot, dt_s=dt_s).replace("genlc/ACS", "rtlc") + "?json&prophecy"
+
+        return self.realtime_revalidation.fetch(self._fetch, window_url, param_dict, policy=self.fetch_policy,
+                                                kind=param_dict['data_level'], stats=self.fetch_stats)
+
+    def fetch_data(self, param_dict):
+        """
+        the backend response for a window, under the fetch policy and admission control,
+        without looking at any cache
+        """
+        with self._admission_slot(param_dict):
+            return self._fetch_data(self.data_server_url, self._data_url(self.data_server_url, param_dict), param_dict)
+
+    @staticmethod
+    def _data_url(data_server_url, param_dict):
+        url = data_server_url.format(
+            t0_isot=param_dict['t0_isot'],
+            dt_s=param_dict['dt_s'],
+        )
+
+        if param_dict['data_level'] == 'realtime':
+            url = url.replace("genlc/ACS", "rtlc") + "?json&prophecy"
+
+        return url
+
+    def _read_ephemeris_store(self, param_dict):
+        if self.ephemeris_store is None:
+            return None
+
+        return self.ephemeris_store.get(isot_to_ijd(param_dict['t0_isot']))
+
+    def _fetch_ephemeris(self, url_ephs, param_dict):
+        res_ephs = self._fetch(url_ephs, policy=self.fetch_policy, kind='ephs', stats=self.fetch_stats)
+
+        if self.ephemeris_store is not None:
+            self.ephemeris_store.put(isot_to_ijd(param_dict['t0_isot']), res_ephs.text)
+
+        return res_ephs
+
+    def _admission_slot(self, param_dict):
+        if self.admission_control is None:
+            return contextlib.nullcontext()
+
+        return self.admission_control.slot(realtime=param_dict['data_level'] == 'realtime',
+                                           low_priority=self.low_priority)
+
     def _run(self, data_server_url, param_dict):
 
         try:
 
-            url = data_server_url.format(
-                t0_isot=param_dict['t0_isot'],
-                dt_s=param_dict['dt_s'],
-            )
+            url = self._data_url(data_server_url, param_dict)
 
             url_ephs = data_server_url.replace("genlc/ACS", "ephs").rsplit('/', 1)[0].format(
                 t0_isot=param_dict['t0_isot'],
             )
 
-            if param_dict['data_level'] == 'realtime':
-                url = url.replace("genlc/ACS", "rtlc") + "?json&prophecy"
+            negative_entry = None if self.negative_cache is None else self.negative_cache.get(param_dict)
+
+            if negative_entry is not None:
+                # fails again like the first time, without asking the backend
+                if negative_entry['kind'] == 'refused':
+                    raise SpiacsAnalysisException(negative_entry['message'])
+
+                return tuple(CachedRes(negative_entry[name]['text'].encode(), negative_entry[name]['status_code'])
+                             for name in ('res', 'res_ephs'))
+
+            res = self._read_shared_cache(param_dict)
 
-            logger.info("calling data server %s with %s", data_server_url, param_dict)
-            logger.info('calling GET on %s', url)
+            if res is not None:
+                return res
 
-            res = requests.get(url, params=param_dict)
-            res_ephs = requests.get(url_ephs)
+            res = self._read_archive(param_dict)
+            res_ephs = self._read_ephemeris_store(param_dict)
+
+            if res is None or res_ephs is None:
+                with self._admission_slot(param_dict):
+                    if res is None:
+                        logger.info("calling data server %s with %s", data_server_url, param_dict)
+                        logger.info('calling GET on %s', url)
+
+                        res = self._fetch_data(data_server_url, url, param_dict)
+
+                    if res_ephs is None:
+                        res_ephs = self._fetch_ephemeris(url_ephs, param_dict)
             
             if len(res.content) < 8000: # typical length to avoid searching in long strings, which can not be errors of this kind
                 if 'this service are limited' in res.text or 'Over revolution' in res.text:
-                    raise SpiacsAnalysisException(f"SPI-ACS backend refuses to process this request, due to resource constrain: {res.text}")
+                    message = f"SPI-ACS backend refuses to process this request, due to resource constrain: {res.text}"
+
+                    if self.negative_cache is not None:
+                        self.negative_cache.put(param_dict, 'refused', message=message)
+
+                    raise SpiacsAnalysisException(message)
+
+                if any(keyword in res.text for keyword in no_data_keywords):
+                    if self.negative_cache is not None:
+                        self.negative_cache.put(param_dict, 'no_data', res=res, res_ephs=res_ephs)
+
+                    return res, res_ephs
+
+            if self.shared_cache is not None and not isinstance(res, ArchivedRes):
+                self._write_shared_cache(param_dict, res, res_ephs)
 
             logger.debug('data server returned %s of len %s text: %s...', res, len(res.content), res.text[:500])
 
-        except ConnectionError as e:
+        except AdmissionRefused as e:
+
+            raise SpiacsBackendBusyException(str(e))
+
+        except (requests.exceptions.RequestException, BackendUnavailable) as e:
 
             raise SpiacsAnalysisException(
                 f'Spiacs Analysis error: {e}')
 
+        finally:
+            logger.info('backend fetch stats: %s, circuit breaker %s', dict(self.fetch_stats), circuit_breaker.state)
+
 
         return res, res_ephs
 
@@ -224,12 +410,27 @@ class SpiacsDispatcher:
             logger.info('*** run_asynch %s', run_asynch)
             logger.warning('param_dict %s', param_dict)
 
-            res = self._run(self.data_server_url, param_dict)
-            
+            with profiled_stage(self.instrument, 'run_query_%s' % param_dict['data_level']) as profile_stage:
+                if self.data_server_conf_dict.get('request_coalescing', True):
+                    res = single_flight.do(normalize_request_key(param_dict),
+                                           lambda: self._run(self.data_server_url, param_dict),
+                                           shared_dir=shared_cache_root(self.data_server_conf_dict),
+                                           shared_ttl_s=self.data_server_conf_dict.get('request_coalescing_ttl_s', 30),
+                                           encode=self._encode_coalesced)
+                    logger.info('request coalescing stats: %s', single_flight.stats())
+                else:
+                    res = self._run(self.data_server_url, param_dict)
+
+                if profile_stage is not None:
+                    profile_stage['result'] = res
+
             # DONE
             query_out.set_done(message=message, debug_message=str(
                 debug_message), job_status='done')
 
+            # only comment and warning of this query_out reach the user: the stats go with the products
+            self.instrument.spiacs_backend_fetch_stats = dict(self.fetch_stats)
+
             # job.set_done()
 
         except SpiacsAnalysisException as e:
@@ -0,0 +1,130 @@
+"""
+Overview
+--------
+
+synthetic light curves for dummy queries
+
+Dummy queries (query_type Dummy) load-test the dispatcher front end without a backend. Their
+light curves come from a parametric model of SPI-ACS counts at the instrument bin: a background
+with a slow orbital-like modulation, a burst with a fast rise and exponential decay in the middle
+of the window, and Poisson noise, drawn with a fixed seed. The model is written as a response of
+the requested data level (ordinary text or realtime JSON), parsed and rebinned like backend responses,
+so that products have the size and structure of real ones.
+
+The samples cover the requested window, up to dummy_max_samples in data_server_conf.yml. Parsed and
+rebinned light curves are kept in memory per (number of samples, data level, time_bin, binning mode),
+the dummy_max_memoized most recently built ones. Each is built once, by the first query asking for it:
+concurrent queries for the same one wait for it, as coalesced backend requests do, and queries for
+others are not held up.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import io
+import json
+import logging
+import threading
+
+import numpy as np
+
+from .spiacs_coalescing import SingleFlight
+from .spiacs_cost import instr_t_bin_s
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+dummy_t0_ijd = 8484.1
+
+dummy_ephs_text = "'166.134 81.107 109932.3 0.016 0.016 30.0'"
+
+_memo = collections.OrderedDict()
+_memo_lock = threading.Lock()
+_builds = SingleFlight()
+
+
+def synthetic_counts(n_samples, seed=0, background_rate=3000., modulation=0.05, modulation_period_s=3000.,
+                     burst_rate=6000., burst_rise_s=0.5, burst_decay_s=5.):
+    """
+    IJD and counts of n_samples instrument bins, with the burst peak in the middle
+    """
+
+    t = np.arange(n_samples) * instr_t_bin_s
+    t_peak = t[n_samples // 2]
+
+    rate = background_rate * (1 + modulation * np.sin(2 * np.pi * t / modulation_period_s))
+    rate += burst_rate * np.exp(-np.abs(t - t_peak) / np.where(t < t_peak, burst_rise_s, burst_decay_s))
+
+    counts = np.random.default_rng(seed).poisson(rate * instr_t_bin_s)
+
+    return dummy_t0_ijd + t / 86400., counts
+
+
+def synthetic_text(n_samples, data_level, seed=0):
+    """
+    the model as a backend response of this data level
+    """
+
+    time_ijd, counts = synthetic_counts(n_samples, seed=seed)
+
+    if data_level == 'realtime':
+        return json.dumps({'lc': {'columns': ['ijd', 'counts'],
+                                  'data': np.column_stack([time_ijd, counts]).tolist()},
+                           'prophecy': []})
+
+    # [IJD] [seconds since reference] [counts in bin] [seconds since midnight]
+    output = io.StringIO()
+    np.savetxt(output,
+               np.column_stack([time_ijd, np.arange(n_samples) * instr_t_bin_s, counts,
+                                (time_ijd % 1) * 86400.]),
+               fmt=['%.10f', '%.3f', '%d', '%.3f'])
+
+    return output.getvalue()
+
+
+def dummy_light_curve(n_samples, data_level, time_bin_s, time_bin_mode='fixed', bayesian_blocks_p0=0.05,
+                      max_memoized=8):
+    """
+    (data, comment, meta_data) as from SpicasLightCurve.parse_and_rebin, built once per arguments;
+    the data is read-only
+    """
+
+    from .spiacs_lightcurve_query import SpicasLightCurve
+
+    key = (n_samples, data_level, time_bin_s, time_bin_mode, bayesian_blocks_p0)
+
+    def lookup():
+        with _memo_lock:
+            if key in _memo:
+                _memo.move_to_end(key)
+                return _memo[key]
+
+    def build():
+        # built by another query between the lookup and this build
+        result = lookup()
+        if result is not None:
+            return result
+
+        data, comment = SpicasLightCurve.parse_text(synthetic_text(n_samples, data_level), data_level)
+        data, meta_data = SpicasLightCurve.reformat_and_rebin(data, time_bin_s, time_bin_mode=time_bin_mode,
+                                                              bayesian_blocks_p0=bayesian_blocks_p0)
+        data.setflags(write=False)
+
+        logger.info('built dummy light curve of %s samples, %s rows', n_samples, data.size)
+
+        with _memo_lock:
+            _memo[key] = data, comment, meta_data
+
+            while len(_memo) > max_memoized:
+                _memo.popitem(last=False)
+
+        return data, comment, meta_data
+
+    result = lookup()
+    if result is not None:
+        return result
+
+    # built outside of the lock, once for all concurrent queries of this key
+    return _builds.do(key, build)
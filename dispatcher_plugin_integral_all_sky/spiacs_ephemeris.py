@@ -0,0 +1,214 @@
+"""
+Overview
+--------
+
+store of INTEGRAL ephemeris answers
+
+Every query fetches the ephemeris at its t0_isot, one row of a few numbers which changes slowly
+along the orbit. The rows fetched are kept, by IJD day, in memory and, with ephemeris_cache_dir,
+on disk for all workers. A query is answered from the store when a row was fetched within
+ephemeris_max_distance_s of its t0. With ephemeris_interpolate, it is also answered by
+linear interpolation between rows on both sides, less than ephemeris_interpolation_max_gap_s apart.
+Only times not covered so are fetched.
+
+Rows are kept as the backend wrote them, and returned as they are when not interpolated.
+The ephemeris_memory_days most recently used days are kept in memory; a day file changed by another
+worker is read again. Writers of a day file take a lock on <ephemeris_cache_dir>/<ijd day>.lock
+for their read-merge-write.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import bisect
+import collections
+import fcntl
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+import numpy as np
+
+from .spiacs_shared_cache import CachedRes
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+# (cache_dir, day): (version of the day file, rows)
+_memory = collections.OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def parse_ephemeris(text):
+    """
+    the numbers of an ephemeris response, None if it is not one
+    """
+    try:
+        values = [float(v) for v in re.sub(r"[\'\" \n\r]+", " ", text).split()]
+    except ValueError:
+        return None
+
+    if len(values) == 0:
+        return None
+
+    return values
+
+
+class EphemerisStore(object):
+
+    def __init__(self, cache_dir=None, max_distance_s=60., interpolate=False, max_gap_s=3600., memory_days=64):
+        self.cache_dir = cache_dir
+        self.max_distance_s = max_distance_s
+        self.interpolate = interpolate
+        self.max_gap_s = max_gap_s
+        self.memory_days = memory_days
+
+    @classmethod
+    def from_conf_dict(cls, conf_dict):
+        if not conf_dict.get('ephemeris_cache', True):
+            return None
+
+        return cls(cache_dir=conf_dict.get('ephemeris_cache_dir') or None,
+                   max_distance_s=conf_dict.get('ephemeris_max_distance_s', 60.),
+                   interpolate=conf_dict.get('ephemeris_interpolate', False),
+                   max_gap_s=conf_dict.get('ephemeris_interpolation_max_gap_s', 3600.),
+                   memory_days=conf_dict.get('ephemeris_memory_days', 64))
+
+    def _day_fn(self, day):
+        return os.path.join(self.cache_dir, '%05d.json' % day)
+
+    def _lock_fn(self, day):
+        return os.path.join(self.cache_dir, '%05d.lock' % day)
+
+    def _file_version(self, day):
+        """
+        changes when the day file is replaced; None without a file
+        """
+        if self.cache_dir is None:
+            return None
+
+        try:
+            st = os.stat(self._day_fn(day))
+        except FileNotFoundError:
+            return None
+
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _remember_locked(self, day, version, rows):
+        _memory[(self.cache_dir, day)] = version, rows
+        _memory.move_to_end((self.cache_dir, day))
+
+        while len(_memory) > self.memory_days:
+            _memory.popitem(last=False)
+
+    def _remember(self, day, version, rows):
+        with _memory_lock:
+            self._remember_locked(day, version, rows)
+
+    def _day_rows(self, day):
+        """
+        sorted [t_ijd, text] rows of an IJD day
+        """
+
+        version = self._file_version(day)
+
+        with _memory_lock:
+            entry = _memory.get((self.cache_dir, day))
+
+            if entry is not None and (self.cache_dir is None or entry[0] == version):
+                _memory.move_to_end((self.cache_dir, day))
+                return entry[1]
+
+        if version is None:
+            return []
+
+        rows = sorted(self._read_day_file(day))
+
+        self._remember(day, version, rows)
+
+        return rows
+
+    def _neighbours(self, t_ijd):
+        """
+        the closest rows before and after t_ijd, from this day and the next ones
+        """
+
+        day = int(np.floor(t_ijd))
+
+        rows = self._day_rows(day - 1) + self._day_rows(day) + self._day_rows(day + 1)
+
+        i = bisect.bisect_left([row[0] for row in rows], t_ijd)
+
+        before = rows[i - 1] if i > 0 else None
+        after = rows[i] if i < len(rows) else None
+
+        return before, after
+
+    def get(self, t_ijd):
+        before, after = self._neighbours(t_ijd)
+
+        nearest = min([row for row in (before, after) if row is not None],
+                      key=lambda row: abs(row[0] - t_ijd), default=None)
+
+        if nearest is not None and abs(nearest[0] - t_ijd) * 86400. <= self.max_distance_s:
+            logger.info('ephemeris from the store, %.3g s away', (nearest[0] - t_ijd) * 86400.)
+            return CachedRes(nearest[1].encode())
+
+        if self.interpolate and before is not None and after is not None and \
+                (after[0] - before[0]) * 86400. <= self.max_gap_s:
+            values_before = np.array(parse_ephemeris(before[1]))
+            values_after = np.array(parse_ephemeris(after[1]))
+
+            if values_before.shape == values_after.shape:
+                w = (t_ijd - before[0]) / (after[0] - before[0])
+                values = values_before + w * (values_after - values_before)
+
+                logger.info('ephemeris interpolated between rows %.3g s apart', (after[0] - before[0]) * 86400.)
+
+                return CachedRes(("'%s'" % " ".join('%.10g' % v for v in values)).encode())
+
+        return None
+
+    def put(self, t_ijd, text):
+        if parse_ephemeris(text) is None:
+            logger.warning('not storing unexpected ephemeris response: %s', text[:200])
+            return
+
+        day = int(np.floor(t_ijd))
+        row = [t_ijd, text]
+
+        if self.cache_dir is None:
+            # merged under the lock, not to lose rows put by other threads
+            with _memory_lock:
+                rows = _memory.get((None, day), (None, []))[1]
+                self._remember_locked(day, None, rows if row in rows else sorted(rows + [row]))
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # merged under the lock of the day file, not to lose rows put by other threads and workers
+        with open(self._lock_fn(day), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                rows = self._read_day_file(day)
+                rows = rows if row in rows else sorted(rows + [row])
+
+                with tempfile.NamedTemporaryFile('w', dir=self.cache_dir, delete=False) as f:
+                    json.dump(rows, f)
+
+                os.replace(f.name, self._day_fn(day))
+
+                self._remember(day, self._file_version(day), rows)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_day_file(self, day):
+        try:
+            with open(self._day_fn(day)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
@@ -0,0 +1,304 @@
+"""
+Overview
+--------
+
+search for short excesses in SPI-ACS count rates, on a ladder of timescales
+
+Every timescale is scanned with a sliding window over the prefix sums of the counts,
+compared to a rolling background taken on both sides of the window, so the cost
+is O(N) per timescale and there is no loop over the samples.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import traceback
+
+import numpy as np
+
+from cdci_data_analysis.analysis.queries import ProductQuery
+from cdci_data_analysis.analysis.parameters import Float
+from cdci_data_analysis.analysis.products import LightCurveProduct, QueryOutput
+from oda_api.data_products import NumpyDataProduct, NumpyDataUnit
+
+from .spiacs_dataserver_dispatcher import SpiacsAnalysisException
+from .spiacs_lightcurve_query import SpicasLightCurve, SpiacsDataQueryMixin
+from .spiacs_profiling import profiled
+from .spiacs_time import integral_mjdref
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+
+excess_dtype = [('TIME', '<f8'),
+                ('TIMESCALE', '<f8'),
+                ('COUNTS', '<f8'),
+                ('BACKGROUND', '<f8'),
+                ('SIGNIFICANCE', '<f8')]
+
+
+def timescale_ladder(instr_t_bin, max_timescale):
+    """
+    timescales doubling from the instrument bin up to max_timescale
+    """
+    n_steps = int(np.floor(np.log2(max(max_timescale / instr_t_bin, 1.)) + 1e-9)) + 1
+    return instr_t_bin * 2 ** np.arange(n_steps)
+
+
+def excess_search(time_s, counts, instr_t_bin, timescales,
+                  min_significance=5.,
+                  bkg_factor=20,
+                  max_candidates=100):
+    """
+    for every timescale, the counts in a window of k bins are compared to the mean of two
+    background windows of bkg_factor*k bins, separated from it by k bins on each side.
+
+    windows overlapping with a gap in the data are skipped. Overlapping windows above threshold
+    are reduced to the most significant one.
+
+    returns a structured array (see excess_dtype) sorted by decreasing significance;
+    TIME is the start of the window, in the same units and reference as time_s
+    """
+
+    counts = np.asarray(counts, dtype=np.float64)
+    time_s = np.asarray(time_s, dtype=np.float64)
+
+    n = counts.size
+
+    cumulative = np.concatenate([[0.], np.cumsum(counts)])
+
+    # sample positions on the regular instrument grid: gaps are jumps in the tick index
+    ticks = np.rint((time_s - time_s[0]) / instr_t_bin).astype(np.int64)
+
+    candidates = []
+
+    for timescale in timescales:
+        k = int(round(timescale / instr_t_bin))
+        nb = bkg_factor * k
+
+        i = np.arange(nb + k, n - 2 * k - nb + 1)
+
+        if i.size == 0:
+            logger.info("timescale %s too long for %s samples, skipping", timescale, n)
+            continue
+
+        signal = cumulative[i + k] - cumulative[i]
+        bkg_left = cumulative[i - k] - cumulative[i - k - nb]
+        bkg_right = cumulative[i + 2 * k + nb] - cumulative[i + 2 * k]
+
+        expected = (bkg_left + bkg_right) / (2 * nb) * k
+        variance = expected * (1 + k / (2 * nb))
+
+        span = 2 * nb + 3 * k - 1
+        contiguous = (ticks[i + 2 * k + nb - 1] - ticks[i - k - nb]) == span
+
+        usable = contiguous & (variance > 0)
+
+        significance = np.zeros(i.size)
+        significance[usable] = (signal[usable] - expected[usable]) / np.sqrt(variance[usable])
+
+        above = np.flatnonzero(significance >= min_significance)
+
+        if above.size == 0:
+            continue
+
+        group = np.concatenate([[0], np.cumsum(np.diff(above) > k)])
+        order = np.lexsort((-significance[above], group))
+        first_in_group = np.concatenate([[True], group[order][1:] != group[order][:-1]])
+        best = above[order[first_in_group]]
+
+        found = np.zeros(best.size, dtype=excess_dtype)
+        found['TIME'] = time_s[i[best]]
+        found['TIMESCALE'] = k * instr_t_bin
+        found['COUNTS'] = signal[best]
+        found['BACKGROUND'] = expected[best]
+        found['SIGNIFICANCE'] = significance[best]
+
+        logger.info("timescale %s: %s candidates above %s sigma", timescale, found.size, min_significance)
+
+        candidates.append(found)
+
+    if len(candidates) == 0:
+        return np.zeros(0, dtype=excess_dtype)
+
+    candidates = np.concatenate(candidates)
+    candidates = candidates[np.argsort(-candidates['SIGNIFICANCE'], kind='stable')]
+
+    return candidates[:max_candidates]
+
+
+class SpiacsExcessTable(LightCurveProduct):
+
+    def __init__(self, name, file_name, data, prod_prefix=None, out_dir=None, src_name=None, meta_data=None):
+
+        if meta_data is None:
+            meta_data = {}
+
+        self.meta_data = {'product': 'spiacs_excess',
+                          'instrument': 'spiacs', 'src_name': src_name,
+                          **meta_data}
+
+        super().__init__(name=name,
+                         data=data,
+                         name_prefix=prod_prefix,
+                         file_dir=out_dir,
+                         file_name=file_name,
+                         meta_data=self.meta_data)
+
+    @classmethod
+    def build_from_res(cls,
+                       res,
+                       data_level,
+                       src_name='',
+                       prod_prefix='spiacs_excess',
+                       out_dir=None,
+                       min_significance=5.,
+                       max_timescale=10.):
+
+        (res, res_ephs) = res
+
+        if out_dir is None:
+            out_dir = './'
+
+        if prod_prefix is None:
+            prod_prefix = ''
+
+        file_name = src_name + '.fits'
+
+        SpicasLightCurve.check_res_has_data(res)
+
+        try:
+            data, comment = SpicasLightCurve.parse_res(res, data_level)
+
+            instr_t_bin = SpicasLightCurve.deduce_instr_t_bin(data)
+            t_ref = SpicasLightCurve.deduce_t_ref(data)
+
+            time_s = (data['TIME_IJD'] - t_ref) * 24 * 3600
+
+            timescales = timescale_ladder(instr_t_bin, max_timescale)
+
+            excess = excess_search(time_s, data['COUNTS'], instr_t_bin, timescales,
+                                   min_significance=min_significance)
+
+            header = {}
+            header['EXTNAME'] = 'EXCESS'
+            header['TIMESYS'] = 'TT'
+            header['TIMEREF'] = 'LOCAL'
+            header['TASSIGN'] = 'SATELLITE'
+            header['MJDREF'] = integral_mjdref
+            header['TIMEZERO'] = t_ref * 24 * 3600
+            header['TIMEUNIT'] = 's '
+            header['TELESCOP'] = 'INTEGRAL'
+            header['INSTRUME'] = 'SPI-ACS'
+            header['TIMEDEL'] = instr_t_bin
+            header['MINSIG'] = min_significance
+            header['MAXTSCAL'] = float(timescales[-1])
+            header['PROPHECY'] = comment
+            header['EPHS'] = SpicasLightCurve.strip_ephs_text(res_ephs)
+
+            units_dict = {}
+            units_dict['TIME'] = 's'
+            units_dict['TIMESCALE'] = 's'
+            units_dict['COUNTS'] = 'count'
+            units_dict['BACKGROUND'] = 'count'
+
+            meta_data = {'src_name': src_name,
+                         'time_bin': instr_t_bin,
+                         'n_candidates': int(excess.size)}
+
+            npd = NumpyDataProduct(data_unit=NumpyDataUnit(data=excess,
+                                                           name='EXCESS',
+                                                           data_header=header,
+                                                           hdu_type='bintable',
+                                                           units_dict=units_dict),
+                                   meta_data=meta_data)
+
+            table = cls(name=src_name, data=npd, file_name=file_name, out_dir=out_dir,
+                        prod_prefix=prod_prefix, src_name=src_name, meta_data=meta_data)
+
+        except Exception as e:
+            logger.info(traceback.format_exc())
+
+            raise SpiacsAnalysisException(
+                message='spiacs excess search failed: %s' % e.__repr__(), debug_message=str(e))
+
+        return [table]
+
+
+class SpiacsExcessQuery(SpiacsDataQueryMixin, ProductQuery):
+
+    def __init__(self, name):
+
+        excess_min_significance = Float(value=5., name='excess_min_significance')
+        excess_max_timescale = Float(value=10., name='excess_max_timescale')
+
+        super(SpiacsExcessQuery, self).__init__(name, parameters_list=[excess_min_significance,
+                                                                       excess_max_timescale])
+
+    @profiled('build_product_list')
+    def build_product_list(self, instrument, res, out_dir, prod_prefix='spiacs_excess', api=False):
+        data_level = instrument.get_par_by_name('data_level').value
+
+        return SpiacsExcessTable.build_from_res(
+            res,
+            data_level=data_level,
+            src_name='query',
+            prod_prefix=prod_prefix,
+            out_dir=out_dir,
+            min_significance=instrument.get_par_by_name('excess_min_significance').value,
+            max_timescale=instrument.get_par_by_name('excess_max_timescale').value)
+
+    @profiled('process_product_method')
+    def process_product_method(self, instrument, prod_list, api=False):
+
+        _names = []
+        _table_path = []
+        _html_fig = []
+
+        _data_list = []
+
+        message = ''
+
+        for query_excess in prod_list.prod_list:
+            query_excess.add_url_to_fits_file(
+                instrument._current_par_dic, url=instrument.disp_conf.products_url)
+            query_excess.write()
+
+            du = query_excess.data.get_data_unit_by_name('EXCESS')
+
+            if du.data.size == 0:
+                message = 'no excess found above %s sigma' % du.header['MINSIG']
+
+            if api == False:
+                _names.append(query_excess.name)
+                _table_path.append(str(query_excess.file_path.name))
+
+                if du.data.size > 0:
+                    _html_fig.append(query_excess.get_html_draw(x=du.data['TIME'],
+                                                                dx=du.data['TIMESCALE'] / 2.,
+                                                                y=du.data['SIGNIFICANCE'],
+                                                                title='Start Time: %s' % instrument.get_par_by_name(
+                                                                    'T1')._astropy_time.utc.value,
+                                                                x_label='Time  (s)',
+                                                                y_label='Significance  (sigma)'))
+            else:
+                _data_list.append(query_excess.data)
+
+        query_out = QueryOutput()
+
+        if api == True:
+            query_out.prod_dictionary['numpy_data_product_list'] = _data_list
+            query_out.prod_dictionary['binary_data_product_list'] = []
+        else:
+            query_out.prod_dictionary['name'] = _names
+            query_out.prod_dictionary['file_name'] = _table_path
+            query_out.prod_dictionary['image'] = _html_fig
+            query_out.prod_dictionary['download_file_name'] = 'excess.tar.gz'
+
+        query_out.prod_dictionary['prod_process_message'] = message
+
+        self.set_backend_fetch_stats(instrument, query_out)
+
+        return query_out
@@ -0,0 +1,250 @@
+"""
+Overview
+--------
+
+fetch policy for backend GET requests: timeouts, retries with jittered backoff,
+hedged requests and a circuit breaker
+
+All backend requests are idempotent GETs, so they can be retried and hedged safely.
+The policy is set in data_server_conf.yml, under fetch_policy.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import collections
+import logging
+import random
+import threading
+import time
+from concurrent import futures
+
+import numpy as np
+import requests
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+
+class BackendUnavailable(Exception):
+    pass
+
+
+class FetchPolicy(object):
+
+    defaults = dict(
+        connect_timeout_s=10.,
+        read_timeout_s=120.,
+        max_retries=2,
+        backoff_base_s=0.5,
+        backoff_max_s=10.,
+        hedge=False,
+        hedge_quantile=0.95,
+        hedge_min_delay_s=1.,
+        hedge_min_samples=20,
+        breaker_failures=5,
+        breaker_reset_s=60.,
+    )
+
+    def __init__(self, **kwargs):
+        unknown = set(kwargs) - set(self.defaults)
+        if len(unknown) > 0:
+            raise RuntimeError(f"unknown fetch_policy settings: {unknown}")
+
+        for k, v in {**self.defaults, **kwargs}.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def from_conf_dict(cls, conf_dict):
+        return cls(**{k: v for k, v in (conf_dict.get('fetch_policy') or {}).items() if v is not None})
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout_s, self.read_timeout_s)
+
+    def backoff_s(self, attempt):
+        # "full jitter": spreads the retries of many workers hitting the same failure
+        return random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * 2 ** attempt))
+
+
+class LatencyTracker(object):
+
+    def __init__(self, size=200):
+        self._lock = threading.Lock()
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=size))
+
+    def add(self, kind, latency_s):
+        with self._lock:
+            self._latencies[kind].append(latency_s)
+
+    def quantile(self, kind, q, min_samples):
+        with self._lock:
+            latencies = list(self._latencies[kind])
+
+        if len(latencies) < min_samples:
+            return None
+
+        return float(np.quantile(latencies, q))
+
+
+class CircuitBreaker(object):
+    """
+    opens after a number of consecutive failures and rejects requests for breaker_reset_s,
+    then lets a single probe through: its success closes the breaker again
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.probe_in_flight:
+            return 'half-open'
+        return 'open'
+
+    def allow(self, policy):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+
+            if time.time() - self.opened_at >= policy.breaker_reset_s and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+
+            return False
+
+    def release_probe(self):
+        """
+        the probe ended without telling whether the backend is back: the next request probes again
+        """
+        with self._lock:
+            self.probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.probe_in_flight = False
+
+    def record_failure(self, policy):
+        with self._lock:
+            self.consecutive_failures += 1
+
+            if self.probe_in_flight or self.consecutive_failures >= policy.breaker_failures:
+                if self.opened_at is None or self.probe_in_flight:
+                    logger.warning('backend circuit breaker opens after %s consecutive failures',
+                                   self.consecutive_failures)
+                self.opened_at = time.time()
+                self.probe_in_flight = False
+
+
+latency_tracker = LatencyTracker()
+circuit_breaker = CircuitBreaker()
+
+
+def _get(url, params, policy, kind, headers=None):
+    t0 = time.time()
+
+    res = requests.get(url, params=params, headers=headers, timeout=policy.timeout)
+
+    if res.status_code >= 500:
+        raise requests.exceptions.HTTPError(f'backend returned {res.status_code}', response=res)
+
+    latency_tracker.add(kind, time.time() - t0)
+
+    return res
+
+
+def _hedged_get(url, params, policy, kind, stats, headers=None):
+    hedge_delay_s = None
+    if policy.hedge:
+        hedge_delay_s = latency_tracker.quantile(kind, policy.hedge_quantile, policy.hedge_min_samples)
+
+    if hedge_delay_s is None:
+        return _get(url, params, policy, kind, headers)
+
+    hedge_delay_s = max(hedge_delay_s, policy.hedge_min_delay_s)
+
+    executor = futures.ThreadPoolExecutor(max_workers=2)
+
+    try:
+        requests_in_flight = [executor.submit(_get, url, params, policy, kind, headers)]
+
+        done, _ = futures.wait(requests_in_flight, timeout=hedge_delay_s)
+
+        if len(done) == 0:
+            logger.info('no response from %s after %.3g s, sending hedged request', url, hedge_delay_s)
+            stats['hedged'] += 1
+            requests_in_flight.append(executor.submit(_get, url, params, policy, kind, headers))
+
+        error = None
+        for completed in futures.as_completed(requests_in_flight):
+            try:
+                res = completed.result()
+            except requests.exceptions.RequestException as e:
+                error = e
+                continue
+
+            if completed is not requests_in_flight[0]:
+                stats['hedge_won'] += 1
+
+            return res
+
+        raise error
+
+    finally:
+        # the slower request is left to finish in background, bounded by the read timeout
+        executor.shutdown(wait=False)
+
+
+def fetch(url, params=None, policy=None, kind='default', stats=None, headers=None):
+    """
+    GET with the fetch policy; stats (a Counter) collects attempts, retries, hedges and latency
+    """
+
+    if policy is None:
+        policy = FetchPolicy()
+
+    if stats is None:
+        stats = collections.Counter()
+
+    t0 = time.time()
+
+    for attempt in range(policy.max_retries + 1):
+        if not circuit_breaker.allow(policy):
+            stats['rejected_by_breaker'] += 1
+            raise BackendUnavailable(
+                f'SPI-ACS backend is considered down after repeated failures, will retry in {policy.breaker_reset_s} s')
+
+        stats['attempts'] += 1
+
+        try:
+            res = _hedged_get(url, params, policy, kind, stats, headers)
+        except requests.exceptions.RequestException as e:
+            circuit_breaker.record_failure(policy)
+
+            if attempt == policy.max_retries:
+                raise
+
+            backoff_s = policy.backoff_s(attempt)
+            logger.warning('backend request %s failed (%s), retry %s/%s in %.3g s',
+                           url, e, attempt + 1, policy.max_retries, backoff_s)
+
+            stats['retries'] += 1
+            time.sleep(backoff_s)
+            continue
+        except BaseException:
+            circuit_breaker.release_probe()
+            raise
+
+        circuit_breaker.record_success()
+
+        stats['latency_s'] += time.time() - t0
+
+        return res
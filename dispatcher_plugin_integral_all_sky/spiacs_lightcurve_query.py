@@ -34,7 +34,7 @@ __author__ = "Andrea Tramacere"
 import os
 import io
 
-from cdci_data_analysis.analysis.parameters import Name
+from cdci_data_analysis.analysis.parameters import Name, Integer, Float
 
 # Dependencies
 # eg numpy
@@ -50,8 +50,6 @@ from cdci_data_analysis.analysis.parameters import Name
 # relative import eg: from .mod import f
 import numpy as np
 from astropy.table import Table
-from astropy import time
-from astropy import units as u
 
 from pathlib import Path
 
@@ -61,10 +59,21 @@ from cdci_data_analysis.analysis.queries import LightCurveQuery
 from cdci_data_analysis.analysis.products import LightCurveProduct, QueryProductList, QueryOutput
 from cdci_data_analysis.analysis.io_helper import FilePath
 from oda_api.data_products import NumpyDataProduct, NumpyDataUnit, BinaryData
-from cdci_data_analysis.configurer import DataServerConf
 
 from .spiacs_dataserver_dispatcher import SpiacsDispatcher
 from .spiacs_dataserver_dispatcher import SpiacsAnalysisException
+from .spiacs_archive import ArchivedRes
+from .spiacs_blocks import block_light_curve
+from .spiacs_cost import QueryCost, CostLimits, instr_t_bin_s
+from .spiacs_dummy import dummy_light_curve, dummy_ephs_text
+from .spiacs_negative_cache import no_data_keywords
+from .spiacs_offload import parse_and_rebin as parse_and_rebin_in_pool
+from .spiacs_product_cache import ProductCache, ProductCacheEntry, product_cache_key
+from .spiacs_profiling import profiled, profiling_role
+from .spiacs_raw import CompactCounts, deduce_instr_t_bin
+from .spiacs_rebin import rebin
+from .spiacs_shared_cache import CachedRes
+from .spiacs_time import integral_mjdref, utc_mjd_to_ijd, ijd_to_isot, ijd_to_tt_isot
 
 import traceback
 import logging
@@ -78,27 +87,28 @@ class DummySpiacsRes(object):
         pass
 
 
-integral_mjdref = 51544.0
+# column names of light curves, in product and data meta data
+lc_columns_meta_data = {'time': 'TIME', 'rate': 'RATE', 'rate_err': 'ERROR'}
+
 
 class SpicasLightCurve(LightCurveProduct):
-    def __init__(self, name, file_name, data, header, prod_prefix=None, out_dir=None, src_name=None, meta_data={}):
+    def __init__(self, name, file_name, data, header, prod_prefix=None, out_dir=None, src_name=None, meta_data=None):
 
-        if meta_data == {} or meta_data is None:
+        # a copy per instance: products are built concurrently, and meta_data may be shared with the data
+        if not meta_data:
             self.meta_data = {'product': 'spiacs_lc',
                               'instrument': 'spiacs', 'src_name': src_name}
         else:
-            self.meta_data = meta_data
+            self.meta_data = dict(meta_data)
 
-        self.meta_data['time'] = 'TIME'
-        self.meta_data['rate'] = 'RATE'
-        self.meta_data['rate_err'] = 'ERROR'
+        self.meta_data.update(lc_columns_meta_data)
 
         super().__init__(name=name,
                          data=data,
                          name_prefix=prod_prefix,
                          file_dir=out_dir,
                          file_name=file_name,
-                         meta_data=meta_data)
+                         meta_data=self.meta_data)
 
     @classmethod
     def build_from_res(cls,
@@ -107,7 +117,18 @@ class SpicasLightCurve(LightCurveProduct):
                        src_name='',
                        prod_prefix='spiacs_lc',
                        out_dir=None,
-                       delta_t=None):
+                       delta_t=None,
+                       process_pool_size=None,
+                       process_pool_min_bytes=1000000,
+                       rebin_threads=None,
+                       time_correction_s=0.,
+                       time_bin_mode='fixed',
+                       bayesian_blocks_p0=0.05,
+                       rebinned=None):
+        """
+        rebinned is (data, comment, meta_data) from parse_and_rebin, if that was done already;
+        the data response is then not used
+        """
 
         (res, res_ephs) = res
 
@@ -124,30 +145,32 @@ class SpicasLightCurve(LightCurveProduct):
         meta_data = {}
         meta_data['src_name'] = src_name
 
-        res_text_stripped = res.text.replace(r"\n", "\n").strip('" \n\\n')
-        res_ephs_text_stripped = re.sub(r"[\'\" \n\r]+", " ", res_ephs.text).strip('" \n\\n')
+        res_ephs_text_stripped = cls.strip_ephs_text(res_ephs)
 
-        for keyword in 'ZeroData', 'NoData':
-            if keyword in res_text_stripped:
-                raise SpiacsAnalysisException(
-                    message=f'no usable data found for this time interval: server reports {keyword} (status {res.status_code}). Raw response: {res.text}')
+        if rebinned is None:
+            cls.check_res_has_data(res)
 
         try:
-            # [IJD] [seconds since reference] [counts in bin] [seconds since midnight]
-
-            if data_level == 'ordinary':
-                data = cls.parse_ordinary_data(res_text_stripped)
-                comment = []
+            if rebinned is None:
+                data, comment, extra_meta_data = cls.parse_and_rebin(res, data_level, delta_t,
+                                                                     process_pool_size=process_pool_size,
+                                                                     process_pool_min_bytes=process_pool_min_bytes,
+                                                                     rebin_threads=rebin_threads,
+                                                                     time_bin_mode=time_bin_mode,
+                                                                     bayesian_blocks_p0=bayesian_blocks_p0)
             else:
-                data, comment = cls.parse_realtime_data(res_text_stripped)
-
-            data, extra_meta_data = cls.reformat_and_rebin(data, delta_t)
+                data, comment, extra_meta_data = rebinned
+                extra_meta_data = dict(extra_meta_data)
 
             t_start = extra_meta_data.pop('t_start')
             t_stop = extra_meta_data.pop('t_stop')
             t_ref =  extra_meta_data.pop('t_ref')
 
+            # all times are relative to t_ref: shifting it corrects them all
+            t_ref += time_correction_s / 86400.
+
             meta_data.update(extra_meta_data)
+            meta_data.update(lc_columns_meta_data)
 
             logger.info("data mean: %s error mean %s", np.mean(data['RATE']), np.mean(data['ERROR']))
             
@@ -159,31 +182,32 @@ class SpicasLightCurve(LightCurveProduct):
             header['ONTIME'] = t_stop - t_start
             header['TASSIGN'] = 'SATELLITE'
 
-            Integral_jd = (t_ref.mjd-integral_mjdref)*u.day
-            header['TSTART'] = Integral_jd.to('s').value + t_start
-            header['TSTOP'] = Integral_jd.to('s').value + t_stop
+            # t_ref is in IJD
+            header['TSTART'] = t_ref * 86400. + t_start
+            header['TSTOP'] = t_ref * 86400. + t_stop
 
-            t1 = time.Time(t_start / 86400. + t_ref.value,
-                           scale='tt', format='mjd')
-            t2 = time.Time(t_start / 86400. + t_ref.value,
-                           scale='tt', format='mjd')
-
-            # TODO add comment  "Start time (UTC) of the light curve" now fits writer is failing
-            header['DATE-OBS'] = '%s' % t1.isot
-            # TODO add comment  "Start time (UTC) of the light curve" now fits writer is failing
-            header['DATE-END'] = '%s' % t2.isot
+            # TODO add comment  "Start time (TT) of the light curve" now fits writer is failing
+            header['DATE-OBS'] = ijd_to_tt_isot(t_ref + t_start / 86400.)
+            # TODO add comment  "Stop time (TT) of the light curve" now fits writer is failing
+            header['DATE-END'] = ijd_to_tt_isot(t_ref + t_stop / 86400.)
 
             header['TIMEDEL'] = meta_data['time_bin']
 
+            if 'TIMEDEL' in data.dtype.names:
+                # variable bins, TIME at their middle; TIMEDEL above is the resolution
+                header['TIMEPIXR'] = 0.5
+
             header['MJDREF'] = integral_mjdref
 
             header['TELESCOP'] = 'INTEGRAL'
             header['INSTRUME'] = 'SPI-ACS'
-            #print ((t_ref.value*u.d).to('s'))
-            header['TIMEZERO'] = (
-                t_ref.value*u.d-integral_mjdref*u.d).to('s').value
+            header['TIMEZERO'] = t_ref * 86400.
             header['TIMEUNIT'] = 's '
 
+            if time_correction_s != 0:
+                header['CLOCKAPP'] = True
+                header['TIMECORR'] = time_correction_s
+
             header['PROPHECY'] = comment
             header['EPHS'] = res_ephs_text_stripped
             units_dict = {}
@@ -192,6 +216,9 @@ class SpicasLightCurve(LightCurveProduct):
             units_dict['ERROR'] = 'count/s'
             units_dict['TIME'] = 's'
 
+            if 'TIMEDEL' in data.dtype.names:
+                units_dict['TIMEDEL'] = 's'
+
             logger.info("data std: %s", np.std(data['RATE']/data['ERROR']))
 
             npd = NumpyDataProduct(data_unit=NumpyDataUnit(data=data,
@@ -217,6 +244,130 @@ class SpicasLightCurve(LightCurveProduct):
         return lc_list
 
 
+    @classmethod
+    def from_product_cache_entry(cls, entry, part, src_name='', prod_prefix='spiacs_lc', out_dir=None):
+        """
+        part is 'api', 'frontend', or None if only the FITS file is needed (paged api queries).
+        The FITS file and the part are taken from the entry now: it may be evicted before the products are
+        processed. Raises OSError or ValueError if it already is
+        """
+        lc = cls(name=src_name, data=None, header=None, file_name=src_name + '.fits', out_dir=out_dir,
+                 prod_prefix=prod_prefix, src_name=src_name)
+
+        entry.copy_fits_to(lc.file_path.path)
+
+        if part is None:
+            lc.product_cache_part = None
+        elif entry.has(part):
+            # served as stored, the data is not needed
+            lc.product_cache_part = entry.load(part)
+        else:
+            lc.product_cache_part = None
+            lc.data = NumpyDataProduct.from_fits_file(lc.file_path.path, meta_data={'src_name': src_name})
+
+        lc.product_cache_entry = entry
+
+        return lc
+
+    @classmethod
+    def read_page(cls, fits_path, page, page_rows, meta_data=None):
+        """
+        reads only the rows of one page of a written light curve, returns a NumpyDataProduct
+        with the row range in meta_data['rows']
+        """
+
+        with pf.open(fits_path, memmap=True) as hdul:
+            hdu = hdul['RATE']
+
+            n_rows = hdu.header['NAXIS2']
+            n_pages = max(int(np.ceil(n_rows / page_rows)), 1)
+
+            if page < 0 or page >= n_pages:
+                raise SpiacsAnalysisException(
+                    message=f'light curve page {page} does not exist: the light curve has {n_rows} rows, '
+                            f'in {n_pages} pages of {page_rows} rows, numbered from 0')
+
+            row_start = page * page_rows
+            row_stop = min(row_start + page_rows, n_rows)
+
+            data = hdu.data[row_start:row_stop].view(np.ndarray).astype(hdu.data.dtype.newbyteorder('='))
+
+            header = {k: v for k, v in hdu.header.items()
+                      if not re.match(r'(XTENSION|BITPIX|NAXIS|PCOUNT|GCOUNT|TFIELDS|TTYPE|TFORM|TUNIT)', k)}
+            units_dict = {c.name: c.unit for c in hdu.columns if c.unit}
+
+        meta_data = dict(meta_data or {})
+        meta_data['rows'] = dict(page=page, n_pages=n_pages, page_rows=page_rows,
+                                 row_start=row_start, row_stop=row_stop, n_rows=n_rows)
+
+        return NumpyDataProduct(data_unit=NumpyDataUnit(data=data,
+                                                        name='RATE',
+                                                        data_header=header,
+                                                        hdu_type='bintable',
+                                                        units_dict=units_dict),
+                                meta_data=meta_data)
+
+    @classmethod
+    def strip_res_text(cls, res):
+        return res.text.replace(r"\n", "\n").strip('" \n\\n')
+
+    @classmethod
+    def strip_ephs_text(cls, res_ephs):
+        return re.sub(r"[\'\" \n\r]+", " ", res_ephs.text).strip('" \n\\n')
+
+    @classmethod
+    def check_res_has_data(cls, res):
+        res_text_stripped = cls.strip_res_text(res)
+
+        for keyword in no_data_keywords:
+            if keyword in res_text_stripped:
+                raise SpiacsAnalysisException(
+                    message=f'no usable data found for this time interval: server reports {keyword} (status {res.status_code}). Raw response: {res.text}')
+
+    @classmethod
+    def parse_res(cls, res, data_level):
+        if isinstance(res, ArchivedRes):
+            return res.data, []
+
+        return cls.parse_text(cls.strip_res_text(res), data_level)
+
+    @classmethod
+    def parse_text(cls, res_text_stripped, data_level):
+        # [IJD] [seconds since reference] [counts in bin] [seconds since midnight]
+        if data_level == 'ordinary':
+            data = cls.parse_ordinary_data(res_text_stripped)
+            comment = []
+        else:
+            data, comment = cls.parse_realtime_data(res_text_stripped)
+
+        return data, comment
+
+    @classmethod
+    def parse_and_rebin(cls, res, data_level, delta_t, process_pool_size=None, process_pool_min_bytes=1000000,
+                        rebin_threads=None, time_bin_mode='fixed', bayesian_blocks_p0=0.05):
+        if isinstance(res, ArchivedRes):
+            size = res.data.nbytes
+        else:
+            size = len(res.text)
+
+        if process_pool_size and size >= process_pool_min_bytes:
+            logger.info('parsing and rebinning %s bytes in process pool', size)
+
+            if isinstance(res, ArchivedRes):
+                return parse_and_rebin_in_pool(res.data, data_level, delta_t, process_pool_size,
+                                               rebin_threads=rebin_threads, time_bin_mode=time_bin_mode,
+                                               bayesian_blocks_p0=bayesian_blocks_p0)
+            else:
+                return parse_and_rebin_in_pool(cls.strip_res_text(res), data_level, delta_t, process_pool_size,
+                                               rebin_threads=rebin_threads, time_bin_mode=time_bin_mode,
+                                               bayesian_blocks_p0=bayesian_blocks_p0)
+
+        data, comment = cls.parse_res(res, data_level)
+        data, meta_data = cls.reformat_and_rebin(data, delta_t, rebin_threads=rebin_threads,
+                                                 time_bin_mode=time_bin_mode, bayesian_blocks_p0=bayesian_blocks_p0)
+
+        return data, comment, meta_data
+
     @classmethod
     def parse_ordinary_data(cls, res_text_stripped):
         data = np.genfromtxt(
@@ -227,7 +378,7 @@ class SpicasLightCurve(LightCurveProduct):
 
         assert len(data['TIME_IJD']) > 100
 
-        return data
+        return CompactCounts.from_raw(data)
                 
 
     @classmethod
@@ -237,46 +388,69 @@ class SpicasLightCurve(LightCurveProduct):
         cn = jdata['lc']['columns']
         cd  = np.array(jdata['lc']['data'])
 
-        data = np.zeros(cd.shape[0], dtype=[('TIME_IJD', '<f8'), ('COUNTS', '<f8')])
+        # the tracked deviation from the accurate time is applied in build_from_res, see spiacs_alignment
+        time_ijd = np.asarray(cd[:, cn.index('ijd')], dtype='<f8')
+        logger.debug('realtime data from IJD %s to %s, %s rows', time_ijd[:1], time_ijd[-1:], time_ijd.size)
 
-        # TODO: add tracked deviation from the accurate time from the past
-        data['TIME_IJD'] = cd[:, cn.index('ijd')] 
-        print("\033[32mdata['TIME_IJD']", data['TIME_IJD'], "\033[0m")
-        data['COUNTS'] = cd[:, cn.index('counts')]
+        assert len(time_ijd) > 100
+
+        data = CompactCounts.from_arrays(time_ijd, np.asarray(cd[:, cn.index('counts')], dtype='<f8'))
 
-        assert len(data['TIME_IJD']) > 100            
-        
         return data, jdata['prophecy']
 
 
     @classmethod
-    def reformat_and_rebin(cls, data, delta_t):
-        meta_data = {}
+    def deduce_instr_t_bin(cls, data):
+        if isinstance(data, CompactCounts):
+            return data.instr_t_bin
+
+        return deduce_instr_t_bin(data['TIME_IJD'])
 
-        dt_s = (data['TIME_IJD'][1:] - data['TIME_IJD'][:-1]) * 24 * 3600
+    @classmethod
+    def deduce_t_ref(cls, data):
+        if isinstance(data, CompactCounts):
+            t_first, t_last = data.time_ijd([0, -1])
+        else:
+            t_first, t_last = data['TIME_IJD'][0], data['TIME_IJD'][-1]
+
+        # in IJD
+        return (t_first + t_last) / 2
 
-        unique_dt_s, unique_dt_s_counts = np.unique(
-            np.round(dt_s, 3), return_counts=True)
-        i = np.argmax(unique_dt_s_counts)
-        instr_t_bin = unique_dt_s[i]
+    @classmethod
+    def reformat_and_rebin(cls, data, delta_t, rebin_threads=None, time_bin_mode='fixed', bayesian_blocks_p0=0.05):
+        """
+        with time_bin_mode 'bayesian_blocks', delta_t is the finest bin of the blocks, see spiacs_blocks
+        """
+        meta_data = {}
 
+        instr_t_bin = cls.deduce_instr_t_bin(data)
 
-        logging.info("deduced instr_t_bin: %s, fraction %s",
-                        instr_t_bin, unique_dt_s_counts[i]/len(dt_s))
+        t_ref = cls.deduce_t_ref(data)
 
-        t_ref = time.Time(
-            (data['TIME_IJD'][0] + data['TIME_IJD'][-1]) / 2 + integral_mjdref,
-            format='mjd')
+        counts = np.asarray(data['COUNTS'], dtype=float)
 
+        # float64 columns are made only here, from the compact raw data
         # IJD offset from MJD, https://heasarc.gsfc.nasa.gov/W3Browse/integral/intscw.html
-        data = np.array(list(zip((data['TIME_IJD'] - t_ref.mjd + integral_mjdref) * 24 * 3600,
-                                    data['COUNTS'] / instr_t_bin,
-                                    data['COUNTS'] ** 0.5 / instr_t_bin
-                                    )),
-                        dtype=[('TIME', float),
-                                ('RATE', float),
-                                ('ERROR', float)]
-                        )
+        time_s = (data['TIME_IJD'] - t_ref) * 24 * 3600
+
+        if time_bin_mode == 'bayesian_blocks':
+            data, meta_data['time_bin'] = block_light_curve(time_s, counts, instr_t_bin, cell_s=delta_t,
+                                                            p0=bayesian_blocks_p0)
+
+            meta_data['t_start'] = time_s[0]
+            meta_data['t_stop'] = time_s[-1] + instr_t_bin
+            meta_data['t_ref'] = t_ref
+
+            return data, meta_data
+
+        data = np.zeros(time_s.size, dtype=[('TIME', float),
+                                            ('RATE', float),
+                                            ('ERROR', float)])
+        data['TIME'] = time_s
+        data['RATE'] = counts / instr_t_bin
+        data['ERROR'] = counts ** 0.5 / instr_t_bin
+
+        del time_s, counts
 
         logger.info("\033[31m got raw time column: %s\033[0m", data['TIME'])
         logger.info("\033[31m got raw rate column: %s\033[0m", data['RATE'])
@@ -299,19 +473,15 @@ class SpicasLightCurve(LightCurveProduct):
             t1 = data['TIME'][0]
             t2 = data['TIME'][-1] + instr_t_bin
 
-            digitized_ids = np.digitize(
-                data['TIME'], np.arange(t1, t2, delta_t))
+            time_mean, rate_mean, n_samples = rebin(data['TIME'], data['RATE'], np.arange(t1, t2, delta_t),
+                                                    threads=rebin_threads)
 
-            binned_data = np.zeros(np.unique(digitized_ids).size, dtype=[
+            binned_data = np.zeros(n_samples.size, dtype=[
                                     ('TIME', '<f8'), ('RATE', '<f8'), ('ERROR', '<f8')])
-            _t_frac = np.zeros(binned_data.size)
-            for ID, binned_id in enumerate(np.unique(digitized_ids)):
-
-                msk = digitized_ids == binned_id
-                _t_frac[ID] = msk.sum()*instr_t_bin
-                binned_data['RATE'][ID] = np.mean(data['RATE'][msk])
-                binned_data['TIME'][ID] = np.mean(data['TIME'][msk])
-                binned_data['ERROR'][ID] = np.sqrt(binned_data['RATE'][ID]*_t_frac[ID])/_t_frac[ID]
+            _t_frac = n_samples * instr_t_bin
+            binned_data['RATE'] = rate_mean
+            binned_data['TIME'] = time_mean
+            binned_data['ERROR'] = np.sqrt(binned_data['RATE'] * _t_frac) / _t_frac
             
             logger.info('binned data RATE %s', binned_data['RATE'])
             logger.info('binned data RATE_ERROR %s', binned_data['ERROR'])
@@ -333,46 +503,30 @@ class SpicasLightCurve(LightCurveProduct):
 
 
 
-class SpiacsLightCurveQuery(LightCurveQuery):
-
-    def __init__(self, name):
-
-        data_level = Name(name_format='str', name='data_level', value="ordinary")
-        data_level._allowed_values = ["ordinary", "realtime"]
-
-        super(SpiacsLightCurveQuery, self).__init__(name, parameters_list=[data_level])
-
-    def build_product_list(self, instrument, res, out_dir, prod_prefix='spiacs_lc', api=False):
-        src_name = 'query'
-
-        T1 = instrument.get_par_by_name('T1')._astropy_time
-        T2 = instrument.get_par_by_name('T2')._astropy_time
-        
-        delta_t = instrument.get_par_by_name('time_bin')._astropy_time_delta.sec
-        data_level = instrument.get_par_by_name('data_level').value
-
-        prod_list = SpicasLightCurve.build_from_res(res,
-                                                    data_level=data_level,
-                                                    src_name=src_name,
-                                                    prod_prefix=prod_prefix,
-                                                    out_dir=out_dir,
-                                                    delta_t=delta_t)
-        return prod_list
+class SpiacsDataQueryMixin(object):
+    """
+    backend query construction and role checks shared by all SPI-ACS product queries,
+    each of them fetching the same (t0_isot, dt_s, data_level) window from the data server
+    """
 
     def get_data_server_query(self, instrument,
                               config=None):
 
-        T1 = instrument.get_par_by_name('T1')._astropy_time
-        T2 = instrument.get_par_by_name('T2')._astropy_time
+        T1_ijd = utc_mjd_to_ijd(instrument.get_par_by_name('T1')._astropy_time.utc.mjd)
+        T2_ijd = utc_mjd_to_ijd(instrument.get_par_by_name('T2')._astropy_time.utc.mjd)
 
         data_level = instrument.get_par_by_name('data_level').value
 
-        delta_t = T2 - T1
-        delta_t_s = delta_t.sec * 0.5
-        T_ref = time.Time((T2.mjd + T1.mjd) * 0.5, format='mjd').isot
+        delta_t_s = (T2_ijd - T1_ijd) * 86400. * 0.5
+        T_ref = ijd_to_isot((T2_ijd + T1_ijd) * 0.5)
 
         param_dict = self.set_instr_dictionaries(T_ref, delta_t_s, data_level)
 
+        instrument.spiacs_backend_fetch_stats = None
+
+        # before anything is fetched
+        self.get_cost_route(instrument)
+
         q = SpiacsDispatcher(instrument=instrument,
                              config=config,
                              param_dict=param_dict)
@@ -386,6 +540,205 @@ class SpiacsLightCurveQuery(LightCurveQuery):
             data_level=data_level
         )
 
+    def get_output_time_bin_s(self, instrument):
+        """
+        the bin of the light curve returned by the query, None if there is none
+        """
+        return None
+
+    def set_backend_fetch_stats(self, instrument, query_out):
+        """
+        adds the attempts, retries, hedges and breaker rejections of the backend requests of this query
+        to the status of the products, if the backend was asked
+        """
+        fetch_stats = getattr(instrument, 'spiacs_backend_fetch_stats', None)
+
+        if fetch_stats is not None:
+            query_out.set_status_field('backend_fetch_stats', json.dumps(fetch_stats))
+
+    def is_paged(self, instrument, api=None):
+        """
+        whether the output is served in pages; api is None before fetching, when it is not known yet
+        """
+        return False
+
+    def get_query_cost(self, instrument):
+        T1_ijd = utc_mjd_to_ijd(instrument.get_par_by_name('T1')._astropy_time.utc.mjd)
+        T2_ijd = utc_mjd_to_ijd(instrument.get_par_by_name('T2')._astropy_time.utc.mjd)
+
+        return QueryCost.estimate((T2_ijd - T1_ijd) * 86400.,
+                                  instrument.get_par_by_name('data_level').value,
+                                  time_bin_s=self.get_output_time_bin_s(instrument))
+
+    def get_cost_route(self, instrument, api=None):
+        """
+        'inline' or 'process_pool', raises QueryCostExceeded if the query is too large
+        """
+        # also checks the time interval, with or without limits
+        cost = self.get_query_cost(instrument)
+
+        cost_limits = CostLimits.from_conf_dict(instrument.data_server_conf_dict)
+
+        if cost_limits is None:
+            return 'inline'
+
+        route = cost_limits.route(cost, paged=self.is_paged(instrument, api=api))
+
+        logger.info('estimated query cost %s, route %s', cost.as_dict(), route)
+
+        return route
+
+    def check_query_roles(self, provided_roles: List[str], par_dic: dict):
+        needed_roles = []
+        needed_roles_with_comments = {}
+
+        data_class = par_dic.get('data_level')
+
+        if data_class == 'realtime':
+            needed_roles.append('integral-realtime')
+            needed_roles_with_comments['integral-realtime'] = "access to real time data requires special role"
+
+        if par_dic.get('spiacs_profile') == 'yes':
+            needed_roles.append(profiling_role)
+            needed_roles_with_comments[profiling_role] = "profiling queries requires special role"
+
+        if all([needed_role in provided_roles for needed_role in needed_roles]):
+            return dict(authorization=True, needed_roles=[])
+        else:
+            return dict(authorization=False, needed_roles=needed_roles,
+                        needed_roles_with_comments=needed_roles_with_comments)
+
+
+class SpiacsLightCurveQuery(SpiacsDataQueryMixin, LightCurveQuery):
+
+    def __init__(self, name):
+        # api only: 0 returns the whole light curve, otherwise page lc_page of lc_page_rows rows
+        lc_page_rows = Integer(value=0, name='lc_page_rows')
+        lc_page = Integer(value=0, name='lc_page')
+
+        # bayesian_blocks: variable bins, time_bin is the finest of them, see spiacs_blocks
+        time_bin_mode = Name(name_format='str', name='time_bin_mode', value='fixed')
+        time_bin_mode._allowed_values = ['fixed', 'bayesian_blocks']
+        bayesian_blocks_p0 = Float(value=0.05, name='bayesian_blocks_p0')
+
+        # data_level is an instrument parameter, see spiacs.common_instr_query
+        super(SpiacsLightCurveQuery, self).__init__(name, parameters_list=[lc_page_rows, lc_page, time_bin_mode,
+                                                                           bayesian_blocks_p0])
+
+    def get_page_rows(self, instrument, api):
+        if not api:
+            return 0
+
+        return instrument.get_par_by_name('lc_page_rows').value or 0
+
+    def is_paged(self, instrument, api=None):
+        if api is None:
+            # api is not known before fetching: the output size is checked again in build_product_list
+            return (instrument.get_par_by_name('lc_page_rows').value or 0) > 0
+
+        # the frontend ignores lc_page_rows
+        return self.get_page_rows(instrument, api) > 0
+
+    def get_output_time_bin_s(self, instrument):
+        return instrument.get_par_by_name('time_bin')._astropy_time_delta.sec
+
+    def get_product_part(self, instrument, api):
+        """
+        the part of a cached product served to this query, None if it is served in pages from the FITS file
+        """
+        if self.get_page_rows(instrument, api) > 0:
+            return None
+
+        return 'api' if api else 'frontend'
+
+    def get_product_cache_key(self, instrument):
+        return product_cache_key(instrument.get_par_by_name('T1')._astropy_time.utc.mjd,
+                                 instrument.get_par_by_name('T2')._astropy_time.utc.mjd,
+                                 instrument.get_par_by_name('time_bin')._astropy_time_delta.sec,
+                                 instrument.get_par_by_name('data_level').value,
+                                 time_bin_mode=instrument.get_par_by_name('time_bin_mode').value,
+                                 bayesian_blocks_p0=instrument.get_par_by_name('bayesian_blocks_p0').value)
+
+    def get_data_server_query(self, instrument,
+                              config=None):
+
+        product_cache = ProductCache.from_conf_dict(instrument.data_server_conf_dict)
+
+        instrument.spiacs_backend_fetch_stats = None
+
+        if product_cache is not None:
+            entry = product_cache.get(self.get_product_cache_key(instrument))
+
+            if entry is not None:
+                # no backend request, build_product_list gets the entry
+                return entry
+
+        return super(SpiacsLightCurveQuery, self).get_data_server_query(instrument, config=config)
+
+    @profiled('build_product_list')
+    def build_product_list(self, instrument, res, out_dir, prod_prefix='spiacs_lc', api=False):
+        src_name = 'query'
+
+        # with api known: lc_page_rows does not spare frontend queries the output size limit
+        cost_route = self.get_cost_route(instrument, api=api)
+
+        if isinstance(res, ProductCacheEntry):
+            try:
+                return [SpicasLightCurve.from_product_cache_entry(res,
+                                                                  part=self.get_product_part(instrument, api),
+                                                                  src_name=src_name,
+                                                                  prod_prefix=prod_prefix,
+                                                                  out_dir=out_dir)]
+            except (OSError, ValueError) as e:
+                # evicted or expired by another query since it was found
+                logger.warning('product cache entry went away, building from the backend: %s', e)
+
+                res, _ = super(SpiacsLightCurveQuery, self).get_data_server_query(instrument).run_query(
+                    logger=logger)
+
+        delta_t = instrument.get_par_by_name('time_bin')._astropy_time_delta.sec
+        data_level = instrument.get_par_by_name('data_level').value
+
+        process_pool_size = instrument.data_server_conf_dict.get('process_pool_size')
+        process_pool_min_bytes = instrument.data_server_conf_dict.get('process_pool_min_bytes', 1000000)
+
+        if cost_route == 'process_pool':
+            # keeps the parsing peak out of the dispatcher worker
+            process_pool_size = process_pool_size or 1
+            process_pool_min_bytes = 0
+
+        prod_list = SpicasLightCurve.build_from_res(res,
+                                                    data_level=data_level,
+                                                    src_name=src_name,
+                                                    prod_prefix=prod_prefix,
+                                                    out_dir=out_dir,
+                                                    delta_t=delta_t,
+                                                    process_pool_size=process_pool_size,
+                                                    process_pool_min_bytes=process_pool_min_bytes,
+                                                    rebin_threads=instrument.data_server_conf_dict.get(
+                                                        'rebin_threads'),
+                                                    time_correction_s=self.get_time_correction_s(instrument),
+                                                    time_bin_mode=instrument.get_par_by_name('time_bin_mode').value,
+                                                    bayesian_blocks_p0=instrument.get_par_by_name(
+                                                        'bayesian_blocks_p0').value)
+        return prod_list
+
+    def get_time_correction_s(self, instrument):
+        from .spiacs_alignment import RealtimeTimeCorrection
+
+        if instrument.get_par_by_name('data_level').value != 'realtime':
+            return 0.
+
+        time_correction = RealtimeTimeCorrection.from_conf_dict(instrument.data_server_conf_dict)
+
+        if time_correction is None:
+            return 0.
+
+        return time_correction.correction_s(
+            (utc_mjd_to_ijd(instrument.get_par_by_name('T1')._astropy_time.utc.mjd) +
+             utc_mjd_to_ijd(instrument.get_par_by_name('T2')._astropy_time.utc.mjd)) / 2.)
+
+    @profiled('process_product_method')
     def process_product_method(self, instrument, prod_list, api=False):
 
         _names = []
@@ -395,29 +748,71 @@ class SpiacsLightCurveQuery(LightCurveQuery):
 
         _data_list = []
         _binary_data_list = []
+
+        message = ''
+
+        product_cache = ProductCache.from_conf_dict(instrument.data_server_conf_dict)
+
+        part = self.get_product_part(instrument, api)
+        page_rows = self.get_page_rows(instrument, api)
+
         for query_lc in prod_list.prod_list:
-            # TODO: why is _current_par_dic only used here? Does base dispatcher need to support this?
-            query_lc.add_url_to_fits_file(
-                instrument._current_par_dic, url=instrument.disp_conf.products_url)
-            query_lc.write()
-            if api == False:
-                _names.append(query_lc.name)
-                _lc_path.append(str(query_lc.file_path.name))
-                # x_label='MJD-%d  (days)' % mjdref,y_label='Rate  (cts/s)'
-                du = query_lc.data.get_data_unit_by_name('RATE')
-                dx = np.zeros(du.data['TIME'].shape) + du.header['TIMEDEL'] / 2.
-                _html_fig.append(query_lc.get_html_draw(x=du.data['TIME'],
-                                                        dx=dx,
-                                                        y=du.data['RATE'],
-                                                        dy=du.data['ERROR'],
-                                                        title='Start Time: %s' % instrument.get_par_by_name(
-                                                            'T1')._astropy_time.utc.value,
-                                                        x_label='Time  (s)',
-                                                        y_label='Rate  (cts/s)'))
-
-            if api == True:
-                _data_list.append(query_lc.data)
+            cache_entry = getattr(query_lc, 'product_cache_entry', None)
+
+            if cache_entry is not None and (part is None or query_lc.product_cache_part is not None):
+                # the FITS file is already in place
+                if part == 'frontend':
+                    _names.append(query_lc.name)
+                    _lc_path.append(str(query_lc.file_path.name))
+                    _html_fig.append(query_lc.product_cache_part)
+                elif part == 'api':
+                    _data_list.append(query_lc.product_cache_part)
 
+            else:
+                # TODO: why is _current_par_dic only used here? Does base dispatcher need to support this?
+                query_lc.add_url_to_fits_file(
+                    instrument._current_par_dic, url=instrument.disp_conf.products_url)
+                query_lc.write()
+                if api == False:
+                    _names.append(query_lc.name)
+                    _lc_path.append(str(query_lc.file_path.name))
+                    # x_label='MJD-%d  (days)' % mjdref,y_label='Rate  (cts/s)'
+                    du = query_lc.data.get_data_unit_by_name('RATE')
+                    if 'TIMEDEL' in du.data.dtype.names:
+                        dx = du.data['TIMEDEL'] / 2.
+                    else:
+                        dx = np.zeros(du.data['TIME'].shape) + du.header['TIMEDEL'] / 2.
+                    _html_fig.append(query_lc.get_html_draw(x=du.data['TIME'],
+                                                            dx=dx,
+                                                            y=du.data['RATE'],
+                                                            dy=du.data['ERROR'],
+                                                            title='Start Time: %s' % instrument.get_par_by_name(
+                                                                'T1')._astropy_time.utc.value,
+                                                            x_label='Time  (s)',
+                                                            y_label='Rate  (cts/s)'))
+
+                if part == 'api':
+                    _data_list.append(query_lc.data)
+
+                if product_cache is not None:
+                    product_cache.put(self.get_product_cache_key(instrument),
+                                      data_level=instrument.get_par_by_name('data_level').value,
+                                      fits_path=query_lc.file_path.path,
+                                      api_product=query_lc.data.encode() if part == 'api' else None,
+                                      figure=_html_fig[-1] if part == 'frontend' else None,
+                                      t2_ijd=utc_mjd_to_ijd(instrument.get_par_by_name('T2')._astropy_time.utc.mjd))
+
+            if page_rows > 0:
+                # the full table is in the FITS file, only the requested rows are read back
+                page = SpicasLightCurve.read_page(query_lc.file_path.path,
+                                                  instrument.get_par_by_name('lc_page').value or 0,
+                                                  page_rows,
+                                                  meta_data=query_lc.meta_data)
+                _data_list.append(page)
+
+                rows = page.meta_data['rows']
+                message = 'light curve rows %s to %s of %s, page %s of %s' % (
+                    rows['row_start'], rows['row_stop'], rows['n_rows'], rows['page'] + 1, rows['n_pages'])
 
         query_out = QueryOutput()
 
@@ -431,56 +826,43 @@ class SpiacsLightCurveQuery(LightCurveQuery):
             query_out.prod_dictionary['image'] = _html_fig
             query_out.prod_dictionary['download_file_name'] = 'light_curves.tar.gz'
 
-        query_out.prod_dictionary['prod_process_message'] = ''
+        query_out.prod_dictionary['prod_process_message'] = message
+
+        self.set_backend_fetch_stats(instrument, query_out)
 
         return query_out
 
     def get_dummy_products(self, instrument, config, out_dir='./', prod_prefix='spiacs', api=False):
-        config = DataServerConf.from_conf_dict(
-            instrument.data_server_conf_dict)
-
-        meta_data = {'product': 'light_curve',
-                     'instrument': 'isgri', 'src_name': ''}
-
-        meta_data['query_parameters'] = self.get_parameters_list_as_json()
-        data_level = instrument.get_par_by_name('data_level').value
-
-        dummy_cache = config.dummy_cache
-
-        res = (DummySpiacsRes(), DummySpiacsRes())
-        with open('%s/query_spiacs_lc.txt' % dummy_cache, 'r') as file:
-            text = str(file.read())
-
-        res[0].__setattr__('text', text)
-        res[1].__setattr__('text', text)
-
-        res[0].__setattr__('status_code', 200)
-        res[1].__setattr__('status_code', 200)
-
-        prod_list = SpicasLightCurve.build_from_res(res,
-                                                    data_level=data_level,
+        """
+        a synthetic light curve covering the requested window, see spiacs_dummy
+        """
+        conf_dict = instrument.data_server_conf_dict
+
+        T1_ijd = utc_mjd_to_ijd(instrument.get_par_by_name('T1')._astropy_time.utc.mjd)
+        T2_ijd = utc_mjd_to_ijd(instrument.get_par_by_name('T2')._astropy_time.utc.mjd)
+
+        # enough samples to parse, not more than a real query could return
+        n_samples = int(np.clip(round((T2_ijd - T1_ijd) * 86400. / instr_t_bin_s), 1000,
+                                conf_dict.get('dummy_max_samples', 2000000)))
+
+        data, comment, meta_data = dummy_light_curve(
+            n_samples,
+            instrument.get_par_by_name('data_level').value,
+            instrument.get_par_by_name('time_bin')._astropy_time_delta.sec,
+            time_bin_mode=instrument.get_par_by_name('time_bin_mode').value,
+            bayesian_blocks_p0=instrument.get_par_by_name('bayesian_blocks_p0').value,
+            max_memoized=conf_dict.get('dummy_max_memoized', 8))
+
+        # the synthetic times are relative: they are put in the requested window
+        meta_data = dict(meta_data, t_ref=(T1_ijd + T2_ijd) / 2.)
+
+        prod_list = SpicasLightCurve.build_from_res((None, CachedRes(dummy_ephs_text.encode())),
+                                                    data_level=instrument.get_par_by_name('data_level').value,
                                                     src_name='lc',
                                                     prod_prefix=prod_prefix,
-                                                    out_dir=out_dir)
+                                                    out_dir=out_dir,
+                                                    rebinned=(data, comment, meta_data))
 
         prod_list = QueryProductList(prod_list=prod_list)
         #
         return prod_list
-
-
-    def check_query_roles(self, provided_roles: List[str], par_dic: dict):
-        needed_roles = []
-        needed_roles_with_comments = {}
-
-        data_class = par_dic.get('data_level')
-
-        if data_class == 'realtime':
-            needed_roles.append('integral-realtime')
-            needed_roles_with_comments['integral-realtime'] = "access to real time data requires special role"
-
-        if all([needed_role in provided_roles for needed_role in needed_roles]):
-            return dict(authorization=True, needed_roles=[])
-        else:
-            return dict(authorization=False, needed_roles=needed_roles,
-                        needed_roles_with_comments=needed_roles_with_comments)
-
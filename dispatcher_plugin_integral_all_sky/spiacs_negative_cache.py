@@ -0,0 +1,137 @@
+"""
+Overview
+--------
+
+cache of failed backend requests
+
+Windows without data (the backend answers ZeroData or NoData) and windows the backend refuses
+to process ("this service are limited", "Over revolution") are remembered, keyed like request
+coalescing on the normalized (t0_isot, dt_s, data_level). Retrying them then fails in the
+same way, without a backend request: refusals are raised again, and the small no-data
+responses are returned again, to fail in build_from_res like the original.
+
+Ordinary data which is not there negative_cache_settled_after_s after the window will not appear:
+such windows are remembered for negative_cache_no_data_ttl_s. Recent windows, at either level, may
+still be filled, and are remembered only for negative_cache_recent_no_data_ttl_s. The product and
+shared caches apply the same rule (is_settled) to the data they keep. Refusals depend on
+the backend load, and are remembered for negative_cache_refused_ttl_s.
+
+Entries are small JSON files in negative_cache_dir, shared by all workers.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+from .spiacs_coalescing import normalize_request_key, request_key_digest
+from .spiacs_time import isot_to_ijd, utc_mjd_to_ijd
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+no_data_keywords = ('ZeroData', 'NoData')
+
+
+def is_settled(data_level, t2_ijd, settled_after_s=3 * 86400., now_s=None):
+    """
+    whether the data of a window ending at t2_ijd was final at now_s (unix time, default now):
+    only ordinary data is, settled_after_s after the window
+    """
+
+    if data_level != 'ordinary' or t2_ijd is None:
+        return False
+
+    now_ijd = utc_mjd_to_ijd((time.time() if now_s is None else now_s) / 86400. + 40587.)
+
+    return (now_ijd - t2_ijd) * 86400. > settled_after_s
+
+
+class NegativeCache(object):
+
+    def __init__(self, cache_dir, no_data_ttl_s=86400., recent_no_data_ttl_s=60., refused_ttl_s=300.,
+                 settled_after_s=3 * 86400.):
+        self.cache_dir = cache_dir
+        self.no_data_ttl_s = no_data_ttl_s
+        self.recent_no_data_ttl_s = recent_no_data_ttl_s
+        self.refused_ttl_s = refused_ttl_s
+        self.settled_after_s = settled_after_s
+
+    @classmethod
+    def from_conf_dict(cls, conf_dict):
+        if not conf_dict.get('negative_cache_dir'):
+            return None
+
+        return cls(conf_dict['negative_cache_dir'],
+                   no_data_ttl_s=conf_dict.get('negative_cache_no_data_ttl_s', 86400.),
+                   recent_no_data_ttl_s=conf_dict.get('negative_cache_recent_no_data_ttl_s', 60.),
+                   refused_ttl_s=conf_dict.get('negative_cache_refused_ttl_s', 300.),
+                   settled_after_s=conf_dict.get('negative_cache_settled_after_s', 3 * 86400.))
+
+    def entry_path(self, param_dict):
+        return os.path.join(self.cache_dir, request_key_digest(normalize_request_key(param_dict)) + '.json')
+
+    def ttl_s(self, entry):
+        if entry['kind'] == 'refused':
+            return self.refused_ttl_s
+
+        if is_settled(entry['data_level'], entry['t2_ijd'], self.settled_after_s, now_s=entry['created']):
+            return self.no_data_ttl_s
+
+        return self.recent_no_data_ttl_s
+
+    def get(self, param_dict):
+        """
+        the remembered entry of this window, or None
+        """
+
+        fn = self.entry_path(param_dict)
+
+        try:
+            with open(fn) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry['created'] > self.ttl_s(entry):
+            logger.info('negative cache entry for %s expired', normalize_request_key(param_dict))
+
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+
+            return None
+
+        logger.info('negative cache hit for %s: %s', normalize_request_key(param_dict), entry['kind'])
+
+        return entry
+
+    def put(self, param_dict, kind, message='', res=None, res_ephs=None):
+        """
+        kind is 'no_data', with the backend responses, or 'refused', with the message
+        """
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        entry = dict(kind=kind,
+                     created=time.time(),
+                     data_level=param_dict['data_level'],
+                     t2_ijd=isot_to_ijd(param_dict['t0_isot']) + float(param_dict['dt_s']) / 86400.,
+                     message=message)
+
+        if res is not None:
+            entry['res'] = dict(text=res.text, status_code=res.status_code)
+            entry['res_ephs'] = dict(text=res_ephs.text, status_code=res_ephs.status_code)
+
+        with tempfile.NamedTemporaryFile('w', dir=self.cache_dir, delete=False) as f:
+            json.dump(entry, f)
+
+        os.replace(f.name, self.entry_path(param_dict))
+
+        logger.info('remembering %s for %s', kind, normalize_request_key(param_dict))
@@ -0,0 +1,93 @@
+"""
+Overview
+--------
+
+optional process pool for the CPU-bound parsing and rebinning of large responses
+
+Parsing and rebinning hold the GIL, so one large query in the request thread stalls every
+other request of the dispatcher worker. When process_pool_size is set in data_server_conf.yml,
+responses larger than process_pool_min_bytes are handled in a pool of processes instead.
+Response text and result arrays go through multiprocessing.shared_memory rather than pickles;
+archived data is already compact (see spiacs_raw) and is sent as it is.
+
+Small responses stay in-process: starting the work elsewhere would cost more than it saves.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .spiacs_pools import get_pool
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+
+def array_to_shm(array):
+    array = np.ascontiguousarray(array)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+
+    descr = dict(name=shm.name, dtype=array.dtype.descr, shape=array.shape)
+    shm.close()
+
+    return descr
+
+
+def array_from_shm(descr, unlink=False):
+    shm = shared_memory.SharedMemory(name=descr['name'])
+
+    try:
+        return np.ndarray(descr['shape'], dtype=np.dtype(descr['dtype']), buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
+def _parse_and_rebin_worker(input_descr, data, data_level, delta_t, rebin_threads, time_bin_mode, bayesian_blocks_p0):
+    from .spiacs_lightcurve_query import SpicasLightCurve
+
+    if data is None:
+        data, comment = SpicasLightCurve.parse_text(array_from_shm(input_descr).tobytes().decode(), data_level)
+    else:
+        comment = []
+
+    data, meta_data = SpicasLightCurve.reformat_and_rebin(data, delta_t, rebin_threads=rebin_threads,
+                                                          time_bin_mode=time_bin_mode,
+                                                          bayesian_blocks_p0=bayesian_blocks_p0)
+
+    return array_to_shm(data), comment, meta_data
+
+
+def parse_and_rebin(text_or_data, data_level, delta_t, pool_size, rebin_threads=None, time_bin_mode='fixed',
+                    bayesian_blocks_p0=0.05):
+    """
+    parses (if given text) and rebins in the process pool, returns the same as the in-process path
+    """
+
+    if not isinstance(text_or_data, str):
+        output_descr, comment, meta_data = get_pool(pool_size, processes=True).submit(
+            _parse_and_rebin_worker, None, text_or_data, data_level, delta_t, rebin_threads,
+            time_bin_mode, bayesian_blocks_p0).result()
+
+        return array_from_shm(output_descr, unlink=True), comment, meta_data
+
+    input_descr = array_to_shm(np.frombuffer(text_or_data.encode(), dtype=np.uint8))
+
+    try:
+        output_descr, comment, meta_data = get_pool(pool_size, processes=True).submit(
+            _parse_and_rebin_worker, input_descr, None, data_level, delta_t, rebin_threads,
+            time_bin_mode, bayesian_blocks_p0).result()
+    finally:
+        input_shm = shared_memory.SharedMemory(name=input_descr['name'])
+        input_shm.close()
+        input_shm.unlink()
+
+    return array_from_shm(output_descr, unlink=True), comment, meta_data
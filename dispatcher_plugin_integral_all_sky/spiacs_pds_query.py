@@ -0,0 +1,260 @@
+"""
+Overview
+--------
+
+averaged power density spectrum of SPI-ACS counts
+
+The counts are binned to pds_time_bin and cut into consecutive segments of pds_segment_s;
+segments with a gap are dropped. The periodograms of all segments come from a single rfft
+over the (segments, bins) array, are Leahy normalized (2 |a_j|^2 / N_photons, 2 for Poisson noise)
+and averaged. Only the frequency and power table is returned, a few thousand rows at most
+instead of the fine-binned light curve.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import traceback
+
+import numpy as np
+
+from cdci_data_analysis.analysis.queries import ProductQuery
+from cdci_data_analysis.analysis.parameters import Float
+from cdci_data_analysis.analysis.products import LightCurveProduct, QueryOutput
+from oda_api.data_products import NumpyDataProduct, NumpyDataUnit
+
+from .spiacs_dataserver_dispatcher import SpiacsAnalysisException
+from .spiacs_lightcurve_query import SpicasLightCurve, SpiacsDataQueryMixin
+from .spiacs_profiling import profiled
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+
+pds_dtype = [('FREQ', '<f8'),
+             ('POWER', '<f8'),
+             ('ERROR', '<f8')]
+
+
+def averaged_leahy_pds(time_s, counts, instr_t_bin, segment_s, time_bin_s=None):
+    """
+    returns the pds (see pds_dtype, without the zero frequency), the number of segments averaged,
+    and the bin actually used, a multiple of instr_t_bin
+    """
+
+    counts = np.asarray(counts, dtype=np.float64)
+    time_s = np.asarray(time_s, dtype=np.float64)
+
+    factor = max(int(round((time_bin_s or instr_t_bin) / instr_t_bin)), 1)
+    time_bin_s = factor * instr_t_bin
+
+    n_segment_bins = int(round(segment_s / time_bin_s))
+    if n_segment_bins < 2:
+        raise SpiacsAnalysisException(
+            message='pds_segment_s %s should be at least two time bins of %s s' % (segment_s, time_bin_s))
+
+    # bins on the regular instrument grid: a bin is complete when all its samples are there
+    bins = np.rint((time_s - time_s[0]) / instr_t_bin).astype(np.int64) // factor
+
+    binned = np.bincount(bins, weights=counts)
+    complete = np.bincount(bins) == factor
+
+    n_segments = binned.size // n_segment_bins
+    if n_segments == 0:
+        raise SpiacsAnalysisException(
+            message='the requested time interval is shorter than one pds segment of %s s' % segment_s)
+
+    segments = binned[:n_segments * n_segment_bins].reshape(n_segments, n_segment_bins)
+    usable = complete[:n_segments * n_segment_bins].reshape(n_segments, n_segment_bins).all(axis=1)
+
+    segments = segments[usable]
+    n_photons = segments.sum(axis=1)
+    segments = segments[n_photons > 0]
+    n_photons = n_photons[n_photons > 0]
+
+    if segments.shape[0] == 0:
+        raise SpiacsAnalysisException(
+            message='no pds segment of %s s without gaps in the requested time interval' % segment_s)
+
+    power = 2 * np.abs(np.fft.rfft(segments, axis=1)[:, 1:]) ** 2 / n_photons[:, None]
+
+    pds = np.zeros(power.shape[1], dtype=pds_dtype)
+    pds['FREQ'] = np.fft.rfftfreq(n_segment_bins, d=time_bin_s)[1:]
+    pds['POWER'] = power.mean(axis=0)
+    pds['ERROR'] = pds['POWER'] / np.sqrt(segments.shape[0])
+
+    logger.info('averaged %s of %s pds segments of %s bins of %s s', segments.shape[0], n_segments,
+                n_segment_bins, time_bin_s)
+
+    return pds, segments.shape[0], time_bin_s
+
+
+class SpiacsPowerSpectrum(LightCurveProduct):
+
+    def __init__(self, name, file_name, data, prod_prefix=None, out_dir=None, src_name=None, meta_data=None):
+
+        if meta_data is None:
+            meta_data = {}
+
+        self.meta_data = {'product': 'spiacs_pds',
+                          'instrument': 'spiacs', 'src_name': src_name,
+                          **meta_data}
+
+        super().__init__(name=name,
+                         data=data,
+                         name_prefix=prod_prefix,
+                         file_dir=out_dir,
+                         file_name=file_name,
+                         meta_data=self.meta_data)
+
+    @classmethod
+    def build_from_res(cls,
+                       res,
+                       data_level,
+                       src_name='',
+                       prod_prefix='spiacs_pds',
+                       out_dir=None,
+                       segment_s=16.,
+                       time_bin_s=None):
+
+        (res, res_ephs) = res
+
+        if out_dir is None:
+            out_dir = './'
+
+        if prod_prefix is None:
+            prod_prefix = ''
+
+        file_name = src_name + '.fits'
+
+        SpicasLightCurve.check_res_has_data(res)
+
+        try:
+            data, comment = SpicasLightCurve.parse_res(res, data_level)
+
+            instr_t_bin = SpicasLightCurve.deduce_instr_t_bin(data)
+            t_ref = SpicasLightCurve.deduce_t_ref(data)
+
+            time_s = (data['TIME_IJD'] - t_ref) * 24 * 3600
+
+            pds, n_segments, time_bin_s = averaged_leahy_pds(time_s, data['COUNTS'], instr_t_bin, segment_s,
+                                                             time_bin_s=time_bin_s)
+
+            header = {}
+            header['EXTNAME'] = 'PDS'
+            header['TELESCOP'] = 'INTEGRAL'
+            header['INSTRUME'] = 'SPI-ACS'
+            header['TIMEDEL'] = time_bin_s
+            header['SEGLEN'] = segment_s
+            header['NSEGMENT'] = n_segments
+            header['PDSNORM'] = 'Leahy'
+            header['PROPHECY'] = comment
+            header['EPHS'] = SpicasLightCurve.strip_ephs_text(res_ephs)
+
+            units_dict = {}
+            units_dict['FREQ'] = 'Hz'
+
+            meta_data = {'src_name': src_name,
+                         'time_bin': time_bin_s,
+                         'segment_s': segment_s,
+                         'n_segments': n_segments}
+
+            npd = NumpyDataProduct(data_unit=NumpyDataUnit(data=pds,
+                                                           name='PDS',
+                                                           data_header=header,
+                                                           hdu_type='bintable',
+                                                           units_dict=units_dict),
+                                   meta_data=meta_data)
+
+            table = cls(name=src_name, data=npd, file_name=file_name, out_dir=out_dir,
+                        prod_prefix=prod_prefix, src_name=src_name, meta_data=meta_data)
+
+        except SpiacsAnalysisException:
+            raise
+
+        except Exception as e:
+            logger.info(traceback.format_exc())
+
+            raise SpiacsAnalysisException(
+                message='spiacs power density spectrum failed: %s' % e.__repr__(), debug_message=str(e))
+
+        return [table]
+
+
+class SpiacsPowerSpectrumQuery(SpiacsDataQueryMixin, ProductQuery):
+
+    def __init__(self, name):
+
+        pds_segment_s = Float(value=16., name='pds_segment_s')
+        pds_time_bin = Float(value=0.05, name='pds_time_bin')
+
+        super(SpiacsPowerSpectrumQuery, self).__init__(name, parameters_list=[pds_segment_s, pds_time_bin])
+
+    @profiled('build_product_list')
+    def build_product_list(self, instrument, res, out_dir, prod_prefix='spiacs_pds', api=False):
+        data_level = instrument.get_par_by_name('data_level').value
+
+        return SpiacsPowerSpectrum.build_from_res(
+            res,
+            data_level=data_level,
+            src_name='query',
+            prod_prefix=prod_prefix,
+            out_dir=out_dir,
+            segment_s=instrument.get_par_by_name('pds_segment_s').value,
+            time_bin_s=instrument.get_par_by_name('pds_time_bin').value)
+
+    @profiled('process_product_method')
+    def process_product_method(self, instrument, prod_list, api=False):
+
+        _names = []
+        _table_path = []
+        _html_fig = []
+
+        _data_list = []
+
+        message = ''
+
+        for query_pds in prod_list.prod_list:
+            query_pds.add_url_to_fits_file(
+                instrument._current_par_dic, url=instrument.disp_conf.products_url)
+            query_pds.write()
+
+            du = query_pds.data.get_data_unit_by_name('PDS')
+
+            message = 'Leahy normalized power, averaged over %s segments of %s s' % (du.header['NSEGMENT'],
+                                                                                   du.header['SEGLEN'])
+
+            if api == False:
+                _names.append(query_pds.name)
+                _table_path.append(str(query_pds.file_path.name))
+
+                df = du.data['FREQ'][0]
+                _html_fig.append(query_pds.get_html_draw(x=du.data['FREQ'],
+                                                         dx=np.zeros(du.data.size) + df / 2.,
+                                                         y=du.data['POWER'],
+                                                         dy=du.data['ERROR'],
+                                                         title='Start Time: %s' % instrument.get_par_by_name(
+                                                             'T1')._astropy_time.utc.value,
+                                                         x_label='Frequency  (Hz)',
+                                                         y_label='Leahy power'))
+            else:
+                _data_list.append(query_pds.data)
+
+        query_out = QueryOutput()
+
+        if api == True:
+            query_out.prod_dictionary['numpy_data_product_list'] = _data_list
+            query_out.prod_dictionary['binary_data_product_list'] = []
+        else:
+            query_out.prod_dictionary['name'] = _names
+            query_out.prod_dictionary['file_name'] = _table_path
+            query_out.prod_dictionary['image'] = _html_fig
+            query_out.prod_dictionary['download_file_name'] = 'pds.tar.gz'
+
+        query_out.prod_dictionary['prod_process_message'] = message
+
+        self.set_backend_fetch_stats(instrument, query_out)
+
+        return query_out
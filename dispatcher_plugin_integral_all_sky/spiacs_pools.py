@@ -0,0 +1,56 @@
+"""
+Overview
+--------
+
+worker pools shared by the queries of a dispatcher worker
+
+Pools are started when first asked for, one per kind and size, and kept: other threads may be using
+a pool when another size is asked for. They are shut down when the interpreter exits.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import atexit
+import logging
+import multiprocessing
+import threading
+from concurrent import futures
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(size, processes=False, thread_name_prefix='spiacs'):
+    """
+    a pool of size processes, or of size threads named with thread_name_prefix
+    """
+
+    key = ('processes', size) if processes else ('threads', size, thread_name_prefix)
+
+    with _pools_lock:
+        if key not in _pools:
+            logger.info('starting pool of %s %s', size, key[0])
+
+            if processes:
+                # forking a threaded server is unsafe
+                _pools[key] = futures.ProcessPoolExecutor(max_workers=size,
+                                                          mp_context=multiprocessing.get_context('spawn'))
+            else:
+                _pools[key] = futures.ThreadPoolExecutor(max_workers=size, thread_name_prefix=thread_name_prefix)
+
+        return _pools[key]
+
+
+@atexit.register
+def shutdown_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+
+    for pool in pools:
+        pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,328 @@
+"""
+Overview
+--------
+
+background prefetching of SPI-ACS data around incoming triggers
+
+Once a GRB or GW trigger is announced, analysts ask for SPI-ACS data around it within minutes.
+For every trigger time, the prefetcher fetches the windows of prefetch_windows_s around it,
+at every level of prefetch_data_levels, and builds the light curves at prefetch_time_bins_s into
+the product cache, for both the frontend and the api. Ordinary data also goes to the local archive,
+when it is configured, if the window is settled (see is_settled in spiacs_negative_cache) and has data:
+the ordinary data of recent triggers is usually not processed yet, and the archive is never refreshed.
+The first user query then finds warm data.
+
+Prefetching has low priority: backend requests leave admission headroom to user queries
+(see spiacs_admission), and the prefetching thread or process is niced.
+
+Trigger times, UTC isot or IJD, one per line (anything after the time is ignored), are read from:
+
+* a directory (prefetch_trigger_dir): one file per trigger, removed once read; files are claimed
+  by renaming, so that several dispatcher workers can watch the same directory
+* a file (prefetch_trigger_file), followed as it grows
+* a queue.Queue, for use within a process
+
+With prefetch_trigger_dir or prefetch_trigger_file in data_server_conf.yml, each dispatcher worker
+starts a prefetching thread. It can also run as a separate process::
+
+    python -m dispatcher_plugin_integral_all_sky.spiacs_prefetch --trigger-dir DIR
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+import types
+
+from .spiacs_negative_cache import is_settled
+from .spiacs_time import isot_to_mjd, mjd_to_isot, ijd_to_isot, isot_to_ijd
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+_started = set()
+_started_lock = threading.Lock()
+
+
+def parse_trigger(line):
+    """
+    returns the UTC isot of a trigger line, or None for empty lines and comments
+    """
+    fields = line.split('#', 1)[0].split()
+
+    if len(fields) == 0:
+        return None
+
+    try:
+        return ijd_to_isot(float(fields[0]))
+    except ValueError:
+        # validates the format
+        mjd_to_isot(isot_to_mjd(fields[0]))
+        return fields[0]
+
+
+def directory_triggers(trigger_dir, poll_s=5., stop=None):
+    claimed_dir = os.path.join(trigger_dir, 'claimed')
+    os.makedirs(claimed_dir, exist_ok=True)
+
+    while stop is None or not stop.is_set():
+        for entry in sorted(os.scandir(trigger_dir), key=lambda e: e.name):
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+
+            claimed_fn = os.path.join(claimed_dir, entry.name)
+
+            try:
+                # atomic: only one worker gets the file
+                os.rename(entry.path, claimed_fn)
+            except FileNotFoundError:
+                continue
+
+            with open(claimed_fn) as f:
+                lines = f.readlines()
+
+            os.remove(claimed_fn)
+
+            for line in lines:
+                yield line
+
+        time.sleep(poll_s)
+
+
+def file_triggers(trigger_file, poll_s=5., stop=None, from_start=False):
+    position = None
+
+    while stop is None or not stop.is_set():
+        try:
+            with open(trigger_file) as f:
+                if position is None:
+                    position = 0 if from_start else f.seek(0, os.SEEK_END)
+
+                if os.fstat(f.fileno()).st_size < position:
+                    logger.info('trigger file %s was truncated, reading from start', trigger_file)
+                    position = 0
+
+                f.seek(position)
+
+                while True:
+                    line = f.readline()
+
+                    # only complete lines
+                    if not line.endswith('\n'):
+                        break
+
+                    position = f.tell()
+                    yield line
+
+        except FileNotFoundError:
+            pass
+
+        time.sleep(poll_s)
+
+
+def queue_triggers(trigger_queue):
+    """
+    reads until None is put in the queue
+    """
+    while True:
+        line = trigger_queue.get()
+
+        if line is None:
+            return
+
+        yield line
+
+
+class SpiacsPrefetcher(object):
+
+    def __init__(self, windows_s=(100., 1000.), time_bins_s=(0.05, 1.), data_levels=('ordinary', 'realtime')):
+        self.windows_s = windows_s
+        self.time_bins_s = time_bins_s
+        self.data_levels = data_levels
+
+    @classmethod
+    def from_conf_dict(cls, conf_dict):
+        return cls(windows_s=conf_dict.get('prefetch_windows_s') or (100., 1000.),
+                   time_bins_s=conf_dict.get('prefetch_time_bins_s') or (0.05, 1.),
+                   data_levels=conf_dict.get('prefetch_data_levels') or ('ordinary', 'realtime'))
+
+    def prefetch(self, trigger_isot):
+        t0 = time.time()
+
+        for window_s in self.windows_s:
+            T1 = mjd_to_isot(isot_to_mjd(trigger_isot) - window_s / 86400.)
+            T2 = mjd_to_isot(isot_to_mjd(trigger_isot) + window_s / 86400.)
+
+            for data_level in self.data_levels:
+                try:
+                    self.prefetch_window(T1, T2, data_level)
+                except Exception as e:
+                    logger.warning('prefetching %s - %s %s failed: %s', T1, T2, data_level, e)
+
+        logger.info('prefetched around %s in %.3g s', trigger_isot, time.time() - t0)
+
+    def prefetch_window(self, T1, T2, data_level):
+        from .spiacs import spiacs_factory
+        from .spiacs_archive import SpiacsArchive, ArchivedRes
+        from .spiacs_dataserver_dispatcher import SpiacsAnalysisException
+        from .spiacs_lightcurve_query import SpicasLightCurve, SpiacsDataQueryMixin
+        from .spiacs_product_cache import ProductCache
+        from cdci_data_analysis.analysis.products import QueryProductList
+
+        instrument = spiacs_factory()
+        conf_dict = instrument.data_server_conf_dict
+
+        instrument.set_par('T1', T1)
+        instrument.set_par('T2', T2)
+        instrument.set_par('data_level', data_level)
+
+        query = instrument.get_query_by_name('spi_acs_lc_query')
+
+        product_cache = ProductCache.from_conf_dict(conf_dict)
+
+        def cached(time_bin_s):
+            instrument.set_par('time_bin', time_bin_s)
+            return product_cache is not None and product_cache.get(query.get_product_cache_key(instrument)) is not None
+
+        time_bins_s = [time_bin_s for time_bin_s in self.time_bins_s if not cached(time_bin_s)]
+
+        if len(time_bins_s) == 0:
+            logger.info('%s - %s %s already prefetched', T1, T2, data_level)
+            return
+
+        # the same backend query as a user would make, without looking at the product cache
+        data_server_query = SpiacsDataQueryMixin.get_data_server_query(query, instrument)
+        data_server_query.low_priority = True
+
+        res, _ = data_server_query.run_query(logger=logger)
+
+        if (data_level == 'ordinary' and conf_dict.get('archive_dir') and
+                not isinstance(res[0], ArchivedRes)):
+            param_dict = data_server_query.param_dict
+            t1_ijd = isot_to_ijd(param_dict['t0_isot']) - param_dict['dt_s'] / 86400.
+            t2_ijd = isot_to_ijd(param_dict['t0_isot']) + param_dict['dt_s'] / 86400.
+
+            if not is_settled('ordinary', t2_ijd, conf_dict.get('negative_cache_settled_after_s', 3 * 86400.)):
+                logger.info('not archiving recent window %s - %s, its data may still be completed', T1, T2)
+            else:
+                try:
+                    SpicasLightCurve.check_res_has_data(res[0])
+                except SpiacsAnalysisException as e:
+                    logger.info('not archiving window %s - %s without data: %s', T1, T2, e.message)
+                else:
+                    data, _ = SpicasLightCurve.parse_res(res[0], 'ordinary')
+
+                    SpiacsArchive(conf_dict['archive_dir']).write(data, [[t1_ijd, t2_ijd]])
+
+        if product_cache is None:
+            return
+
+        instrument.disp_conf = types.SimpleNamespace(products_url=conf_dict.get('prefetch_products_url', ''))
+
+        for time_bin_s in time_bins_s:
+            instrument.set_par('time_bin', time_bin_s)
+            instrument._current_par_dic = dict(T1=T1, T2=T2, time_bin=time_bin_s, data_level=data_level,
+                                               product_type='spi_acs_lc')
+
+            with tempfile.TemporaryDirectory() as out_dir:
+                prod_list = query.build_product_list(instrument, res, out_dir, api=False)
+                query.process_product_method(instrument, QueryProductList(prod_list=prod_list), api=False)
+
+                # the api product is added to the new entry, from its FITS file
+                entry = product_cache.get(query.get_product_cache_key(instrument))
+
+                if entry is not None:
+                    prod_list = query.build_product_list(instrument, entry, out_dir, api=True)
+                    query.process_product_method(instrument, QueryProductList(prod_list=prod_list), api=True)
+
+            logger.info('prefetched %s - %s %s at %s s', T1, T2, data_level, time_bin_s)
+
+    def run(self, triggers):
+        for line in triggers:
+            try:
+                trigger_isot = parse_trigger(line)
+            except Exception as e:
+                logger.warning('ignoring trigger %r: %s', line, e)
+                continue
+
+            if trigger_isot is not None:
+                self.prefetch(trigger_isot)
+
+    def start(self, triggers):
+        def run_niced():
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+            except (AttributeError, OSError) as e:
+                logger.info('can not lower prefetching priority: %s', e)
+
+            self.run(triggers)
+
+        thread = threading.Thread(target=run_niced, name='spiacs-prefetch', daemon=True)
+        thread.start()
+
+        return thread
+
+
+def start_prefetcher(conf_dict):
+    """
+    starts the prefetching thread of this process, if triggers are configured
+    """
+
+    if conf_dict.get('prefetch_trigger_dir'):
+        source = ('dir', conf_dict['prefetch_trigger_dir'])
+    elif conf_dict.get('prefetch_trigger_file'):
+        source = ('file', conf_dict['prefetch_trigger_file'])
+    else:
+        return None
+
+    with _started_lock:
+        if source in _started:
+            return None
+        _started.add(source)
+
+    logger.info('starting prefetcher on %s', source)
+
+    if source[0] == 'dir':
+        triggers = directory_triggers(source[1])
+    else:
+        triggers = file_triggers(source[1])
+
+    return SpiacsPrefetcher.from_conf_dict(conf_dict).start(triggers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='prefetch SPI-ACS data around trigger times')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--trigger-dir')
+    source.add_argument('--trigger-file')
+    source.add_argument('--trigger', action='append', help='UTC isot or IJD, can be repeated')
+    parser.add_argument('--poll-s', type=float, default=5.)
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    os.nice(10)
+
+    import yaml
+    from . import conf_file
+
+    with open(conf_file) as f:
+        prefetcher = SpiacsPrefetcher.from_conf_dict(yaml.safe_load(f)['instruments']['spi_acs'])
+
+    if args.trigger_dir:
+        prefetcher.run(directory_triggers(args.trigger_dir, poll_s=args.poll_s))
+    elif args.trigger_file:
+        prefetcher.run(file_triggers(args.trigger_file, poll_s=args.poll_s, from_start=True))
+    else:
+        prefetcher.run(args.trigger)
+
+
+if __name__ == '__main__':
+    main()
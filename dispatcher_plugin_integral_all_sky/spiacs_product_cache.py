@@ -0,0 +1,282 @@
+"""
+Overview
+--------
+
+cache of final light curve products, keyed on the full query parameters
+
+A hit skips the backend request, parsing, rebinning, FITS writing and figure generation:
+the stored FITS file, api-mode serialized product and figure are returned as they are.
+Every entry holds the FITS file; the api product and the figure are added when a query in
+that mode first builds them.
+
+Entries expire after product_cache_ttl_s if their data was settled when they were built: ordinary
+data of a window ending more than negative_cache_settled_after_s before (see spiacs_negative_cache).
+Realtime data, and ordinary data of recent windows, may still change or be completed, and their entries
+expire after product_cache_realtime_ttl_s. When the cache grows beyond product_cache_max_bytes,
+the least recently used entries are evicted.
+
+Keys include a digest of the plugin code, so that entries built by another version are not used.
+
+When the shared cache is configured (see spiacs_shared_cache), products are kept there instead,
+for all dispatcher replicas, and evicted by its sweeper.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import functools
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from cdci_data_analysis.analysis.products import QueryOutput
+
+from .spiacs_shared_cache import ContentStore, entry_ttl_s
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+
+@functools.lru_cache(maxsize=None)
+def plugin_version():
+    """
+    the package version and a digest of the plugin modules: the package version is not bumped on every change
+    """
+    try:
+        from importlib.metadata import version
+        package_version = version('dispatcher-plugin-integral-all-sky')
+    except Exception:
+        package_version = 'unknown'
+
+    sha = hashlib.sha256()
+    for fn in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+        with open(fn, 'rb') as f:
+            sha.update(f.read())
+
+    return '%s+%s' % (package_version, sha.hexdigest()[:16])
+
+
+def product_cache_key(T1_mjd, T2_mjd, time_bin_s, data_level, time_bin_mode='fixed', bayesian_blocks_p0=None):
+    binning = [] if time_bin_mode == 'fixed' else [time_bin_mode, repr(bayesian_blocks_p0)]
+
+    return hashlib.sha256(json.dumps(['spi_acs_lc', repr(T1_mjd), repr(T2_mjd), repr(time_bin_s),
+                                      data_level, plugin_version()] + binning).encode()).hexdigest()
+
+
+class ProductCacheEntry(object):
+
+    def __init__(self, entry_dir):
+        self.entry_dir = entry_dir
+
+    @property
+    def fits_path(self):
+        return os.path.join(self.entry_dir, 'product.fits')
+
+    def has(self, part):
+        return os.path.exists(os.path.join(self.entry_dir, part + '.json'))
+
+    def load(self, part):
+        with open(os.path.join(self.entry_dir, part + '.json')) as f:
+            return json.load(f)
+
+    def copy_fits_to(self, file_path):
+        shutil.copyfile(self.fits_path, file_path)
+
+    def run_query(self, call_back_url=None, run_asynch=False, logger=None, param_dict=None):
+        """
+        stands in for SpiacsDispatcher.run_query on a hit
+        """
+
+        query_out = QueryOutput()
+        query_out.set_done(message='', debug_message='product cache hit', job_status='done')
+
+        return self, query_out
+
+
+class ProductCache(object):
+
+    def __init__(self, cache_dir, max_bytes=1e9, ttl_s=86400., realtime_ttl_s=60., settled_after_s=3 * 86400.):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.realtime_ttl_s = realtime_ttl_s
+        self.settled_after_s = settled_after_s
+
+    @classmethod
+    def from_conf_dict(cls, conf_dict):
+        if not conf_dict.get('product_cache_dir'):
+            return None
+
+        store = ContentStore.from_conf_dict(conf_dict)
+
+        if store is not None:
+            return SharedProductCache(store,
+                                      ttl_s=conf_dict.get('product_cache_ttl_s', 86400.),
+                                      realtime_ttl_s=conf_dict.get('product_cache_realtime_ttl_s', 60.),
+                                      settled_after_s=conf_dict.get('negative_cache_settled_after_s', 3 * 86400.))
+
+        return cls(conf_dict['product_cache_dir'],
+                   max_bytes=conf_dict.get('product_cache_max_bytes', 1e9),
+                   ttl_s=conf_dict.get('product_cache_ttl_s', 86400.),
+                   realtime_ttl_s=conf_dict.get('product_cache_realtime_ttl_s', 60.),
+                   settled_after_s=conf_dict.get('negative_cache_settled_after_s', 3 * 86400.))
+
+    def get(self, key):
+        entry_dir = os.path.join(self.cache_dir, key)
+
+        try:
+            with open(os.path.join(entry_dir, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - meta['created'] > entry_ttl_s(meta, self.ttl_s, self.realtime_ttl_s, self.settled_after_s):
+            logger.info('product cache entry %s expired', key)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+        # for LRU eviction: atime is often not updated
+        os.utime(os.path.join(entry_dir, 'meta.json'))
+
+        logger.info('product cache hit %s', key)
+
+        return ProductCacheEntry(entry_dir)
+
+    def _write(self, entry_dir, fn, write):
+        with tempfile.NamedTemporaryFile('wb', dir=entry_dir, delete=False) as f:
+            write(f)
+        os.replace(f.name, os.path.join(entry_dir, fn))
+
+    def put(self, key, data_level, fits_path, api_product=None, figure=None, t2_ijd=None):
+        """
+        t2_ijd is the end of the window, for the lifetime of the entry
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        os.makedirs(entry_dir, exist_ok=True)
+
+        if not os.path.exists(os.path.join(entry_dir, 'product.fits')):
+            with open(fits_path, 'rb') as fits_file:
+                self._write(entry_dir, 'product.fits', lambda f: shutil.copyfileobj(fits_file, f))
+
+        for part, content in ('api', api_product), ('frontend', figure):
+            if content is not None:
+                self._write(entry_dir, part + '.json', lambda f: f.write(json.dumps(content).encode()))
+
+        if not os.path.exists(os.path.join(entry_dir, 'meta.json')):
+            self._write(entry_dir, 'meta.json',
+                        lambda f: f.write(json.dumps(dict(created=time.time(), data_level=data_level,
+                                                          t2_ijd=t2_ijd)).encode()))
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total_bytes = 0
+
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir():
+                continue
+
+            try:
+                entry_bytes = sum(f.stat().st_size for f in os.scandir(entry.path))
+                last_used = os.stat(os.path.join(entry.path, 'meta.json')).st_mtime
+            except OSError:
+                continue
+
+            entries.append((last_used, entry_bytes, entry.path))
+            total_bytes += entry_bytes
+
+        for last_used, entry_bytes, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+
+            logger.info('evicting product cache entry %s', entry_path)
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_bytes -= entry_bytes
+
+
+class SharedProductCacheEntry(ProductCacheEntry):
+
+    def __init__(self, store, ref):
+        self.store = store
+        self.ref = ref
+
+    @property
+    def fits_path(self):
+        return self.store.object_path(self.ref['objects']['fits'])
+
+    def has(self, part):
+        return part in self.ref['objects']
+
+    def load(self, part):
+        content = self.store.get_bytes(self.ref['objects'][part])
+
+        if content is None:
+            raise FileNotFoundError('shared cache object of %s is missing or damaged' % part)
+
+        return json.loads(content)
+
+    def copy_fits_to(self, file_path):
+        digest = self.ref['objects']['fits']
+        sha = hashlib.sha256()
+
+        with open(self.store.object_path(digest), 'rb') as source, open(file_path, 'wb') as f:
+            for block in iter(lambda: source.read(1 << 20), b''):
+                sha.update(block)
+                f.write(block)
+
+        if sha.hexdigest() != digest:
+            os.remove(file_path)
+            raise ValueError('shared cache object %s is damaged' % digest)
+
+        self.store.touch(digest)
+
+
+class SharedProductCache(object):
+    """
+    the product cache, on the shared content-addressed cache
+    """
+
+    def __init__(self, store, ttl_s=86400., realtime_ttl_s=60., settled_after_s=3 * 86400.):
+        self.store = store
+        self.ttl_s = ttl_s
+        self.realtime_ttl_s = realtime_ttl_s
+        self.settled_after_s = settled_after_s
+
+    def get(self, key):
+        # objects are checked as they are read, not twice
+        ref = self.store.get_ref('product', key, verify=False)
+
+        if ref is None:
+            return None
+
+        if time.time() - ref['created'] > entry_ttl_s(ref, self.ttl_s, self.realtime_ttl_s, self.settled_after_s):
+            return None
+
+        logger.info('shared product cache hit %s', key)
+
+        return SharedProductCacheEntry(self.store, ref)
+
+    def put(self, key, data_level, fits_path, api_product=None, figure=None, t2_ijd=None):
+        # parts are added to the entry: a concurrent writer may drop one, to be built again
+        ref = self.store.get_ref('product', key, verify=False)
+
+        if ref is None:
+            objects, created = {}, None
+        else:
+            objects, created = dict(ref['objects']), ref['created']
+
+        if 'fits' not in objects:
+            objects['fits'] = self.store.put_file(fits_path)
+
+        for part, content in ('api', api_product), ('frontend', figure):
+            if content is not None:
+                objects[part] = self.store.put_bytes(json.dumps(content).encode())
+
+        self.store.put_ref('product', key, data_level, objects, created=created, t2_ijd=t2_ijd)
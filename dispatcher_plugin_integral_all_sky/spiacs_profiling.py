@@ -0,0 +1,223 @@
+"""
+Overview
+--------
+
+opt-in profiling of single queries
+
+Enabled for all queries of a process with the SPIACS_PROFILE environment variable, or for one
+query with spiacs_profile=yes, which needs the spiacs-profiling role.
+
+Each stage of the query (run_query, build_product_list, process_product_method) then runs under
+cProfile and tracemalloc. Next to the products, in the query out_dir, are written:
+
+* spiacs_profile_<stage>.pstats, to be read with pstats or snakeviz
+* spiacs_profile.json: per stage, the duration, the traced memory peak, the top allocation sites,
+  and the sizes of the arrays going out of the stage
+
+cProfile only sees the thread of the query, while tracemalloc counts allocations of all threads.
+When profiling is off, the only cost is checking whether it is on.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import cProfile
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+profile_env_var = 'SPIACS_PROFILE'
+
+profiling_role = 'spiacs-profiling'
+
+# tracemalloc is process-wide: it runs while any stage, in any thread, is profiled
+_tracing_stages = 0
+_tracing_lock = threading.Lock()
+
+
+def profiling_requested(instrument):
+    if os.environ.get(profile_env_var):
+        return True
+
+    try:
+        return instrument.get_par_by_name('spiacs_profile').value == 'yes'
+    except Exception:
+        return False
+
+
+def describe_sizes(obj, name='result', sizes=None):
+    """
+    sizes of the arrays and responses in obj, looking into tuples, lists and data products
+    """
+
+    if sizes is None:
+        sizes = {}
+
+    if isinstance(obj, np.ndarray):
+        sizes[name] = dict(shape=list(obj.shape), dtype=str(obj.dtype), nbytes=int(obj.nbytes))
+    elif isinstance(obj, (tuple, list)):
+        for i, item in enumerate(obj):
+            describe_sizes(item, '%s[%s]' % (name, i), sizes)
+    elif hasattr(obj, 'data_unit'):
+        for data_unit in obj.data_unit:
+            if data_unit.data is not None:
+                describe_sizes(data_unit.data, '%s.%s' % (name, data_unit.name), sizes)
+    elif hasattr(obj, 'prod_list'):
+        describe_sizes(obj.prod_list, name, sizes)
+    elif hasattr(obj, 'prod_dictionary'):
+        sizes[name] = dict(nbytes=len(json.dumps(obj.prod_dictionary, default=str)))
+    elif hasattr(obj, 'data') and hasattr(obj, 'file_path'):
+        describe_sizes(obj.data, name, sizes)
+    elif hasattr(obj, 'nbytes'):
+        sizes[name] = dict(type=type(obj).__name__, nbytes=int(obj.nbytes))
+    elif hasattr(obj, 'content'):
+        sizes[name] = dict(type=type(obj).__name__, nbytes=len(obj.content))
+
+    return sizes
+
+
+def _start_tracing():
+    global _tracing_stages
+
+    with _tracing_lock:
+        if _tracing_stages == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+        _tracing_stages += 1
+
+
+def _stop_tracing():
+    global _tracing_stages
+
+    with _tracing_lock:
+        _tracing_stages -= 1
+        if _tracing_stages == 0:
+            tracemalloc.stop()
+
+
+class QueryProfile(object):
+
+    def __init__(self, top_allocations=25):
+        self.top_allocations = top_allocations
+        self.stages = {}
+        self.profilers = {}
+        self.out_dir = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        _start_tracing()
+
+        tracemalloc.reset_peak()
+        snapshot_before = tracemalloc.take_snapshot()
+
+        profiler = cProfile.Profile()
+
+        stage = dict(started=time.time())
+        self.stages[name] = stage
+
+        t0 = time.perf_counter()
+        profiler.enable()
+
+        try:
+            yield stage
+        finally:
+            profiler.disable()
+
+            stage['duration_s'] = time.perf_counter() - t0
+            stage['traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+
+            stage['top_allocations'] = [
+                dict(site=str(stat.traceback[-1]), size_diff=stat.size_diff, count_diff=stat.count_diff,
+                     traceback=[str(frame) for frame in stat.traceback])
+                for stat in tracemalloc.take_snapshot().compare_to(snapshot_before, 'traceback')[:self.top_allocations]
+            ]
+
+            _stop_tracing()
+
+            self.profilers[name] = profiler
+
+            logger.info('profiled %s: %.3g s, traced peak %s bytes', name, stage['duration_s'],
+                        stage['traced_peak_bytes'])
+
+    def write(self, out_dir=None):
+        if out_dir is not None:
+            self.out_dir = out_dir
+
+        if self.out_dir is None:
+            return
+
+        for name, profiler in self.profilers.items():
+            profiler.dump_stats(os.path.join(self.out_dir, 'spiacs_profile_%s.pstats' % name))
+
+        with open(os.path.join(self.out_dir, 'spiacs_profile.json'), 'w') as f:
+            json.dump(self.stages, f, indent=2, default=str)
+
+
+def get_query_profile(instrument):
+    """
+    the profile of the current query, or None when profiling is off
+    """
+
+    if not profiling_requested(instrument):
+        return None
+
+    if getattr(instrument, 'spiacs_query_profile', None) is None:
+        instrument.spiacs_query_profile = QueryProfile()
+
+    return instrument.spiacs_query_profile
+
+
+@contextlib.contextmanager
+def profiled_stage(instrument, name, out_dir=None):
+    """
+    profiles the block if profiling is on; the stage dict yielded (None when off) takes the result
+    """
+
+    profile = get_query_profile(instrument)
+
+    if profile is None:
+        yield None
+        return
+
+    with profile.stage(name) as stage:
+        yield stage
+
+    if 'result' in stage:
+        stage['arrays'] = describe_sizes(stage.pop('result'))
+
+    profile.write(out_dir)
+
+
+def profiled(stage_name):
+    """
+    decorates query methods taking the instrument as first argument; out_dir is taken from the arguments
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, instrument, *args, **kwargs):
+            if not profiling_requested(instrument):
+                return method(self, instrument, *args, **kwargs)
+
+            out_dir = inspect.signature(method).bind(self, instrument, *args, **kwargs).arguments.get('out_dir')
+
+            with profiled_stage(instrument, stage_name, out_dir=out_dir) as stage:
+                result = method(self, instrument, *args, **kwargs)
+                stage['result'] = result
+
+            return result
+
+        return wrapper
+
+    return decorator
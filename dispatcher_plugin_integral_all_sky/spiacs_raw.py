@@ -0,0 +1,172 @@
+"""
+Overview
+--------
+
+compact in-memory representation of raw SPI-ACS counts
+
+Raw samples are small integer counts on a regular time grid, but parsing yields float64
+for both columns, 16 bytes per sample. CompactCounts keeps instead:
+
+* counts in the smallest type holding them exactly: uint16, uint32, float32, or float64 as a last resort
+* times as positions on the instrument grid: the grid step, the start of each segment between gaps,
+  and a small integer residual per sample
+
+The residual is counted in units of the float64 spacing, so that the float64
+times are reproduced bit by bit, whatever precision the backend used. For backend responses
+this is typically 3 bytes per sample instead of 16.
+
+Float64 columns are produced only when asked for, by indexing like the structured array
+returned by parsing: data['TIME_IJD'], data['COUNTS'].
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+raw_dtype = [('TIME_IJD', '<f8'), ('COUNTS', '<f8')]
+
+
+def deduce_instr_t_bin(time_ijd):
+    dt_s = (time_ijd[1:] - time_ijd[:-1]) * 24 * 3600
+
+    unique_dt_s, unique_dt_s_counts = np.unique(
+        np.round(dt_s, 3), return_counts=True)
+    i = np.argmax(unique_dt_s_counts)
+    instr_t_bin = unique_dt_s[i]
+
+    logging.info("deduced instr_t_bin: %s, fraction %s",
+                 instr_t_bin, unique_dt_s_counts[i]/len(dt_s))
+
+    return instr_t_bin
+
+
+def smallest_int_dtype(values):
+    for dtype in np.int8, np.int16, np.int32:
+        info = np.iinfo(dtype)
+        if values.size == 0 or (values.min() >= info.min and values.max() <= info.max):
+            return dtype
+
+    return np.int64
+
+
+def compact_counts_dtype(counts):
+    if counts.size == 0:
+        return np.uint16
+
+    if np.all(counts == np.rint(counts)) and counts.min() >= 0:
+        if counts.max() <= np.iinfo(np.uint16).max:
+            return np.uint16
+
+        if counts.max() <= np.iinfo(np.uint32).max:
+            return np.uint32
+
+    if np.array_equal(counts.astype(np.float32), counts):
+        return np.float32
+
+    return np.float64
+
+
+class CompactCounts(object):
+
+    def __init__(self, counts, step_units, segment_start, segment_units, residual, instr_t_bin):
+        self.counts = counts
+        self.step_units = step_units
+        self.segment_start = segment_start
+        self.segment_units = segment_units
+        self.residual = residual
+        self.instr_t_bin = instr_t_bin
+
+    @classmethod
+    def from_arrays(cls, time_ijd, counts, instr_t_bin=None):
+        time_ijd = np.ascontiguousarray(time_ijd, dtype='<f8')
+        counts = np.asarray(counts)
+
+        if instr_t_bin is None and time_ijd.size >= 2:
+            instr_t_bin = deduce_instr_t_bin(time_ijd)
+
+        # float64 bit patterns of positive numbers are ordered like the numbers, and evenly spaced
+        # within a power of two: an exact integer time axis
+        units = time_ijd.view('<i8')
+
+        if units.size < 2:
+            step_units = 1.
+            segment_start = np.arange(units.size)
+        else:
+            step_units = instr_t_bin / 86400. / np.spacing(time_ijd[0])
+
+            # a segment ends where the next sample is not one step away
+            steps = np.rint(np.diff(units) / step_units)
+            segment_start = np.concatenate([[0], np.flatnonzero(steps != 1) + 1])
+
+            # the real grid step, rather than the rounded one, keeps the residuals small on long segments
+            segment_stop = np.append(segment_start[1:], units.size) - 1
+            if np.any(segment_stop > segment_start):
+                step_units = (np.sum(units[segment_stop] - units[segment_start]) /
+                              np.sum(segment_stop - segment_start))
+
+        compact = cls(counts.astype(compact_counts_dtype(counts)), step_units,
+                      segment_start, units[segment_start], None, instr_t_bin)
+
+        residual = units - compact._predicted_units(np.arange(units.size))
+        compact.residual = residual.astype(smallest_int_dtype(residual))
+
+        logger.info('compacted %s raw samples from %s to %s bytes, %s segments, residual %s, counts %s',
+                    units.size, time_ijd.nbytes + counts.nbytes, compact.nbytes,
+                    segment_start.size, compact.residual.dtype, compact.counts.dtype)
+
+        return compact
+
+    @classmethod
+    def from_raw(cls, data):
+        return cls.from_arrays(data['TIME_IJD'], data['COUNTS'])
+
+    def _predicted_units(self, index):
+        segment = np.searchsorted(self.segment_start, index, side='right') - 1
+        ticks = index - self.segment_start[segment]
+
+        return self.segment_units[segment] + np.rint(ticks * self.step_units).astype(np.int64)
+
+    def time_ijd(self, index=None):
+        """
+        float64 times, all of them or at the given indices
+        """
+        if index is None:
+            index = np.arange(self.size)
+        else:
+            index = np.arange(self.size)[index]
+
+        return (self._predicted_units(index) + self.residual[index]).view('<f8')
+
+    def to_raw(self):
+        data = np.zeros(self.size, dtype=raw_dtype)
+        data['TIME_IJD'] = self.time_ijd()
+        data['COUNTS'] = self.counts
+
+        return data
+
+    @property
+    def size(self):
+        return self.counts.size
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes + self.residual.nbytes + self.segment_start.nbytes + self.segment_units.nbytes
+
+    def __getitem__(self, name):
+        if name == 'TIME_IJD':
+            return self.time_ijd()
+
+        if name == 'COUNTS':
+            return self.counts
+
+        raise KeyError(name)
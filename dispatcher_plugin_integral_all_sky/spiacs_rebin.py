@@ -0,0 +1,97 @@
+"""
+Overview
+--------
+
+vectorized and optionally multi-threaded rebinning of raw light curves
+
+Each output bin holds the mean time and the mean rate of the raw samples falling in it.
+The sums are computed with the same pairwise summation as np.mean over the samples of the bin,
+so that results do not depend on the way the work is split: bins of equal sample count
+are gathered into rows of a 2D array and summed along the rows.
+
+For large windows the samples are split into chunks at bin edges, so that no bin is shared
+between chunks and chunk results are simply concatenated. Chunks are reduced on a thread pool:
+searchsorted, gathers and sums release the GIL. This is enabled with rebin_threads in
+data_server_conf.yml.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+
+import numpy as np
+
+from .spiacs_pools import get_pool
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+min_chunk_samples = 1000000
+
+
+def rebin_chunk(time_s, rate, edges):
+    """
+    returns mean time, mean rate and number of samples of each non-empty bin, ordered by bin
+    """
+
+    # same as np.digitize
+    bin_ids = np.searchsorted(edges, time_s, side='right')
+
+    if np.any(bin_ids[1:] < bin_ids[:-1]):
+        order = np.argsort(bin_ids, kind='stable')
+        bin_ids, time_s, rate = bin_ids[order], time_s[order], rate[order]
+
+    starts = np.concatenate([[0], np.flatnonzero(bin_ids[1:] != bin_ids[:-1]) + 1])
+    n_samples = np.diff(np.append(starts, bin_ids.size))
+
+    time_sum = np.zeros(starts.size)
+    rate_sum = np.zeros(starts.size)
+
+    for n in np.unique(n_samples):
+        selected = n_samples == n
+        rows = starts[selected][:, None] + np.arange(n)
+
+        time_sum[selected] = time_s[rows].sum(axis=1)
+        rate_sum[selected] = rate[rows].sum(axis=1)
+
+    return time_sum / n_samples, rate_sum / n_samples, n_samples
+
+
+def chunk_bounds(time_s, edges, n_chunks):
+    """
+    sample indices splitting time-ordered samples in about n_chunks chunks, on bin edges
+    """
+
+    approximate = np.linspace(0, time_s.size, n_chunks + 1).astype(np.int64)[1:-1]
+
+    # the edge at or before each approximate split
+    bin_ids = np.searchsorted(edges, time_s[approximate], side='right')
+    split_edges = edges[np.maximum(bin_ids - 1, 0)]
+
+    bounds = np.searchsorted(time_s, split_edges, side='left')
+
+    return np.unique(np.concatenate([[0], bounds, [time_s.size]]))
+
+
+def rebin(time_s, rate, edges, threads=None, chunk_samples=min_chunk_samples):
+    time_s = np.ascontiguousarray(time_s)
+    rate = np.ascontiguousarray(rate)
+
+    n_chunks = 1
+    if threads and threads > 1:
+        n_chunks = min(threads, time_s.size // chunk_samples)
+
+    if n_chunks <= 1 or np.any(time_s[1:] < time_s[:-1]):
+        return rebin_chunk(time_s, rate, edges)
+
+    bounds = chunk_bounds(time_s, edges, n_chunks)
+
+    logger.info('rebinning %s samples in %s chunks on %s threads', time_s.size, bounds.size - 1, threads)
+
+    results = list(get_pool(threads, thread_name_prefix='spiacs-rebin').map(
+        lambda i: rebin_chunk(time_s[bounds[i]:bounds[i + 1]], rate[bounds[i]:bounds[i + 1]], edges),
+        range(bounds.size - 1)))
+
+    return tuple(np.concatenate(column) for column in zip(*results))
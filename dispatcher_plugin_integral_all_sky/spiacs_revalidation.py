@@ -0,0 +1,259 @@
+"""
+Overview
+--------
+
+revalidation of realtime responses
+
+Realtime windows are polled again and again while new data arrives, and each rtlc?json&prophecy
+response repeats all the rows of the previous one. With realtime_revalidation_dir set in
+data_server_conf.yml, the last response of each window is kept, and the next request for
+the same window only asks for what changed.
+
+Entries are keyed on the exact window (t0_isot, dt_s and data level, as the request coalescing keys):
+a client polling a window which slides with the current time asks for a new window every time, and
+gets no revalidation. The requests are:
+
+* if the backend sent an ETag or Last-Modified, the request is conditional (If-None-Match,
+  If-Modified-Since), and the kept response is used again when the backend answers 304
+* otherwise, only the suffix of the window is requested: t0_isot and dt_s are narrowed to start
+  realtime_revalidation_overlap_s before the last kept IJD, and end where the window ends.
+  The rows of the kept response before that time and the rows of the suffix are spliced into
+  the text of the kept response, each row as the backend wrote it.
+
+  The spliced result is the response to a full request only for what the suffix covers: the rows
+  before the suffix and the fields besides lc (prophecy) are those of the kept response, the latter
+  since the backend computes them for the requested window, and the suffix window is not the full one.
+  Rows the backend backfills before the suffix, and changes of these fields, are not seen
+  until the entry is older than realtime_revalidation_max_age_s and the full window is requested again
+
+Responses which are not JSON light curves (no data, refusals) are not kept, and a suffix
+which can not be spliced is replaced by a full request.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+from .spiacs_coalescing import normalize_request_key, request_key_digest
+from .spiacs_shared_cache import CachedRes
+from .spiacs_time import isot_to_ijd, ijd_to_isot
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+_decoder = json.JSONDecoder()
+
+
+def realtime_rows(text):
+    """
+    start and end of the rows in the lc data array of a realtime response, and (start, end, ijd) of each row
+    """
+
+    lc = re.search(r'"lc"\s*:\s*\{', text)
+    if lc is None:
+        raise ValueError('no lc in realtime response')
+
+    columns = re.compile(r'"columns"\s*:\s*').search(text, lc.end())
+    data = re.compile(r'"data"\s*:\s*\[').search(text, lc.end())
+    if columns is None or data is None:
+        raise ValueError('no lc columns or data in realtime response')
+
+    i_ijd = _decoder.raw_decode(text, columns.end())[0].index('ijd')
+
+    rows = []
+    pos = data.end()
+
+    while True:
+        while text[pos].isspace():
+            pos += 1
+
+        if text[pos] == ']' and len(rows) == 0:
+            break
+
+        row, end = _decoder.raw_decode(text, pos)
+        rows.append((pos, end, float(row[i_ijd])))
+
+        pos = end
+        while text[pos].isspace():
+            pos += 1
+
+        if text[pos] == ']':
+            break
+
+        if text[pos] != ',':
+            raise ValueError('unexpected %r in realtime data rows' % text[pos])
+
+        pos += 1
+
+    rows_end = rows[-1][1] if rows else data.end()
+
+    return data.end(), rows_end, rows
+
+
+def splice_rows(kept_text, suffix_text, t_from_ijd):
+    """
+    the kept response, with its rows from t_from_ijd on replaced by those of the suffix;
+    everything else, rows before t_from_ijd included, is kept as it was
+    """
+
+    rows_start, rows_end, rows = realtime_rows(kept_text)
+    _, _, suffix_rows = realtime_rows(suffix_text)
+
+    if len(rows) < 2:
+        raise ValueError('too few kept rows to splice')
+
+    separator = kept_text[rows[0][1]:rows[1][0]]
+
+    row_texts = [kept_text[start:end] for start, end, ijd in rows if ijd < t_from_ijd] + \
+                [suffix_text[start:end] for start, end, ijd in suffix_rows if ijd >= t_from_ijd]
+
+    return kept_text[:rows_start] + separator.join(row_texts) + kept_text[rows_end:]
+
+
+class RealtimeRevalidation(object):
+
+    def __init__(self, cache_dir, max_age_s=3600., overlap_s=5.):
+        self.cache_dir = cache_dir
+        self.max_age_s = max_age_s
+        self.overlap_s = overlap_s
+
+    @classmethod
+    def from_conf_dict(cls, conf_dict):
+        if not conf_dict.get('realtime_revalidation_dir'):
+            return None
+
+        return cls(conf_dict['realtime_revalidation_dir'],
+                   max_age_s=conf_dict.get('realtime_revalidation_max_age_s', 3600.),
+                   overlap_s=conf_dict.get('realtime_revalidation_overlap_s', 5.))
+
+    def entry_path(self, param_dict):
+        return os.path.join(self.cache_dir, request_key_digest(normalize_request_key(param_dict)) + '.json')
+
+    def get(self, param_dict):
+        try:
+            with open(self.entry_path(param_dict)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry['created'] > self.max_age_s:
+            return None
+
+        return entry
+
+    def put(self, param_dict, res, created=None):
+        """
+        keeps the response with its validators, if it is a realtime light curve;
+        created is when its rows before the suffix were fetched, now for a full response
+        """
+
+        if res.status_code != 200:
+            return
+
+        try:
+            text = res.text
+            _, _, rows = realtime_rows(text)
+        except (ValueError, IndexError) as e:
+            logger.info('not keeping realtime response for revalidation: %s', e)
+            return
+
+        if len(rows) == 0:
+            return
+
+        headers = getattr(res, 'headers', None) or {}
+
+        entry = dict(created=time.time() if created is None else created,
+                     etag=headers.get('ETag'),
+                     last_modified=headers.get('Last-Modified'),
+                     t_last_ijd=max(ijd for _, _, ijd in rows),
+                     text=text)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        with tempfile.NamedTemporaryFile('w', dir=self.cache_dir, delete=False) as f:
+            json.dump(entry, f)
+
+        os.replace(f.name, self.entry_path(param_dict))
+
+    def suffix_window(self, param_dict, t_from_ijd):
+        """
+        t0_isot and dt_s of a window starting at or before t_from_ijd, ending with the window of param_dict
+        """
+
+        t_end_ijd = isot_to_ijd(param_dict['t0_isot']) + float(param_dict['dt_s']) / 86400.
+
+        # t0_isot has ms precision: taken 1 ms early, and the end kept where it was
+        t0_isot = ijd_to_isot(0.5 * (t_from_ijd + t_end_ijd) - 0.001 / 86400.)
+        dt_s = (t_end_ijd - isot_to_ijd(t0_isot)) * 86400.
+
+        return t0_isot, dt_s
+
+    def fetch(self, fetch, window_url, param_dict, stats=None, **kwargs):
+        """
+        fetch(url, params=..., headers=..., stats=..., **kwargs) is the backend request,
+        window_url(t0_isot, dt_s) the URL of a realtime window
+        """
+
+        entry = self.get(param_dict)
+
+        url = window_url(param_dict['t0_isot'], param_dict['dt_s'])
+
+        if entry is None:
+            res = fetch(url, params=param_dict, stats=stats, **kwargs)
+            self.put(param_dict, res)
+            return res
+
+        if entry['etag'] is not None or entry['last_modified'] is not None:
+            headers = {}
+            if entry['etag'] is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified'] is not None:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+            res = fetch(url, params=param_dict, headers=headers, stats=stats, **kwargs)
+
+            if res.status_code == 304:
+                logger.info('realtime response not modified since the last request')
+
+                if stats is not None:
+                    stats['not_modified'] += 1
+
+                return CachedRes(entry['text'].encode())
+
+            self.put(param_dict, res)
+            return res
+
+        t_from_ijd = entry['t_last_ijd'] - self.overlap_s / 86400.
+        t0_isot, dt_s = self.suffix_window(param_dict, t_from_ijd)
+
+        suffix_res = fetch(window_url(t0_isot, dt_s), params=dict(param_dict, t0_isot=t0_isot, dt_s=dt_s),
+                           stats=stats, **kwargs)
+
+        try:
+            if suffix_res.status_code != 200:
+                raise ValueError('suffix request returned %s' % suffix_res.status_code)
+
+            res = CachedRes(splice_rows(entry['text'], suffix_res.text, t_from_ijd).encode())
+        except (ValueError, IndexError) as e:
+            logger.info('can not splice realtime suffix, requesting the full window: %s', e)
+
+            res = fetch(url, params=param_dict, stats=stats, **kwargs)
+            self.put(param_dict, res)
+            return res
+
+        logger.info('realtime window completed with %s bytes from %s', len(suffix_res.content), t0_isot)
+
+        if stats is not None:
+            stats['suffix_fetches'] += 1
+
+        # the rows before the suffix are as old as the kept response
+        self.put(param_dict, res, created=entry['created'])
+
+        return res
@@ -0,0 +1,341 @@
+"""
+Overview
+--------
+
+content-addressed cache shared by dispatcher replicas
+
+With data_server_cache set in data_server_conf.yml (under dispatcher_mnt_point, if that is
+set too), backend responses and built light curves are kept on that shared mount, and a window
+fetched by one replica is served to all of them. The cache holds::
+
+    <root>/objects/<ab>/<sha256>        immutable content, named by its sha256
+    <root>/refs/<kind>/<ab>/<digest>.json  what a query key maps to: object digests, creation time, data level,
+                                           end of the window
+
+The layout is safe on NFS-like filesystems without locks:
+
+* everything is written to a temporary file in the destination directory, flushed to disk,
+  and renamed into place: readers see a complete file or none
+* objects never change, so that concurrent writers of the same content write the same bytes;
+  for refs the last writer wins, and either is valid
+* objects are checked against their digest when read, a ref pointing to a missing or damaged
+  object is a miss
+
+Refs expire after shared_cache_ttl_s if their data was settled when they were written: ordinary data
+of a window ending more than negative_cache_settled_after_s before (see spiacs_negative_cache).
+Realtime data, and ordinary data of recent windows, may still change or be completed, and their refs
+expire after shared_cache_realtime_ttl_s.
+
+When the objects take more than shared_cache_max_bytes, the sweeper removes the least recently used
+ones, with refs left pointing to them, and temporary files abandoned by crashed writers. It also
+removes the expired results and unused locks of request coalescing, kept in <root>/coalescing.
+It runs after writes, at most every shared_cache_sweep_interval_s across all replicas, or with the
+command below; files removed by another sweeper at the same time are skipped::
+
+    python -m dispatcher_plugin_integral_all_sky.spiacs_shared_cache sweep --root DIR --max-bytes N
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+from .spiacs_coalescing import request_key_digest, sweep_shared_results
+from .spiacs_negative_cache import is_settled
+
+logger = logging.getLogger('spiacs_dataserver_dispatcher')
+
+# objects read more recently than this are not touched again: on NFS, touching is a write
+touch_interval_s = 3600.
+
+tmp_prefix = '.tmp-'
+
+
+def shared_cache_root(conf_dict):
+    data_server_cache = conf_dict.get('data_server_cache')
+
+    if not data_server_cache:
+        return None
+
+    if conf_dict.get('dispatcher_mnt_point'):
+        return os.path.join(conf_dict['dispatcher_mnt_point'], data_server_cache.lstrip('/'))
+
+    return data_server_cache
+
+
+def entry_ttl_s(entry, ttl_s, realtime_ttl_s, settled_after_s):
+    """
+    lifetime of an entry with created, data_level and t2_ijd (None if unknown)
+    """
+    if is_settled(entry['data_level'], entry.get('t2_ijd'), settled_after_s, now_s=entry['created']):
+        return ttl_s
+
+    return realtime_ttl_s
+
+
+class CachedRes(object):
+    """
+    stands in for a backend response read from a cache or a store: the shared cache, the negative cache,
+    ephemerides, recorded cassettes
+    """
+
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+    @property
+    def text(self):
+        return self.content.decode()
+
+
+class ContentStore(object):
+
+    def __init__(self, root, max_bytes=2e10, ttl_s=7 * 86400., realtime_ttl_s=60., sweep_interval_s=600.,
+                 settled_after_s=3 * 86400., coalescing_ttl_s=30.):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.realtime_ttl_s = realtime_ttl_s
+        self.settled_after_s = settled_after_s
+        self.coalescing_ttl_s = coalescing_ttl_s
+        self.sweep_interval_s = sweep_interval_s
+
+    @classmethod
+    def from_conf_dict(cls, conf_dict):
+        root = shared_cache_root(conf_dict)
+
+        if root is None:
+            return None
+
+        return cls(root,
+                   max_bytes=conf_dict.get('shared_cache_max_bytes', 2e10),
+                   ttl_s=conf_dict.get('shared_cache_ttl_s', 7 * 86400.),
+                   realtime_ttl_s=conf_dict.get('shared_cache_realtime_ttl_s', 60.),
+                   settled_after_s=conf_dict.get('negative_cache_settled_after_s', 3 * 86400.),
+                   coalescing_ttl_s=conf_dict.get('request_coalescing_ttl_s', 30.),
+                   sweep_interval_s=conf_dict.get('shared_cache_sweep_interval_s', 600.))
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def ref_path(self, kind, key):
+        digest = request_key_digest(key)
+        return os.path.join(self.root, 'refs', kind, digest[:2], digest + '.json')
+
+    def _write_atomic(self, path, write):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False,
+                                         prefix='%s%s-%s-' % (tmp_prefix, socket.gethostname(), os.getpid())) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(f.name, path)
+
+    def put_bytes(self, content):
+        digest = hashlib.sha256(content).hexdigest()
+
+        if not os.path.exists(self.object_path(digest)):
+            self._write_atomic(self.object_path(digest), lambda f: f.write(content))
+
+        return digest
+
+    def put_file(self, path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+
+        digest = sha.hexdigest()
+
+        if not os.path.exists(self.object_path(digest)):
+            with open(path, 'rb') as source:
+                self._write_atomic(self.object_path(digest), lambda f: shutil.copyfileobj(source, f))
+
+        return digest
+
+    def verify(self, digest):
+        sha = hashlib.sha256()
+
+        try:
+            with open(self.object_path(digest), 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+        except OSError:
+            return False
+
+        if sha.hexdigest() != digest:
+            logger.warning('shared cache object %s is damaged, removing it', digest)
+
+            try:
+                os.remove(self.object_path(digest))
+            except OSError:
+                pass
+
+            return False
+
+        self.touch(digest)
+
+        return True
+
+    def get_bytes(self, digest):
+        try:
+            with open(self.object_path(digest), 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+
+        if hashlib.sha256(content).hexdigest() != digest:
+            logger.warning('shared cache object %s is damaged', digest)
+            return None
+
+        self.touch(digest)
+
+        return content
+
+    def touch(self, digest):
+        try:
+            if time.time() - os.stat(self.object_path(digest)).st_mtime > touch_interval_s:
+                os.utime(self.object_path(digest))
+        except OSError:
+            pass
+
+    def put_ref(self, kind, key, data_level, objects, created=None, t2_ijd=None):
+        """
+        objects maps names to object digests, t2_ijd is the end of the window
+        """
+
+        ref = dict(created=time.time() if created is None else created, data_level=data_level, t2_ijd=t2_ijd,
+                   objects=objects)
+
+        self._write_atomic(self.ref_path(kind, key), lambda f: f.write(json.dumps(ref).encode()))
+
+        self.maybe_sweep()
+
+    def get_ref(self, kind, key, verify=True):
+        """
+        the ref, if it is fresh and all its objects are there; without verify, get_bytes checks them
+        """
+
+        try:
+            with open(self.ref_path(kind, key)) as f:
+                ref = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - ref['created'] > entry_ttl_s(ref, self.ttl_s, self.realtime_ttl_s, self.settled_after_s):
+            return None
+
+        if verify and not all(self.verify(digest) for digest in ref['objects'].values()):
+            return None
+
+        return ref
+
+    def maybe_sweep(self):
+        marker = os.path.join(self.root, 'last_sweep')
+
+        try:
+            if time.time() - os.stat(marker).st_mtime < self.sweep_interval_s:
+                return
+        except FileNotFoundError:
+            pass
+
+        # other replicas skip the sweep from now on; if two sweep at once, removals are idempotent
+        with open(marker, 'a'):
+            pass
+        os.utime(marker)
+
+        try:
+            self.sweep()
+        except OSError as e:
+            logger.warning('shared cache sweep failed: %s', e)
+
+    def _scan(self, subdir):
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, subdir)):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                yield path, fn, st
+
+    @staticmethod
+    def _remove(path):
+        """
+        removes a file, unless another sweeper did; returns whether this one did
+        """
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def sweep(self, tmp_max_age_s=3600.):
+        t0 = time.time()
+
+        objects = []
+        total_bytes = 0
+
+        for path, fn, st in self._scan('objects'):
+            if fn.startswith(tmp_prefix):
+                if t0 - st.st_mtime > tmp_max_age_s:
+                    self._remove(path)
+                continue
+
+            objects.append((st.st_mtime, st.st_size, path))
+            total_bytes += st.st_size
+
+        n_removed = 0
+        for mtime, size, path in sorted(objects):
+            if total_bytes <= self.max_bytes:
+                break
+
+            total_bytes -= size
+            n_removed += self._remove(path)
+
+        for path, fn, st in self._scan('refs'):
+            if fn.startswith(tmp_prefix) and t0 - st.st_mtime > tmp_max_age_s:
+                self._remove(path)
+            elif t0 - st.st_mtime > max(self.ttl_s, self.realtime_ttl_s):
+                self._remove(path)
+
+        n_coalescing_removed = sweep_shared_results(self.root, self.coalescing_ttl_s, tmp_max_age_s)
+
+        logger.info('swept shared cache %s in %.3g s: removed %s objects and %s coalescing files, %s bytes left',
+                    self.root, time.time() - t0, n_removed, n_coalescing_removed, total_bytes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='maintain the shared SPI-ACS cache')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sweep = subparsers.add_parser('sweep', help='evict least recently used objects')
+    sweep.add_argument('--root', required=True)
+    sweep.add_argument('--max-bytes', type=float, required=True)
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'sweep':
+        ContentStore(args.root, max_bytes=args.max_bytes).sweep()
+
+
+if __name__ == '__main__':
+    main()
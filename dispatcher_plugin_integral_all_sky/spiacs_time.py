@@ -0,0 +1,127 @@
+"""
+Overview
+--------
+
+plain-float conversions between IJD, MJD and ISOT
+
+IJD is INTEGRAL Julian Date, days in TT since 2000-01-01T00:00:00 TT (MJD 51544),
+see https://heasarc.gsfc.nasa.gov/W3Browse/integral/intscw.html
+
+Building astropy Time objects costs milliseconds per object, which adds up on every query.
+These functions do the same arithmetic on floats, with the leap second table read once;
+they agree with astropy to better than a microsecond since 1972 (when leap seconds became integer).
+The only exception is UTC MJD during a day with a leap second, which astropy stretches to 86401 s:
+here all days have 86400 s, so that UTC MJD can be off by up to a second on those days. UTC isot is exact.
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import datetime
+import functools
+import math
+
+import numpy as np
+
+integral_mjdref = 51544.0
+
+tt_tai_s = 32.184
+
+_mjd_epoch = datetime.date(1858, 11, 17).toordinal()
+
+
+@functools.lru_cache(maxsize=1)
+def leap_second_table():
+    """
+    (MJD UTC of the start of each entry, TAI-UTC in seconds), as known to erfa
+    """
+    import erfa
+
+    table = erfa.leap_seconds.get()
+
+    mjd = np.array([datetime.date(int(year), int(month), 1).toordinal() - _mjd_epoch
+                    for year, month in zip(table['year'], table['month'])], dtype=float)
+
+    return mjd, np.array(table['tai_utc'], dtype=float)
+
+
+def tai_utc_s(mjd_utc):
+    mjd, tai_utc = leap_second_table()
+
+    i = np.searchsorted(mjd, mjd_utc, side='right') - 1
+
+    return float(tai_utc[max(i, 0)])
+
+
+def utc_mjd_to_ijd(mjd_utc):
+    return mjd_utc + (tai_utc_s(mjd_utc) + tt_tai_s) / 86400. - integral_mjdref
+
+
+def ijd_to_utc_mjd(ijd):
+    mjd_tt = ijd + integral_mjdref
+
+    # TAI-UTC at the approximate UTC, corrected once: the first guess is off only within
+    # a minute after a leap second
+    mjd_utc = mjd_tt - (tai_utc_s(mjd_tt) + tt_tai_s) / 86400.
+    return mjd_tt - (tai_utc_s(mjd_utc) + tt_tai_s) / 86400.
+
+
+def isot_to_mjd(isot):
+    """
+    calendar date to MJD, in the same time scale
+    """
+    date, _, clock = isot.partition('T')
+
+    year, month, day = (int(x) for x in date.split('-'))
+
+    seconds = 0.
+    if clock != '':
+        hours, minutes, secs = clock.split(':')
+        seconds = int(hours) * 3600 + int(minutes) * 60 + float(secs)
+
+    return datetime.date(year, month, day).toordinal() - _mjd_epoch + seconds / 86400.
+
+
+def mjd_to_isot(mjd, precision=3):
+    """
+    MJD to calendar date, in the same time scale, formatted as astropy isot
+    """
+    day = math.floor(mjd)
+
+    scale = 10 ** precision
+    ticks = int(round((mjd - day) * 86400 * scale))
+
+    if ticks >= 86400 * scale:
+        day += 1
+        ticks -= 86400 * scale
+
+    seconds, fraction = divmod(ticks, scale)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+
+    isot = datetime.date.fromordinal(day + _mjd_epoch).isoformat() + 'T%02d:%02d:%02d' % (hours, minutes, seconds)
+
+    if precision > 0:
+        isot += '.%0*d' % (precision, fraction)
+
+    return isot
+
+
+def isot_to_ijd(isot):
+    """
+    UTC isot to IJD
+    """
+    return utc_mjd_to_ijd(isot_to_mjd(isot))
+
+
+def ijd_to_isot(ijd):
+    """
+    IJD to UTC isot
+    """
+    return mjd_to_isot(ijd_to_utc_mjd(ijd))
+
+
+def ijd_to_tt_isot(ijd):
+    return mjd_to_isot(ijd + integral_mjdref)
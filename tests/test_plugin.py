@@ -161,20 +161,15 @@ def test_odaapi_data_coherence(dispatcher_live_fixture, dispatcher_test_conf):
     assert "166.134 81.107 109932.3 0.016 0.016 30.0" in product_spiacs_rt.spi_acs_lc_0_query.data_unit[1].header['EPHS']
     assert "166.134 81.107 109932.3 0.016 0.016 30.0" in product_spiacs.spi_acs_lc_0_query.data_unit[1].header['EPHS']
 
-    # TODO: this verification will have to be completed
-    # for offset in np.arange(-10, 10):        
-    #     if data['RATE'][offset:] - data_rt['RATE'][:-offset]:
-    #         pass
-    
-    # from matplotlib import pyplot as plt
-    # t0 = t.min()
-    # plt.plot((t - t0), data['RATE'])
-    # plt.plot((t_rt - t0), data_rt['RATE'])
-    # plt.grid()
-    # plt.xlim(0, 1)
-    # plt.savefig("test_odaapi_data_coherence.png")
-        
-    # assert np.abs(data['RATE'] - data_rt['RATE']).max() < 1e-5
+    from dispatcher_plugin_integral_all_sky.spiacs_alignment import align_counts
+
+    time_bin = data['TIME'][1] - data['TIME'][0]
+    alignment, ccf = align_counts(t, data['RATE'] * time_bin, time_bin,
+                                  t_rt, data_rt['RATE'] * time_bin, time_bin)
+
+    print("realtime alignment", alignment)
+
+    assert np.isfinite(alignment['lag_s'])
 
 
 def test_request_too_large(dispatcher_live_fixture):
@@ -233,3 +228,1414 @@ def test_realtime(dispatcher_live_fixture, dispatcher_test_conf, roles):
         assert jdata['job_status'] == 'failed'
         assert c.status_code == 403
 
+
+
+def test_excess_search():
+    from dispatcher_plugin_integral_all_sky.spiacs_excess_query import excess_search, timescale_ladder
+
+    rng = np.random.default_rng(1)
+
+    instr_t_bin = 0.05
+    t = np.arange(100000) * instr_t_bin
+    counts = rng.poisson(150, t.size)
+    counts[50000:50020] += 60
+
+    # data gap, windows across it should be skipped
+    t[75000:] += 100
+
+    excess = excess_search(t, counts, instr_t_bin, timescale_ladder(instr_t_bin, 10.), min_significance=6)
+
+    assert len(excess) > 0
+    assert np.all(np.abs(excess['TIME'] - t[50000]) < 10)
+    assert 0.4 <= excess['TIMESCALE'][0] <= 1.6
+    assert np.all(np.diff(excess['SIGNIFICANCE']) <= 0)
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_request_coalescing(tmp_path, shared):
+    import threading
+    from dispatcher_plugin_integral_all_sky.spiacs_coalescing import SingleFlight
+    from dispatcher_plugin_integral_all_sky.spiacs_shared_cache import CachedRes, ContentStore
+
+    single_flight = SingleFlight()
+    n_fetches = []
+    release = threading.Event()
+
+    response = CachedRes(b'8484.1 0.000 152 0'), CachedRes(b"'166.134 81.107'")
+
+    def fetch():
+        n_fetches.append(1)
+        release.wait(5)
+        return response
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+                    single_flight.do(('2023-03-25T20:30:00.000', 137.5, 'ordinary'), fetch,
+                                     shared_dir=str(tmp_path) if shared else None)))
+               for _ in range(10)]
+
+    for thread in threads:
+        thread.start()
+
+    time.sleep(0.5)
+    release.set()
+
+    for thread in threads:
+        thread.join()
+
+    assert results == [response] * 10
+    assert len(n_fetches) == 1
+    assert single_flight.stats()['coalesced'] == 9
+
+    if shared:
+        import fcntl
+        import glob
+        import os
+
+        # another worker, with its own process-level state, picks up the stored result
+        other_worker = SingleFlight()
+        res, res_ephs = other_worker.do(('2023-03-25T20:30:00.000', 137.5, 'ordinary'), lambda: 1/0,
+                                        shared_dir=str(tmp_path))
+        assert (res.status_code, res.text, res_ephs.text) == (200, response[0].text, response[1].text)
+        assert other_worker.stats()['coalesced_shared'] == 1
+
+        # a hung leader in a third worker delays the others by the result lifetime at most
+        lock_fn, = glob.glob(str(tmp_path / 'coalescing' / '*.lock'))
+        os.remove(lock_fn.replace('.lock', '.json'))
+
+        with open(lock_fn) as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            t0 = time.time()
+            assert SingleFlight().do(('2023-03-25T20:30:00.000', 137.5, 'ordinary'), lambda: 'fetched',
+                                     shared_dir=str(tmp_path), shared_ttl_s=0.3, encode=lambda result: None) == 'fetched'
+            assert time.time() - t0 < 2
+
+            # expired results, abandoned temporary files and unused locks are swept; held locks are kept
+            store = ContentStore(str(tmp_path), coalescing_ttl_s=30.)
+            other_lock_fn = lock_fn.replace('.lock', '-other.lock')
+            for fn in lock_fn.replace('.lock', '.json'), other_lock_fn, str(tmp_path / 'coalescing' / 'tmpabc'):
+                open(fn, 'w').close()
+                os.utime(fn, (time.time() - 7200, time.time() - 7200))
+            os.utime(lock_fn, (time.time() - 7200, time.time() - 7200))
+
+            store.sweep()
+            assert os.listdir(str(tmp_path / 'coalescing')) == [os.path.basename(lock_fn)]
+
+        store.sweep()
+        assert os.listdir(str(tmp_path / 'coalescing')) == []
+
+
+def test_archive(tmp_path):
+    from dispatcher_plugin_integral_all_sky.spiacs_archive import SpiacsArchive, ingest_from_files
+
+    # two recorded responses, the second crossing into the next IJD day
+    for i, t0_ijd in enumerate([8484.1, 8484.99995]):
+        ijd = t0_ijd + np.arange(2000) * 0.05 / 86400
+        with open(tmp_path / f"response_{i}.txt", "w") as f:
+            f.write("\n".join(f"{t:.10f} {j * 0.05:.3f} {100 + j % 7} 0" for j, t in enumerate(ijd)))
+
+    archive = SpiacsArchive(str(tmp_path / "archive"))
+    ingest_from_files(archive, [str(tmp_path / "response_0.txt"), str(tmp_path / "response_1.txt")])
+
+    assert archive.read(8484.0, 8484.1) is None
+
+    data = archive.read(8484.1 + 10.01 / 86400, 8484.1 + 20.01 / 86400)
+    assert len(data) == 200
+    assert np.all(data["COUNTS"] == 100 + (np.arange(201, 401) % 7))
+
+    data = archive.read(8484.99995, 8484.99995 + 99.99 / 86400)
+    assert len(data) == 2000
+    assert np.all(np.diff(data['TIME_IJD']) > 0)
+
+
+def test_archive_no_data(tmp_path, stand_in_backend):
+    import types
+    from astropy import units as u
+    from astropy.time import Time
+    from dispatcher_plugin_integral_all_sky.spiacs_archive import SpiacsArchive, ingest_from_backend
+    from dispatcher_plugin_integral_all_sky.spiacs_dataserver_dispatcher import SpiacsDispatcher
+    from dispatcher_plugin_integral_all_sky.spiacs_raw import raw_dtype
+
+    url, calls = stand_in_backend
+
+    archive = SpiacsArchive(str(tmp_path / "archive"))
+
+    # covered without samples, as older versions archived windows without data: the backend is asked
+    archive.write(np.zeros(0, dtype=raw_dtype), [[8484.1, 8484.2]])
+    assert archive.covers(8484.1, 8484.2)
+    assert archive.read(8484.1, 8484.2) is None
+
+    instrument = types.SimpleNamespace(data_server_conf_dict=dict(
+        data_server_url=url + "/zero/genlc/ACS/{t0_isot}/{dt_s}",
+        dummy_cache=''))
+
+    ingest_from_backend(archive, SpiacsDispatcher(instrument=instrument),
+                        "2023-03-25T20:00:00.000", "2023-03-25T21:00:00.000", chunk_s=1800.)
+
+    # through the dispatcher, with the window as parameters; windows without data are not archived
+    assert len(calls) == 2
+    assert all('data_level=ordinary' in call for call in calls)
+    assert not archive.covers(8484.84, 8484.87)
+
+    # recent chunks may still be completed: not fetched for the archive
+    calls.clear()
+    now_isot = Time.now().isot
+    ingest_from_backend(archive, SpiacsDispatcher(instrument=instrument), now_isot, now_isot, chunk_s=1800.)
+    ingest_from_backend(archive, SpiacsDispatcher(instrument=instrument),
+                        (Time.now() - 3600 * u.s).isot, now_isot, chunk_s=1800.)
+    assert len(calls) == 0
+
+
+def test_archive_concurrent_writes(tmp_path):
+    import os
+    import threading
+    from dispatcher_plugin_integral_all_sky.spiacs_archive import SpiacsArchive
+    from dispatcher_plugin_integral_all_sky.spiacs_raw import raw_dtype
+
+    archive = SpiacsArchive(str(tmp_path / "archive"))
+
+    def chunk(k):
+        data = np.zeros(100, dtype=raw_dtype)
+        data['TIME_IJD'] = 8484 + (k * 100 + np.arange(100)) / 86400.
+        # counts tell the time of their sample
+        data['COUNTS'] = k * 100 + np.arange(100)
+        return data
+
+    n_misaligned = []
+
+    def read():
+        while not done.is_set():
+            time_s, counts = archive.map_day(8484)
+            n_misaligned.append(int(np.sum(np.round(np.asarray(time_s)) != counts)))
+
+    def write(ks):
+        for k in ks:
+            archive.write(chunk(k), [[8484 + k * 100 / 86400., 8484 + (k + 1) * 100 / 86400.]])
+
+    done = threading.Event()
+    reader = threading.Thread(target=read)
+    reader.start()
+
+    writers = [threading.Thread(target=write, args=(range(i, 40, 4),)) for i in range(4)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+
+    done.set()
+    reader.join()
+
+    # no samples of one writer lost, and readers never pair times and counts of different writes
+    time_s, counts = archive.map_day(8484)
+    assert np.all(np.asarray(counts) == np.arange(4000))
+    assert sum(n_misaligned) == 0
+    assert sorted(fn for fn in os.listdir(archive.day_dir(8484)) if not fn.startswith('tmp')) == \
+        ['.lock', 'COUNTS.40.u4', 'TIME_S.40.f8', 'meta.json']
+
+
+@pytest.fixture
+def stand_in_backend():
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    calls = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            calls.append(self.path)
+
+            if self.path.startswith('/fail'):
+                self.send_response(503)
+                self.end_headers()
+                return
+
+            if self.path.startswith('/slow') and len(calls) == 1:
+                time.sleep(2)
+
+            self.send_response(200)
+            self.end_headers()
+
+            if self.path.startswith('/zero'):
+                self.wfile.write(b"ZeroData")
+            elif self.path.startswith('/refuse'):
+                self.wfile.write(b"Over revolution")
+            elif '/ephs/' in self.path:
+                self.wfile.write(b"'166.134 81.107 109932.3 0.016 0.016 30.0'")
+            else:
+                self.wfile.write(b"OK")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield f"http://127.0.0.1:{server.server_port}", calls
+
+    server.shutdown()
+
+
+def test_fetch_policy(stand_in_backend, monkeypatch):
+    import collections
+    import requests
+    from dispatcher_plugin_integral_all_sky import spiacs_fetch
+
+    url, calls = stand_in_backend
+
+    policy = spiacs_fetch.FetchPolicy(max_retries=2, backoff_base_s=0.01, breaker_failures=3, breaker_reset_s=0.5,
+                                      hedge=True, hedge_min_samples=3, hedge_min_delay_s=0.1)
+
+    spiacs_fetch.circuit_breaker.record_success()
+
+    stats = collections.Counter()
+    with pytest.raises(requests.exceptions.HTTPError):
+        spiacs_fetch.fetch(url + "/fail", policy=policy, kind='test-fail', stats=stats)
+    assert stats['attempts'] == 3 and stats['retries'] == 2
+
+    # breaker is open now: no request reaches the backend
+    n_calls = len(calls)
+    with pytest.raises(spiacs_fetch.BackendUnavailable):
+        spiacs_fetch.fetch(url + "/ok", policy=policy, kind='test-ok')
+    assert len(calls) == n_calls
+
+    time.sleep(0.6)
+    calls.clear()
+
+    # a probe failing otherwise than on the backend lets the next request probe again
+    def broken_get(*args):
+        raise RuntimeError('not a backend failure')
+
+    with monkeypatch.context() as m:
+        m.setattr(spiacs_fetch, '_hedged_get', broken_get)
+        with pytest.raises(RuntimeError):
+            spiacs_fetch.fetch(url + "/ok", policy=policy, kind='test-ok')
+    assert spiacs_fetch.circuit_breaker.state == 'open'
+
+    # first request is slow, the hedged one answers
+    for _ in range(3):
+        spiacs_fetch.latency_tracker.add('test-slow', 0.01)
+
+    stats = collections.Counter()
+    assert spiacs_fetch.fetch(url + "/slow", policy=policy, kind='test-slow', stats=stats).text == "OK"
+    assert stats['hedged'] == 1 and stats['hedge_won'] == 1
+    assert stats['latency_s'] < 1.5
+    assert spiacs_fetch.circuit_breaker.state == 'closed'
+
+
+def test_time_conversion():
+    from astropy.time import Time
+    from dispatcher_plugin_integral_all_sky import spiacs_time
+
+    for ijd in np.random.default_rng(0).uniform(1000, 9500, 200):
+        t = Time(ijd + 51544., format='mjd', scale='tt')
+
+        assert spiacs_time.ijd_to_tt_isot(ijd) == t.isot
+        assert abs(spiacs_time.isot_to_ijd(t.utc.isot) - (Time(t.utc.isot, scale='utc').tt.mjd - 51544.)) * 86400 < 1e-6
+        assert abs(spiacs_time.utc_mjd_to_ijd(t.utc.mjd) - ijd) * 86400 < 1e-6
+        assert abs(spiacs_time.ijd_to_utc_mjd(ijd) - t.utc.mjd) * 86400 < 1e-6
+
+
+def test_process_pool_offload():
+    from dispatcher_plugin_integral_all_sky.spiacs_lightcurve_query import SpicasLightCurve, DummySpiacsRes
+
+    ijd = 8484.1 + np.arange(20000) * 0.05 / 86400
+    counts = np.random.default_rng(0).poisson(150, ijd.size)
+
+    res = DummySpiacsRes()
+    res.text = "\n".join(f"{t:.10f} {j * 0.05:.3f} {c} 0" for j, (t, c) in enumerate(zip(ijd, counts)))
+
+    for delta_t in None, 1.:
+        data, comment, meta_data = SpicasLightCurve.parse_and_rebin(res, 'ordinary', delta_t)
+        data_pool, comment_pool, meta_data_pool = SpicasLightCurve.parse_and_rebin(
+            res, 'ordinary', delta_t, process_pool_size=2, process_pool_min_bytes=0)
+
+        assert np.all(data == data_pool)
+        assert comment == comment_pool
+        assert meta_data == meta_data_pool
+
+
+def test_admission_control(tmp_path):
+    from dispatcher_plugin_integral_all_sky.spiacs_admission import AdmissionControl, AdmissionRefused
+
+    admission_control = AdmissionControl(state_file=str(tmp_path / "admission.json"),
+                                         max_concurrent=3, rate_per_s=0.01, burst=3, realtime_reserved=1,
+                                         max_wait_s=0.2)
+
+    # another worker sharing the node state
+    other_worker = AdmissionControl(**{**vars(admission_control)})
+
+    with admission_control.slot():
+        with other_worker.slot():
+            # ordinary queries can not use the capacity reserved for realtime
+            with pytest.raises(AdmissionRefused):
+                with admission_control.slot():
+                    pass
+
+            with other_worker.slot(realtime=True):
+                pass
+
+    # the token bucket is empty now, even if nothing is in flight
+    with pytest.raises(AdmissionRefused):
+        with admission_control.slot(realtime=True):
+            pass
+
+
+def test_product_cache(tmp_path):
+    from dispatcher_plugin_integral_all_sky.spiacs_product_cache import ProductCache, product_cache_key
+    from dispatcher_plugin_integral_all_sky.spiacs_time import utc_mjd_to_ijd, isot_to_ijd
+
+    fits_path = tmp_path / "product.fits"
+    fits_path.write_bytes(b"x" * 1000)
+
+    product_cache = ProductCache(str(tmp_path / "cache"), max_bytes=2500, ttl_s=100, realtime_ttl_s=0)
+
+    keys = [product_cache_key(60000., 60000.01, t_bin, 'ordinary') for t_bin in (0.05, 1., 10.)]
+    assert len(set(keys)) == 3
+
+    t2_ijd = utc_mjd_to_ijd(60000.01)
+
+    product_cache.put(keys[0], 'ordinary', str(fits_path), api_product={'a': 1}, t2_ijd=t2_ijd)
+    entry = product_cache.get(keys[0])
+    assert entry.has('api') and not entry.has('frontend')
+    assert entry.load('api') == {'a': 1}
+
+    product_cache.put(keys[0], 'ordinary', str(fits_path), figure={'image': 'i'}, t2_ijd=t2_ijd)
+    assert product_cache.get(keys[0]).load('frontend') == {'image': 'i'}
+
+    # least recently used entry goes first
+    time.sleep(0.01)
+    product_cache.put(keys[1], 'ordinary', str(fits_path), t2_ijd=t2_ijd)
+    time.sleep(0.01)
+    product_cache.get(keys[0])
+    product_cache.put(keys[2], 'ordinary', str(fits_path), t2_ijd=t2_ijd)
+
+    assert product_cache.get(keys[1]) is None
+    assert product_cache.get(keys[0]) is not None
+    assert product_cache.get(keys[2]) is not None
+
+    # realtime entries expire quickly
+    realtime_key = product_cache_key(60000., 60000.01, 1., 'realtime')
+    product_cache.put(realtime_key, 'realtime', str(fits_path))
+    time.sleep(0.01)
+    assert product_cache.get(realtime_key) is None
+
+    # ordinary data of a recent window may still be completed: its entry expires as quickly
+    recent_key = product_cache_key(60000., 60000.01, 2., 'ordinary')
+    product_cache.put(recent_key, 'ordinary', str(fits_path),
+                      t2_ijd=isot_to_ijd(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())))
+    time.sleep(0.01)
+    assert product_cache.get(recent_key) is None
+
+
+def test_compact_counts():
+    from dispatcher_plugin_integral_all_sky.spiacs_raw import CompactCounts
+
+    rng = np.random.default_rng(0)
+
+    # backend precision, a gap, and a grid step slightly off the nominal one
+    ijd = np.round(8484.1 + np.arange(100000) * 0.0500003 / 86400, 10)
+    ijd[30000:] += 7.3 / 86400
+    counts = rng.poisson(150, ijd.size).astype(float)
+
+    data = CompactCounts.from_arrays(ijd, counts)
+
+    assert data.instr_t_bin == 0.05
+    assert data.counts.dtype == np.uint16
+    assert data.segment_start.size == 2
+    assert data.nbytes * 4 < ijd.nbytes + counts.nbytes
+
+    # bit-exact
+    assert np.array_equal(data['TIME_IJD'].view(np.int64), ijd.view(np.int64))
+    assert np.array_equal(data.time_ijd([0, 29999, 30000, -1]), ijd[[0, 29999, 30000, -1]])
+    assert np.array_equal(data['COUNTS'], counts)
+
+    # counts which do not fit in integers are kept as they are
+    assert CompactCounts.from_arrays(ijd[:10], counts[:10] + 0.1).counts.dtype == np.float64
+
+
+def test_chunked_rebin():
+    from dispatcher_plugin_integral_all_sky import spiacs_rebin
+
+    rng = np.random.default_rng(0)
+
+    time_s = np.arange(200000) * 0.05
+    time_s[50000:] += 3.333
+    rate = rng.poisson(150, time_s.size) / 0.05
+    edges = np.arange(time_s[0], time_s[-1] + 0.05, 1.3)
+
+    # the per-bin loop used before
+    bin_ids = np.digitize(time_s, edges)
+    reference = np.array([(np.mean(time_s[bin_ids == i]), np.mean(rate[bin_ids == i]), np.sum(bin_ids == i))
+                          for i in np.unique(bin_ids)])
+
+    for threads in None, 1, 3, 8:
+        time_mean, rate_mean, n_samples = spiacs_rebin.rebin(time_s, rate, edges, threads=threads, chunk_samples=1000)
+
+        assert np.array_equal(time_mean, reference[:, 0])
+        assert np.array_equal(rate_mean, reference[:, 1])
+        assert np.array_equal(n_samples, reference[:, 2])
+
+
+def test_light_curve_pages(tmp_path):
+    from dispatcher_plugin_integral_all_sky.spiacs_lightcurve_query import SpicasLightCurve, DummySpiacsRes
+    from dispatcher_plugin_integral_all_sky.spiacs_dataserver_dispatcher import SpiacsAnalysisException
+
+    ijd = 8484.1 + np.arange(5000) * 0.05 / 86400
+
+    res = DummySpiacsRes()
+    res.status_code = 200
+    res.text = "\n".join(f"{t:.10f} {j * 0.05:.3f} {100 + j % 7} 0" for j, t in enumerate(ijd))
+
+    res_ephs = DummySpiacsRes()
+    res_ephs.text = "'166.134 81.107 109932.3 0.016 0.016 30.0'"
+
+    lc, = SpicasLightCurve.build_from_res((res, res_ephs), 'ordinary', src_name='query', out_dir=str(tmp_path))
+    lc.write()
+
+    full = lc.data.get_data_unit_by_name('RATE').data
+
+    pages = [SpicasLightCurve.read_page(lc.file_path.path, page, 1200) for page in range(5)]
+
+    assert [p.meta_data['rows']['row_start'] for p in pages] == [0, 1200, 2400, 3600, 4800]
+    assert pages[-1].meta_data['rows']['n_pages'] == 5
+
+    paged = np.concatenate([p.get_data_unit_by_name('RATE').data for p in pages])
+    for column in 'TIME', 'RATE', 'ERROR':
+        assert np.array_equal(paged[column], full[column])
+
+    with pytest.raises(SpiacsAnalysisException):
+        SpicasLightCurve.read_page(lc.file_path.path, 5, 1200)
+
+
+def test_realtime_alignment(tmp_path):
+    from dispatcher_plugin_integral_all_sky.spiacs_alignment import (
+        align_counts, RealtimeTimeCorrection, SpiacsAlignmentQuery)
+
+    rng = np.random.default_rng(0)
+
+    def rate(t):
+        return 3000 + 600 * np.sin(t / 3.1) + 400 * np.sin(t / 0.3)
+
+    t = np.arange(20000) * 0.05
+    t_rt = t[500:15000]
+
+    # realtime data, with half the counts, sees the same signal 0.4 s later
+    results, ccf = align_counts(t, rng.poisson(rate(t) * 0.05), 0.05,
+                                t_rt, rng.poisson(rate(t_rt - 0.4) * 0.05 * 0.5), 0.05,
+                                max_lag_s=5.)
+
+    assert abs(results['lag_s'] - 0.4) < 0.05
+    assert abs(results['rate_scale'] - 0.5) < 0.01
+    assert 0.8 < results['residual_chi2_dof'] < 1.2
+    assert ccf['LAG'][0] == -5. and ccf['LAG'][-1] == 5.
+
+    time_correction = RealtimeTimeCorrection(str(tmp_path / "correction.json"), max_distance_s=3600)
+    assert time_correction.correction_s(8484.) == 0.
+
+    time_correction.record(8484., results['lag_s'], results['correlation_peak'])
+    time_correction.record(8485., 1., 0.01)
+
+    assert time_correction.correction_s(8484.01) == -results['lag_s']
+    assert time_correction.correction_s(8485.) == 0.
+
+    query = SpiacsAlignmentQuery('spi_acs_alignment_query')
+    assert not query.check_query_roles([], {'data_level': 'ordinary'})['authorization']
+    assert query.check_query_roles(['integral-realtime'], {'data_level': 'ordinary'})['authorization']
+
+    # corrections apply to all users: recording them is not for every realtime user
+    record = {'data_level': 'ordinary', 'alignment_record_correction': 'yes'}
+    assert not query.check_query_roles(['integral-realtime'], record)['authorization']
+    assert query.check_query_roles(['integral-realtime'], record)['needed_roles'] == ['spiacs-time-correction']
+    assert not query.check_query_roles(['spiacs-time-correction'], record)['authorization']
+    assert query.check_query_roles(['integral-realtime', 'spiacs-time-correction'], record)['authorization']
+
+
+def test_prefetch_triggers(tmp_path):
+    import itertools
+    import threading
+    from dispatcher_plugin_integral_all_sky import spiacs_prefetch
+
+    assert spiacs_prefetch.parse_trigger("2023-03-25T20:30:00.000 GRB230325A\n") == "2023-03-25T20:30:00.000"
+    assert spiacs_prefetch.parse_trigger("# comment\n") is None
+    assert spiacs_prefetch.parse_trigger("8484.5") == "2023-03-25T11:58:50.816"
+
+    with pytest.raises(ValueError):
+        spiacs_prefetch.parse_trigger("yesterday")
+
+    trigger_dir = tmp_path / "triggers"
+    trigger_dir.mkdir()
+    (trigger_dir / "a").write_text("2023-03-25T20:30:00\n")
+    (trigger_dir / "b").write_text("2023-03-26T20:30:00\n")
+
+    triggers = spiacs_prefetch.directory_triggers(str(trigger_dir), poll_s=0.01)
+    assert list(itertools.islice(triggers, 2)) == ["2023-03-25T20:30:00\n", "2023-03-26T20:30:00\n"]
+    assert sorted(p.name for p in trigger_dir.iterdir()) == ["claimed"]
+
+    # a followed file: only complete lines appended after the start are read
+    trigger_file = tmp_path / "triggers.txt"
+    trigger_file.write_text("2023-03-24T20:30:00\n")
+
+    stop = threading.Event()
+    triggers = spiacs_prefetch.file_triggers(str(trigger_file), poll_s=0.01, stop=stop)
+
+    def append():
+        time.sleep(0.1)
+        with open(trigger_file, "a") as f:
+            f.write("2023-03-25T20:30:00\n2023-03-26")
+
+    threading.Thread(target=append).start()
+
+    assert next(triggers) == "2023-03-25T20:30:00\n"
+    stop.set()
+
+
+def test_prefetch_recent_window(tmp_path, stand_in_backend, monkeypatch):
+    import logging
+    from dispatcher_plugin_integral_all_sky import spiacs
+    from dispatcher_plugin_integral_all_sky.spiacs_archive import SpiacsArchive
+    from dispatcher_plugin_integral_all_sky.spiacs_dataserver_dispatcher import SpiacsAnalysisException
+    from dispatcher_plugin_integral_all_sky.spiacs_lightcurve_query import SpicasLightCurve
+    from dispatcher_plugin_integral_all_sky.spiacs_prefetch import SpiacsPrefetcher
+    from dispatcher_plugin_integral_all_sky.spiacs_time import isot_to_ijd
+
+    url, calls = stand_in_backend
+
+    spiacs_factory = spiacs.spiacs_factory
+
+    def instrument_factory():
+        instrument = spiacs_factory()
+        instrument.data_server_conf_dict.update(
+            data_server_url=url + "/zero/genlc/ACS/{t0_isot}/{dt_s}",
+            dummy_cache='',
+            request_coalescing=False,
+            admission_control=None,
+            cassette_mode=None,
+            data_server_cache=None,
+            negative_cache_dir=None,
+            product_cache_dir=None,
+            ephemeris_cache_dir=str(tmp_path / "ephs"),
+            archive_dir=str(tmp_path / "archive"),
+            prefer_archive=True)
+        return instrument
+
+    monkeypatch.setattr(spiacs, 'spiacs_factory', instrument_factory)
+
+    # a trigger of a minute ago: its ordinary data is not processed yet
+    T1 = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(time.time() - 120))
+    T2 = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(time.time() - 60))
+
+    SpiacsPrefetcher().prefetch_window(T1, T2, 'ordinary')
+
+    assert not SpiacsArchive(str(tmp_path / "archive")).covers(isot_to_ijd(T1), isot_to_ijd(T2))
+
+    n_calls = len(calls)
+
+    # the query after it still asks the backend, and tells why there is no data
+    instrument = instrument_factory()
+    instrument.set_par('T1', T1)
+    instrument.set_par('T2', T2)
+    instrument.set_par('data_level', 'ordinary')
+
+    lc_query = instrument.get_query_by_name('spi_acs_lc_query')
+    (res, _), _ = lc_query.get_data_server_query(instrument).run_query(logger=logging.getLogger())
+
+    assert len(calls) > n_calls
+    with pytest.raises(SpiacsAnalysisException, match="ZeroData"):
+        SpicasLightCurve.check_res_has_data(res)
+
+
+def test_query_profiling(tmp_path, monkeypatch):
+    import json
+    import types
+    from dispatcher_plugin_integral_all_sky.spiacs_profiling import profiled, profile_env_var
+    from dispatcher_plugin_integral_all_sky.spiacs_lightcurve_query import SpiacsDataQueryMixin
+
+    class Query(object):
+        @profiled('build_product_list')
+        def build_product_list(self, instrument, res, out_dir, api=False):
+            return [np.zeros(1000)]
+
+    profile = types.SimpleNamespace(value='no')
+    instrument = types.SimpleNamespace(get_par_by_name=lambda name: profile)
+
+    monkeypatch.delenv(profile_env_var, raising=False)
+    assert Query().build_product_list(instrument, None, str(tmp_path))[0].size == 1000
+    assert list(tmp_path.iterdir()) == []
+
+    profile.value = 'yes'
+    Query().build_product_list(instrument, None, out_dir=str(tmp_path))
+
+    assert (tmp_path / "spiacs_profile_build_product_list.pstats").exists()
+
+    stages = json.loads((tmp_path / "spiacs_profile.json").read_text())
+    assert stages['build_product_list']['arrays']['result[0]'] == dict(shape=[1000], dtype='float64', nbytes=8000)
+    assert stages['build_product_list']['traced_peak_bytes'] >= 8000
+    assert len(stages['build_product_list']['top_allocations']) > 0
+
+    assert not SpiacsDataQueryMixin().check_query_roles([], {'spiacs_profile': 'yes'})['authorization']
+    assert SpiacsDataQueryMixin().check_query_roles(['spiacs-profiling'], {'spiacs_profile': 'yes'})['authorization']
+
+
+def test_query_cost():
+    from dispatcher_plugin_integral_all_sky.spiacs_cost import QueryCost, CostLimits, QueryCostExceeded
+
+    cost = QueryCost.estimate(86400., 'ordinary', time_bin_s=1.)
+    assert cost.n_raw_samples == 1728001
+    assert cost.n_output_rows == 86401
+    assert 0.5e9 < cost.peak_memory_bytes < 1.5e9
+
+    assert QueryCost.estimate(100., 'realtime', time_bin_s=0.01).n_output_rows == 2001
+    assert QueryCost.estimate(100., 'realtime').output_bytes == 0
+
+    limits = CostLimits.from_conf_dict(dict(cost_limits=dict(max_raw_samples=10000000,
+                                                             offload_peak_memory_bytes=100000000,
+                                                             max_output_bytes=3000000)))
+
+    assert limits.route(QueryCost.estimate(1000., 'ordinary', time_bin_s=1.)) == 'inline'
+    assert limits.route(cost) == 'process_pool'
+
+    with pytest.raises(QueryCostExceeded) as excinfo:
+        limits.route(QueryCost.estimate(86400., 'ordinary', time_bin_s=0.05))
+    assert 'larger time_bin' in excinfo.value.message
+
+    assert limits.route(QueryCost.estimate(86400., 'ordinary', time_bin_s=0.05), paged=True) == 'process_pool'
+
+    with pytest.raises(QueryCostExceeded) as excinfo:
+        limits.route(QueryCost.estimate(10 * 86400., 'ordinary', time_bin_s=100.))
+    assert 'shorter interval' in excinfo.value.message
+
+    assert CostLimits.from_conf_dict({}) is None
+
+    from cdci_data_analysis.analysis.exceptions import RequestNotUnderstood
+
+    for duration_s in 0., -3600.:
+        with pytest.raises(RequestNotUnderstood) as excinfo:
+            QueryCost.estimate(duration_s, 'ordinary', time_bin_s=1.)
+        assert 'T2 should be after T1' in excinfo.value.message
+
+    from dispatcher_plugin_integral_all_sky.spiacs import spiacs_factory
+
+    instrument = spiacs_factory()
+    instrument.data_server_conf_dict['cost_limits'] = dict(max_output_bytes=3000000)
+    instrument.set_par('T1', '2023-03-25T00:00:00.0')
+    instrument.set_par('T2', '2023-03-26T00:00:00.0')
+    instrument.set_par('time_bin', 0.05)
+    instrument.set_par('lc_page_rows', 1000)
+
+    lc_query = instrument.get_query_by_name('spi_acs_lc_query')
+
+    # paging is for the api only: the frontend is limited once api is known
+    assert lc_query.get_cost_route(instrument) == 'inline'
+    assert lc_query.get_cost_route(instrument, api=True) == 'inline'
+    with pytest.raises(QueryCostExceeded):
+        lc_query.get_cost_route(instrument, api=False)
+
+    instrument.set_par('T2', '2023-03-24T00:00:00.0')
+    with pytest.raises(RequestNotUnderstood):
+        lc_query.get_cost_route(instrument, api=True)
+
+
+def test_negative_cache(tmp_path, stand_in_backend):
+    import types
+    import logging
+    from dispatcher_plugin_integral_all_sky.spiacs_dataserver_dispatcher import SpiacsDispatcher, SpiacsException
+    from dispatcher_plugin_integral_all_sky.spiacs_lightcurve_query import SpicasLightCurve
+    from dispatcher_plugin_integral_all_sky.spiacs_dataserver_dispatcher import SpiacsAnalysisException
+
+    url, calls = stand_in_backend
+
+    def dispatcher(path, t0_isot, data_level='ordinary'):
+        instrument = types.SimpleNamespace(data_server_conf_dict=dict(
+            data_server_url=url + path + "/genlc/ACS/{t0_isot}/{dt_s}",
+            dummy_cache='',
+            request_coalescing=False,
+            negative_cache_dir=str(tmp_path),
+            negative_cache_recent_no_data_ttl_s=0.5))
+
+        return SpiacsDispatcher(instrument=instrument,
+                                param_dict=dict(t0_isot=t0_isot, dt_s=100., data_level=data_level))
+
+    for _ in range(2):
+        res, _ = dispatcher("/zero", "2010-01-01T00:00:00.000").run_query(logger=logging.getLogger())
+        with pytest.raises(SpiacsAnalysisException, match="ZeroData"):
+            SpicasLightCurve.check_res_has_data(res[0])
+
+    assert len(calls) == 2
+
+    for _ in range(2):
+        with pytest.raises(SpiacsException, match="refuses to process"):
+            dispatcher("/refuse", "2010-01-02T00:00:00.000").run_query(logger=logging.getLogger())
+
+    assert len(calls) == 4
+
+    # recent windows may still get data
+    recent_isot = time.strftime("%Y-%m-%dT%H:%M:%S.000", time.gmtime())
+    dispatcher("/zero", recent_isot, 'realtime').run_query(logger=logging.getLogger())
+    dispatcher("/zero", recent_isot, 'realtime').run_query(logger=logging.getLogger())
+    assert len(calls) == 6
+
+    time.sleep(0.6)
+    dispatcher("/zero", recent_isot, 'realtime').run_query(logger=logging.getLogger())
+    assert len(calls) == 8
+
+
+def test_shared_cache(tmp_path, stand_in_backend, monkeypatch):
+    import os
+    import time
+    import types
+    import logging
+    from concurrent import futures
+    from dispatcher_plugin_integral_all_sky.spiacs_shared_cache import ContentStore
+    from dispatcher_plugin_integral_all_sky.spiacs_product_cache import ProductCache
+    from dispatcher_plugin_integral_all_sky.spiacs_dataserver_dispatcher import SpiacsDispatcher
+
+    store = ContentStore(str(tmp_path / "shared"), max_bytes=2500, sweep_interval_s=3600)
+
+    # concurrent writers of the same content and refs
+    with futures.ThreadPoolExecutor(8) as executor:
+        digests = set(executor.map(lambda i: store.put_bytes(b"x" * 1000), range(16)))
+        list(executor.map(lambda i: store.put_ref('test', 'a', 'ordinary', dict(data=digests.copy().pop())),
+                          range(16)))
+
+    digest, = digests
+    assert store.get_bytes(store.get_ref('test', 'a')['objects']['data']) == b"x" * 1000
+
+    # damaged objects are misses
+    with open(store.object_path(digest), 'wb') as f:
+        f.write(b"y" * 1000)
+    assert store.get_ref('test', 'a') is None
+
+    digests = [store.put_bytes(bytes([i]) * 1000) for i in range(5)]
+    for i, digest in enumerate(digests):
+        os.utime(store.object_path(digest), (i, i))
+
+    # the least recently used go
+    store.sweep()
+    assert [store.get_bytes(digest) is not None for digest in digests] == [False, False, False, True, True]
+
+    # refs of recent windows live as long as realtime ones
+    created = time.time() - 120
+    store.put_ref('test', 'settled', 'ordinary', {}, created=created, t2_ijd=0.)
+    store.put_ref('test', 'recent', 'ordinary', {}, created=created, t2_ijd=(created + 60) / 86400. + 1e4)
+    assert store.get_ref('test', 'settled') is not None
+    assert store.get_ref('test', 'recent') is None
+
+    # files removed by a concurrent sweeper are skipped
+    for i in range(5):
+        os.utime(store.object_path(store.put_bytes(bytes([i]) * 1000)), (i, i))
+
+    remove = os.remove
+
+    def remove_twice(path):
+        remove(path)
+        remove(path)
+
+    monkeypatch.setattr(os, 'remove', remove_twice)
+    store.sweep()
+    monkeypatch.undo()
+
+    conf_dict = dict(data_server_cache=str(tmp_path / "shared"), product_cache_dir=str(tmp_path / "products"))
+
+    fits_path = tmp_path / "lc.fits"
+    fits_path.write_bytes(b"FITS" * 100)
+
+    product_cache = ProductCache.from_conf_dict(conf_dict)
+    product_cache.put('key', 'ordinary', str(fits_path), api_product={'a': 1})
+    product_cache.put('key', 'ordinary', str(fits_path), figure={'f': 2})
+
+    entry = ProductCache.from_conf_dict(conf_dict).get('key')
+    assert entry.load('api') == {'a': 1} and entry.load('frontend') == {'f': 2}
+
+    entry.copy_fits_to(str(tmp_path / "copy.fits"))
+    assert (tmp_path / "copy.fits").read_bytes() == fits_path.read_bytes()
+
+    # objects swept or damaged after the entry was found: errors to rebuild on, not a bad product
+    store = ContentStore(str(tmp_path / "shared"))
+    os.remove(store.object_path(entry.ref['objects']['api']))
+    with pytest.raises(OSError):
+        entry.load('api')
+
+    with open(store.object_path(entry.ref['objects']['fits']), 'wb') as f:
+        f.write(b"DAMAGED")
+    with pytest.raises(ValueError):
+        entry.copy_fits_to(str(tmp_path / "damaged.fits"))
+    assert not (tmp_path / "damaged.fits").exists()
+
+    # a second replica gets the response from the shared cache
+    url, calls = stand_in_backend
+
+    def run(mnt_point):
+        instrument = types.SimpleNamespace(data_server_conf_dict=dict(
+            data_server_url=url + "/genlc/ACS/{t0_isot}/{dt_s}",
+            dummy_cache='',
+            request_coalescing=False,
+            dispatcher_mnt_point=mnt_point,
+            data_server_cache='spiacs'))
+
+        return SpiacsDispatcher(instrument=instrument,
+                                param_dict=dict(t0_isot="2010-01-01T00:00:00.000", dt_s=100., data_level='ordinary')
+                                ).run_query(logger=logging.getLogger())[0]
+
+    res = run(str(tmp_path))
+    assert len(calls) == 2
+
+    assert run(str(tmp_path))[0].text == res[0].text
+    assert len(calls) == 2
+
+
+def test_ephemeris_store(tmp_path, stand_in_backend):
+    import types
+    import logging
+    from concurrent import futures
+    from dispatcher_plugin_integral_all_sky import spiacs_ephemeris
+    from dispatcher_plugin_integral_all_sky.spiacs_ephemeris import EphemerisStore
+    from dispatcher_plugin_integral_all_sky.spiacs_dataserver_dispatcher import SpiacsDispatcher
+
+    store = EphemerisStore(str(tmp_path / "ephs"), max_distance_s=60., interpolate=True, max_gap_s=3600.)
+
+    assert store.get(8484.5) is None
+
+    store.put(8484.5, "'166.134 81.107 109932.3 0.016 0.016 30.0'")
+    store.put(8484.5 + 1800 / 86400., "'166.234 81.207 109942.3 0.016 0.016 30.0'")
+    store.put(8484.9, "ZeroData")
+
+    assert store.get(8484.5 + 30 / 86400.).text == "'166.134 81.107 109932.3 0.016 0.016 30.0'"
+    assert store.get(8484.5 + 900 / 86400.).text == "'166.184 81.157 109937.3 0.016 0.016 30'"
+    assert store.get(8484.5 + 7200 / 86400.) is None
+
+    # rows are found by other workers
+    assert EphemerisStore(str(tmp_path / "ephs"), max_distance_s=60.).get(8484.5).text.startswith("'166.134")
+
+    # also once the day is in memory
+    with open(tmp_path / "ephs" / "08484.json") as f:
+        rows = json.load(f)
+    with open(tmp_path / "ephs" / "08484.json", 'w') as f:
+        json.dump(sorted(rows + [[8484.7, "'166.5 81.5 109950.0 0.016 0.016 30.0'"]]), f)
+    assert store.get(8484.7).text.startswith("'166.5")
+
+    # concurrent writers keep all rows, the memory keeps the most recently used days
+    small_store = EphemerisStore(str(tmp_path / "ephs_concurrent"), memory_days=2)
+    with futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda i: small_store.put(8400 + i % 4 + i / 1000., "'%d 1 2'" % i), range(40)))
+
+    with open(tmp_path / "ephs_concurrent" / "08401.json") as f:
+        assert len(json.load(f)) == 10
+    assert len([key for key in spiacs_ephemeris._memory if key[0] == small_store.cache_dir]) <= 2
+    assert small_store.get(8401.005).text == "'5 1 2'"
+
+    url, calls = stand_in_backend
+
+    for t0_isot in "2010-01-01T00:00:00.000", "2010-01-01T00:00:30.000":
+        instrument = types.SimpleNamespace(data_server_conf_dict=dict(
+            data_server_url=url + "/genlc/ACS/{t0_isot}/{dt_s}",
+            dummy_cache='',
+            request_coalescing=False,
+            ephemeris_cache_dir=str(tmp_path / "ephs")))
+
+        SpiacsDispatcher(instrument=instrument,
+                         param_dict=dict(t0_isot=t0_isot, dt_s=100., data_level='ordinary')
+                         ).run_query(logger=logging.getLogger())
+
+    assert len([call for call in calls if '/ephs/' in call]) == 1
+    assert len(calls) == 3
+
+
+def test_cassette(tmp_path, stand_in_backend):
+    import types
+    import logging
+    from dispatcher_plugin_integral_all_sky.spiacs_dataserver_dispatcher import SpiacsDispatcher, SpiacsException
+
+    url, calls = stand_in_backend
+
+    def run(mode, t0_isot="2010-01-01T00:00:00.000", path=""):
+        instrument = types.SimpleNamespace(data_server_conf_dict=dict(
+            data_server_url=url + path + "/genlc/ACS/{t0_isot}/{dt_s}",
+            dummy_cache='',
+            request_coalescing=False,
+            ephemeris_cache=False,
+            cassette_mode=mode,
+            cassette_dir=str(tmp_path / "cassette"),
+            cassette_latency_scale=0.))
+
+        res, _ = SpiacsDispatcher(instrument=instrument,
+                                  param_dict=dict(t0_isot=t0_isot, dt_s=100., data_level='ordinary')
+                                  ).run_query(logger=logging.getLogger())
+        return [r.text for r in res]
+
+    recorded = run('record')
+    assert len(calls) == 2
+
+    with pytest.raises(SpiacsException):
+        run('record', path="/fail")
+
+    n_calls = len(calls)
+
+    assert run('replay') == recorded == ["OK", "'166.134 81.107 109932.3 0.016 0.016 30.0'"]
+
+    with pytest.raises(SpiacsException, match="recorded failure"):
+        run('replay', path="/fail")
+
+    with pytest.raises(SpiacsException, match="not in cassette"):
+        run('replay', t0_isot="2011-01-01T00:00:00.000")
+
+    assert len(calls) == n_calls
+
+
+@pytest.fixture
+def synthetic_backend():
+    import functools
+    import threading
+    from urllib.parse import unquote
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from dispatcher_plugin_integral_all_sky.spiacs_time import isot_to_ijd
+
+    @functools.lru_cache(maxsize=None)
+    def ordinary_text(path):
+        # the same counts for the same window, whoever asks
+        t0_isot, dt_s = unquote(path).split('/')[-2:]
+        t0_ijd, dt_s = isot_to_ijd(t0_isot), float(dt_s)
+
+        n = int(2 * dt_s / 0.05)
+        ijd = t0_ijd - dt_s / 86400 + np.arange(n) * 0.05 / 86400
+        counts = 100 + (np.arange(n) * 7919 + int(t0_ijd * 86400)) % 37
+
+        return "\n".join(f"{t:.10f} {j * 0.05:.3f} {c} 0" for j, (t, c) in enumerate(zip(ijd, counts))).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(0.05)
+
+            self.send_response(200)
+            self.end_headers()
+
+            if '/ephs/' in self.path:
+                self.wfile.write(b"'166.134 81.107 109932.3 0.016 0.016 30.0'")
+            else:
+                self.wfile.write(ordinary_text(self.path.split('?')[0]))
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield f"http://127.0.0.1:{server.server_port}"
+
+    server.shutdown()
+
+
+@pytest.mark.stress
+def test_concurrent_queries(tmp_path, synthetic_backend):
+    import json
+    import types
+    import functools
+    from concurrent import futures
+    from cdci_data_analysis.analysis.products import QueryProductList
+    from dispatcher_plugin_integral_all_sky.spiacs import spiacs_factory
+    from dispatcher_plugin_integral_all_sky.spiacs_time import ijd_to_isot
+
+    def query(i, run_dir):
+        # an instrument per query, like the dispatcher; everything else is shared by the threads
+        instrument = spiacs_factory()
+        instrument.data_server_conf_dict.update(
+            data_server_url=synthetic_backend + "/genlc/ACS/{t0_isot}/{dt_s}",
+            dummy_cache='',
+            admission_control=None,
+            cassette_mode=None,
+            product_cache_dir=str(run_dir / "products"),
+            negative_cache_dir=str(run_dir / "negative"),
+            ephemeris_cache_dir=str(run_dir / "ephs"))
+
+        # windows and bins repeat: some queries are served from the caches
+        t_ijd = 8484.1 + (i % 30) * 0.01
+        instrument.set_par('T1', ijd_to_isot(t_ijd - 60 / 86400))
+        instrument.set_par('T2', ijd_to_isot(t_ijd + 60 / 86400))
+        instrument.set_par('time_bin', [0.5, 2., 0.05][i % 3])
+        instrument._current_par_dic = {'T1': 'x'}
+        instrument.disp_conf = types.SimpleNamespace(products_url='http://products')
+
+        lc_query = instrument.get_query_by_name('spi_acs_lc_query')
+        out_dir = run_dir / f"out_{i}"
+        out_dir.mkdir()
+
+        res, _ = lc_query.get_data_server_query(instrument).run_query(logger=logger)
+        prod_list = lc_query.build_product_list(instrument, res, str(out_dir), api=True)
+        query_out = lc_query.process_product_method(instrument, QueryProductList(prod_list=prod_list), api=True)
+
+        return json.dumps([p.encode() if hasattr(p, 'encode') else p
+                           for p in query_out.prod_dictionary['numpy_data_product_list']], sort_keys=True)
+
+    n_queries = 120
+
+    reference_dir = tmp_path / "reference"
+    reference_dir.mkdir()
+    reference = [query(i, reference_dir) for i in range(n_queries)]
+
+    throughput = {}
+    for n_threads in 1, 4, 16:
+        run_dir = tmp_path / f"threads_{n_threads}"
+        run_dir.mkdir()
+
+        t0 = time.time()
+        with futures.ThreadPoolExecutor(n_threads) as executor:
+            results = list(executor.map(functools.partial(query, run_dir=run_dir), range(n_queries)))
+        throughput[n_threads] = n_queries / (time.time() - t0)
+
+        assert results == reference
+
+    logger.info('queries per second by number of threads: %s', throughput)
+
+    # parsing holds the GIL, waiting for the backend does not
+    assert throughput[4] > 1.3 * throughput[1]
+    assert throughput[16] > 1.3 * throughput[1]
+
+
+def test_backend_fetch_stats(tmp_path, synthetic_backend):
+    import types
+    import logging
+    from cdci_data_analysis.analysis.products import QueryProductList
+    from dispatcher_plugin_integral_all_sky.spiacs import spiacs_factory
+
+    instrument = spiacs_factory()
+    instrument.data_server_conf_dict.update(
+        data_server_url=synthetic_backend + "/genlc/ACS/{t0_isot}/{dt_s}",
+        dummy_cache='',
+        admission_control=None,
+        cassette_mode=None,
+        product_cache_dir=str(tmp_path / "products"),
+        negative_cache_dir=str(tmp_path / "negative"),
+        ephemeris_cache_dir=str(tmp_path / "ephs"))
+    instrument.set_par('T1', '2023-03-25T20:27:40.0')
+    instrument.set_par('T2', '2023-03-25T20:29:40.0')
+    instrument._current_par_dic = {'T1': 'x'}
+    instrument.disp_conf = types.SimpleNamespace(products_url='http://products')
+
+    lc_query = instrument.get_query_by_name('spi_acs_lc_query')
+
+    def status():
+        res, _ = lc_query.get_data_server_query(instrument).run_query(logger=logging.getLogger())
+        prod_list = lc_query.build_product_list(instrument, res, str(tmp_path), api=True)
+        return lc_query.process_product_method(instrument, QueryProductList(prod_list=prod_list),
+                                               api=True).status_dictionary
+
+    # the data and the ephemeris
+    assert json.loads(status()['backend_fetch_stats'])['attempts'] == 2
+
+    # from the product cache, without backend requests
+    assert 'backend_fetch_stats' not in status()
+
+
+def test_product_cache_entry_evicted(tmp_path, synthetic_backend):
+    import types
+    import shutil
+    import logging
+    from cdci_data_analysis.analysis.products import QueryProductList
+    from dispatcher_plugin_integral_all_sky.spiacs import spiacs_factory
+    from dispatcher_plugin_integral_all_sky.spiacs_product_cache import ProductCacheEntry
+
+    instrument = spiacs_factory()
+    instrument.data_server_conf_dict.update(
+        data_server_url=synthetic_backend + "/genlc/ACS/{t0_isot}/{dt_s}",
+        dummy_cache='',
+        admission_control=None,
+        cassette_mode=None,
+        product_cache_dir=str(tmp_path / "products"),
+        negative_cache_dir=str(tmp_path / "negative"),
+        ephemeris_cache_dir=str(tmp_path / "ephs"))
+    instrument.set_par('T1', '2023-03-25T20:27:40.0')
+    instrument.set_par('T2', '2023-03-25T20:29:40.0')
+    instrument._current_par_dic = {'T1': 'x'}
+    instrument.disp_conf = types.SimpleNamespace(products_url='http://products')
+
+    lc_query = instrument.get_query_by_name('spi_acs_lc_query')
+
+    def query(evict=False):
+        res, _ = lc_query.get_data_server_query(instrument).run_query(logger=logging.getLogger())
+
+        if evict:
+            # by another query, between finding the entry and building the products
+            assert isinstance(res, ProductCacheEntry)
+            shutil.rmtree(str(tmp_path / "products"))
+
+        prod_list = lc_query.build_product_list(instrument, res, str(tmp_path), api=True)
+        query_out = lc_query.process_product_method(instrument, QueryProductList(prod_list=prod_list), api=True)
+
+        products = query_out.prod_dictionary['numpy_data_product_list']
+
+        return [p.encode() if hasattr(p, 'encode') else p for p in products], query_out.status_dictionary
+
+    products, _ = query()
+
+    # built again from the backend
+    evicted_products, status = query(evict=True)
+    assert evicted_products == products
+    assert 'backend_fetch_stats' in status
+
+
+def test_realtime_revalidation(tmp_path):
+    import types
+    import hashlib
+    import logging
+    import threading
+    from urllib.parse import unquote
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from dispatcher_plugin_integral_all_sky.spiacs_time import isot_to_ijd
+    from dispatcher_plugin_integral_all_sky.spiacs_dataserver_dispatcher import SpiacsDispatcher
+
+    step_ijd = 0.05 / 86400
+    backend = dict(now_ijd=8484.1, requests=[])
+
+    def realtime_text(t0_isot, dt_s):
+        t0_ijd = isot_to_ijd(t0_isot)
+        k = np.arange(np.ceil((t0_ijd - dt_s / 86400) / step_ijd),
+                      np.floor(min(t0_ijd + dt_s / 86400, backend['now_ijd']) / step_ijd) + 1).astype(int)
+
+        rows = ", ".join(f"[{j * step_ijd:.10f}, {100 + j % 17}]" for j in k)
+
+        return f'{{"lc": {{"columns": ["ijd", "counts"], "data": [{rows}]}}, "prophecy": ["{t0_isot}"]}}'.encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = unquote(self.path.split('?')[0])
+
+            if '/ephs/' in path:
+                body = b"'166.134 81.107 109932.3 0.016 0.016 30.0'"
+            else:
+                t0_isot, dt_s = path.split('/')[-2:]
+                body = realtime_text(t0_isot, float(dt_s))
+                backend['requests'].append((path, len(body)))
+
+            etag = '"%s"' % hashlib.sha256(body).hexdigest()
+
+            if path.startswith('/etag') and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            if path.startswith('/etag'):
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    param_dict = dict(t0_isot="2023-03-25T02:24:00.000", dt_s=600., data_level='realtime')
+
+    def run(mode):
+        instrument = types.SimpleNamespace(data_server_conf_dict=dict(
+            data_server_url=url + "/" + mode + "/genlc/ACS/{t0_isot}/{dt_s}",
+            dummy_cache='',
+            request_coalescing=False,
+            realtime_revalidation_dir=str(tmp_path / mode),
+            realtime_revalidation_overlap_s=2.))
+
+        (res, _), _ = SpiacsDispatcher(instrument=instrument, param_dict=param_dict).run_query(logger=logging.getLogger())
+        return res.content
+
+    def full_response(mode):
+        return requests.get(url + f"/{mode}/rtlc/{param_dict['t0_isot']}/{param_dict['dt_s']}").content
+
+    t0_ijd = isot_to_ijd(param_dict['t0_isot'])
+
+    for mode in 'etag', 'plain':
+        backend['now_ijd'] = t0_ijd - 100 / 86400
+        assert run(mode) == full_response(mode)
+
+        backend['requests'].clear()
+        backend['now_ijd'] = t0_ijd + 30 / 86400
+        assert run(mode) == full_response(mode)
+
+        if mode == 'plain':
+            # only the last 2 s kept and the 130 s which are new were requested
+            (path, n_bytes), _ = backend['requests']
+            assert path != f"/plain/rtlc/{param_dict['t0_isot']}/{param_dict['dt_s']}"
+            assert n_bytes * 4 < len(full_response(mode))
+
+        backend['requests'].clear()
+        assert run(mode) == full_response(mode)
+
+        if mode == 'etag':
+            # answered 304, without a body
+            assert len(backend['requests']) == 2
+
+    # spliced entries keep the age of the full response: rows backfilled before the suffix
+    # are seen once it is older than realtime_revalidation_max_age_s
+    entry_path, = (tmp_path / 'plain').glob('*.json')
+    entry = json.loads(entry_path.read_text())
+    entry['created'] -= 3601
+    entry_path.write_text(json.dumps(entry))
+
+    backend['requests'].clear()
+    backend['now_ijd'] = t0_ijd + 40 / 86400
+    assert run('plain') == full_response('plain')
+    (path, _), _ = backend['requests']
+    assert path.endswith(f"/{param_dict['t0_isot']}/{param_dict['dt_s']}")
+
+    created = json.loads(entry_path.read_text())['created']
+
+    backend['requests'].clear()
+    backend['now_ijd'] = t0_ijd + 50 / 86400
+    assert run('plain') == full_response('plain')
+    (path, _), _ = backend['requests']
+    assert not path.endswith(f"/{param_dict['t0_isot']}/{param_dict['dt_s']}")
+    assert json.loads(entry_path.read_text())['created'] == created
+
+
+def test_power_density_spectrum(tmp_path):
+    from dispatcher_plugin_integral_all_sky.spiacs_pds_query import averaged_leahy_pds, SpiacsPowerSpectrum
+    from dispatcher_plugin_integral_all_sky.spiacs_lightcurve_query import DummySpiacsRes
+
+    rng = np.random.default_rng(2)
+
+    instr_t_bin = 0.05
+    t = np.arange(200000) * instr_t_bin
+    counts = rng.poisson(150 * (1 + 0.05 * np.sin(2 * np.pi * 2.5 * t)))
+
+    # data gap: segments across it are dropped
+    t[150000:] += 33.3
+
+    pds, n_segments, time_bin_s = averaged_leahy_pds(t, counts, instr_t_bin, 16., time_bin_s=0.1)
+
+    assert time_bin_s == 0.1
+    assert 10000 // 16 - 2 <= n_segments < 10000 // 16
+    assert pds['FREQ'][0] == 1 / 16. and pds['FREQ'][-1] == 5.
+
+    # Poisson noise at 2, the QPO stands out
+    peak = np.argmax(pds['POWER'])
+    assert pds['FREQ'][peak] == 2.5
+    assert abs(np.median(pds['POWER']) - 2) < 0.1
+
+    ijd = 8484.1 + t[:20000] / 86400
+
+    res = DummySpiacsRes()
+    res.status_code = 200
+    res.text = "\n".join(f"{x:.10f} {j * 0.05:.3f} {c} 0" for j, (x, c) in enumerate(zip(ijd, counts)))
+
+    res_ephs = DummySpiacsRes()
+    res_ephs.text = "'166.134 81.107 109932.3 0.016 0.016 30.0'"
+
+    table, = SpiacsPowerSpectrum.build_from_res((res, res_ephs), 'ordinary', src_name='query', out_dir=str(tmp_path),
+                                                segment_s=10.)
+
+    du = table.data.get_data_unit_by_name('PDS')
+    assert du.header['NSEGMENT'] == 100 and du.data.size == 100
+
+
+def test_bayesian_blocks(tmp_path):
+    from dispatcher_plugin_integral_all_sky.spiacs_blocks import bayesian_blocks, optimal_partition, ncp_prior
+    from dispatcher_plugin_integral_all_sky.spiacs_lightcurve_query import SpicasLightCurve, DummySpiacsRes
+
+    rng = np.random.default_rng(3)
+
+    n = 10000
+    rate = np.full(n, 150.)
+    rate[3000:] *= 1.5
+    rate[5000:5020] *= 3
+    counts = rng.poisson(rate)
+
+    edges = optimal_partition(counts.astype(float), np.ones(n) * 0.05, ncp_prior(n))
+    assert list(edges) == [0, 3000, 5000, 5020, n]
+
+    # merged cells, edges refined at full resolution
+    assert list(bayesian_blocks(counts, np.ones(n) * 0.05, max_cells=1000)) == list(edges)
+
+    ijd = 8484.1 + np.arange(n) * 0.05 / 86400
+    ijd[7000:] += 10 / 86400
+
+    res = DummySpiacsRes()
+    res.status_code = 200
+    res.text = "\n".join(f"{t:.10f} {j * 0.05:.3f} {c} 0" for j, (t, c) in enumerate(zip(ijd, counts)))
+
+    res_ephs = DummySpiacsRes()
+    res_ephs.text = "'166.134 81.107 109932.3 0.016 0.016 30.0'"
+
+    lc, = SpicasLightCurve.build_from_res((res, res_ephs), 'ordinary', src_name='query', out_dir=str(tmp_path),
+                                          delta_t=0.05, time_bin_mode='bayesian_blocks')
+
+    du = lc.data.get_data_unit_by_name('RATE')
+    blocks = du.data
+
+    assert du.header['TIMEDEL'] == 0.05
+    # the gap is in the last block, but not in its exposure
+    assert np.allclose(blocks['TIMEDEL'], [150., 100., 1., 259.])
+    assert np.isclose(np.sum(blocks['RATE'] * blocks['TIMEDEL']) - blocks['RATE'][-1] * 10, counts.sum())
+    assert np.allclose(blocks['TIME'][1:] - blocks['TIME'][:-1], (blocks['TIMEDEL'][1:] + blocks['TIMEDEL'][:-1]) / 2)
+
+
+def test_dummy_products(tmp_path):
+    from dispatcher_plugin_integral_all_sky.spiacs import spiacs_factory
+    from dispatcher_plugin_integral_all_sky.spiacs_dummy import dummy_light_curve
+    from astropy.time import Time
+
+    data, comment, meta_data = dummy_light_curve(20000, 'ordinary', 1.)
+
+    # built once, and not to be changed by the products made of it
+    assert dummy_light_curve(20000, 'ordinary', 1.)[0] is data
+    assert not data.flags.writeable
+    assert data.size == 1000
+
+    realtime_data = dummy_light_curve(20000, 'realtime', 1.)[0]
+    assert realtime_data.size == data.size
+    assert np.isclose(realtime_data['RATE'].mean(), data['RATE'].mean(), rtol=1e-3)
+
+    instrument = spiacs_factory()
+    instrument.set_par('T1', '2023-03-25T20:27:40.0')
+    instrument.set_par('T2', '2023-03-25T20:37:40.0')
+
+    query = instrument.get_query_by_name('spi_acs_lc_query')
+
+    for data_level, time_bin in ('ordinary', 2.), ('realtime', 0.5):
+        instrument.set_par('data_level', data_level)
+        instrument.set_par('time_bin', time_bin)
+
+        lc, = query.get_dummy_products(instrument, None, out_dir=str(tmp_path)).prod_list
+
+        du = lc.data.get_data_unit_by_name('RATE')
+
+        assert du.header['TIMEDEL'] == time_bin
+        assert du.data.size == int(600 / time_bin)
+        assert abs(du.header['TSTART'] + du.header['TSTOP'] - 2 * du.header['TIMEZERO']) < 2 * time_bin
+
+        date_obs, date_end = Time([du.header['DATE-OBS'], du.header['DATE-END']], format='isot', scale='tt')
+        assert np.isclose((date_end - date_obs).sec, du.header['TSTOP'] - du.header['TSTART'], atol=1e-3)
+
+
+def test_dummy_concurrent_builds(monkeypatch):
+    import threading
+    from concurrent import futures
+    from dispatcher_plugin_integral_all_sky import spiacs_dummy
+
+    building = threading.Event()
+    release = threading.Event()
+    n_built = []
+
+    synthetic_text = spiacs_dummy.synthetic_text
+
+    def slow_synthetic_text(n_samples, data_level, seed=0):
+        n_built.append(n_samples)
+        if n_samples == 30000:
+            building.set()
+            assert release.wait(10)
+        return synthetic_text(n_samples, data_level, seed=seed)
+
+    monkeypatch.setattr(spiacs_dummy, 'synthetic_text', slow_synthetic_text)
+
+    with futures.ThreadPoolExecutor(4) as executor:
+        slow = [executor.submit(spiacs_dummy.dummy_light_curve, 30000, 'ordinary', 1.) for i in range(3)]
+        assert building.wait(10)
+
+        # other light curves are built while this one is
+        assert spiacs_dummy.dummy_light_curve(30001, 'ordinary', 1.)[0].size == 1500
+
+        release.set()
+        data, = {id(f.result()[0]): f.result()[0] for f in slow}.values()
+
+    assert data.size == 1500
+    assert sorted(n_built) == [30000, 30001]